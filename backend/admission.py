@@ -0,0 +1,262 @@
+"""
+Rate limiting and admission control.
+
+Rate limiting is off unless RATE_LIMIT is set. Every request then takes
+tokens from its client's token bucket, which refills at RATE_LIMIT tokens
+per second up to RATE_LIMIT_BURST. A client without enough tokens is
+answered 429 with Retry-After straight away. Clients are told apart by
+RATE_LIMIT_CLIENT_HEADER when it is set (an API key or a client id added by
+the gateway), otherwise by remote address. Behind a proxy or load balancer
+every request has the proxy's address, so all clients would share one
+bucket: set RATE_LIMIT_CLIENT_HEADER there, and a warning is logged at
+startup when it is missing.
+
+A request costs one token, except for views marked `@admission(cost)`.
+Unbounded lists and empty-query searches cost one more token per
+RATE_LIMIT_ROWS_PER_TOKEN rows they are expected to return, estimated from
+the table's row count (planner statistics on PostgreSQL), re-read every
+ROW_ESTIMATE_TTL seconds; the estimate is not read while rate limiting is
+off. With ROUTE_CONCURRENCY set (off by default), marked views also run at
+most that many requests at a time per process; more are answered 503 at
+once instead of queueing for a worker thread or a database connection.
+The cap counts requests served from the response cache too, so set it
+above the number of cheap concurrent hits a route should take.
+
+Buckets and counters live in each worker process, so with N processes a
+client can reach N times the rate. GET /api/health/admission returns the
+counters for monitoring.
+"""
+from flask import request, current_app, jsonify, g
+from models import db
+from jobs import REPLAY_ENVIRON_KEY
+from sqlalchemy import text
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Full buckets are forgotten once this many clients are tracked
+MAX_CLIENTS = 10000
+
+OUTCOMES = ('admitted', 'rate_limited', 'overloaded')
+
+
+class TokenBuckets:
+    """A token bucket per client"""
+
+    def __init__(self):
+        self.buckets = {}  # client -> (tokens, monotonic time of the last update)
+        self.lock = threading.Lock()
+
+    def take(self, client, cost, rate, burst):
+        """Take `cost` tokens; returns 0 if they were taken, else seconds until they will be available"""
+        # A request costing more than the burst needs a full bucket
+        cost = min(cost, burst)
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(client, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens < cost:
+                self.buckets[client] = (tokens, now)
+                return (cost - tokens) / rate
+            self.buckets[client] = (tokens - cost, now)
+            if len(self.buckets) > MAX_CLIENTS:
+                self._forget_full(now, rate, burst)
+            return 0
+
+    def _forget_full(self, now, rate, burst):
+        # A bucket that has refilled is the same as no bucket
+        full = [client for client, (tokens, updated) in self.buckets.items()
+                if tokens + (now - updated) * rate >= burst]
+        for client in full:
+            del self.buckets[client]
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class RouteLimits:
+    """Requests running per route, plus admission counters"""
+
+    def __init__(self):
+        self.running = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def enter(self, route, limit):
+        """Start a request unless `limit` are already running"""
+        with self.lock:
+            if self.running.get(route, 0) >= limit:
+                return False
+            self.running[route] = self.running.get(route, 0) + 1
+            return True
+
+    def leave(self, route):
+        with self.lock:
+            self.running[route] -= 1
+
+    def count(self, route, outcome):
+        with self.lock:
+            counts = self.counts.setdefault(route, dict.fromkeys(OUTCOMES, 0))
+            counts[outcome] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {route: {**counts, 'running': self.running.get(route, 0)}
+                    for route, counts in self.counts.items()}
+
+
+class RowEstimates:
+    """Approximate row counts per table, re-read when older than the TTL"""
+
+    def __init__(self):
+        self.values = {}  # table -> (rows, monotonic time read)
+        self.lock = threading.Lock()
+
+    def get(self, engine, table, ttl):
+        now = time.monotonic()
+        with self.lock:
+            rows, read_at = self.values.get(table, (None, 0))
+        if rows is None or now - read_at > ttl:
+            # Two requests may read it at once; both get a valid estimate
+            rows = _count_rows(engine, table)
+            with self.lock:
+                self.values[table] = (rows, now)
+        return rows
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+def _count_rows(engine, table):
+    with engine.connect() as conn:
+        if engine.dialect.name == 'postgresql':
+            # reltuples is -1 until the table is first analyzed
+            rows = conn.execute(text('SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)'),
+                                {'table': table}).scalar()
+            if rows is not None and rows >= 0:
+                return rows
+        quoted = engine.dialect.identifier_preparer.quote(table)
+        return conn.execute(text(f'SELECT count(*) FROM {quoted}')).scalar()
+
+
+buckets = TokenBuckets()
+route_limits = RouteLimits()
+row_estimates = RowEstimates()
+
+
+def admission(cost):
+    """Mark an expensive view: it costs `cost` tokens (a number, or a function
+    of the query args) and runs at most ROUTE_CONCURRENCY at a time"""
+    def decorator(view):
+        view.admission_cost = cost
+        return view
+    return decorator
+
+
+def exempt(view):
+    """Never rate limit a view, e.g. health checks"""
+    view.admission_exempt = True
+    return view
+
+
+def table_cost(model, unless=None):
+    """Cost function of a view returning every row of `model`; a non-empty
+    `unless` query parameter narrows the result, making it cost one token"""
+    def cost(args):
+        if unless and args.get(unless, '').strip():
+            return 1
+        config = current_app.config
+        rows = row_estimates.get(db.engine, model.__tablename__, config['ROW_ESTIMATE_TTL'])
+        return 1 + rows // config['RATE_LIMIT_ROWS_PER_TOKEN']
+    return cost
+
+
+def request_cost(view, args):
+    """Tokens a request to `view` costs; needs an app context"""
+    # Costs only matter to the token buckets; row estimates may query the database
+    if current_app.config['RATE_LIMIT'] <= 0:
+        return 1
+    cost = getattr(view, 'admission_cost', 1)
+    return cost(args) if callable(cost) else cost
+
+
+def capped(view, config):
+    return (config['ROUTE_CONCURRENCY'] > 0 and hasattr(view, 'admission_cost')
+            and not getattr(view, 'admission_exempt', False))
+
+
+def admit(route, view, cost, client, config):
+    """None if the request may run, else (status, error, Retry-After seconds).
+    An admitted request to a capped view must be followed by `release`."""
+    if capped(view, config) and not route_limits.enter(route, config['ROUTE_CONCURRENCY']):
+        route_limits.count(route, 'overloaded')
+        return 503, 'Too many requests to this endpoint are running, try again shortly', 1
+
+    if config['RATE_LIMIT'] > 0:
+        wait = buckets.take(client, cost, config['RATE_LIMIT'], config['RATE_LIMIT_BURST'])
+        if wait:
+            release(route, view, config)
+            route_limits.count(route, 'rate_limited')
+            return 429, 'Rate limit exceeded', math.ceil(wait)
+
+    route_limits.count(route, 'admitted')
+    return None
+
+
+def release(route, view, config):
+    if capped(view, config):
+        route_limits.leave(route)
+
+
+def admission_stats():
+    config = current_app.config
+    return {
+        'rate_limit': config['RATE_LIMIT'],
+        'burst': config['RATE_LIMIT_BURST'],
+        'route_concurrency': config['ROUTE_CONCURRENCY'],
+        'routes': route_limits.snapshot()
+    }
+
+
+def rejection(status, message, retry_after):
+    response = jsonify({'error': message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def _client():
+    header = current_app.config['RATE_LIMIT_CLIENT_HEADER']
+    return (header and request.headers.get(header)) or request.remote_addr
+
+
+def _admit_request():
+    view = current_app.view_functions.get(request.endpoint)
+    # Replayed background requests were admitted when they were queued
+    if (view is None or request.method == 'OPTIONS' or getattr(view, 'admission_exempt', False)
+            or request.environ.get(REPLAY_ENVIRON_KEY)):
+        return None
+    rejected = admit(request.endpoint, view, request_cost(view, request.args), _client(), current_app.config)
+    if rejected is not None:
+        return rejection(*rejected)
+    g.admitted_view = view
+    return None
+
+
+def _release_request(exc):
+    view = g.pop('admitted_view', None)
+    if view is not None:
+        release(request.endpoint, view, current_app.config)
+
+
+def init_admission(app):
+    if app.config['RATE_LIMIT'] > 0 and not app.config['RATE_LIMIT_CLIENT_HEADER']:
+        logger.warning('RATE_LIMIT is set without RATE_LIMIT_CLIENT_HEADER; clients are told apart by remote '
+                       'address, so behind a proxy they all share one bucket')
+    app.before_request(_admit_request)
+    app.teardown_request(_release_request)
@@ -1,6 +1,13 @@
+import time
+
+# Startup time is measured from here, before Flask and the models are imported
+IMPORT_STARTED = time.perf_counter()
+
 from flask import Flask
 from flask_cors import CORS
 from dotenv import load_dotenv
+import click
+import json
 import os
 
 # Load environment variables
@@ -27,16 +34,100 @@ def create_app():
         database_uri = f'postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}'
     
     app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    
+    # Optional read replicas, comma-separated; GET requests are routed to them by replicas.py
+    replica_uris = [uri.strip() for uri in os.getenv('DATABASE_REPLICA_URIS', '').split(',') if uri.strip()]
+    app.config['SQLALCHEMY_BINDS'] = {f'replica_{i}': uri for i, uri in enumerate(replica_uris)}
+    app.config['REPLICA_BINDS'] = list(app.config['SQLALCHEMY_BINDS'])
+    app.config['REPLICA_CHECK_INTERVAL'] = float(os.getenv('REPLICA_CHECK_INTERVAL', '5'))  # seconds
+    app.config['REPLICA_STICKY_SECONDS'] = int(os.getenv('REPLICA_STICKY_SECONDS', '60'))  # lifetime of the read-your-writes cookie
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    
+    # Startup: 'create' prepares the schema on every start, 'check' only verifies it, 'skip' trusts it
+    app.config['SCHEMA_MODE'] = os.getenv('DB_SCHEMA_MODE', 'create').lower()
+    app.config['POOL_WARM'] = int(os.getenv('DB_POOL_WARM', '0'))  # connections opened at startup
     app.config['UPLOAD_FOLDER'] = os.getenv('UPLOAD_FOLDER', 'uploads')
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
     
+    # Upload storage: 'local' (UPLOAD_FOLDER) or 's3' (any S3-compatible service)
+    app.config['STORAGE_BACKEND'] = os.getenv('STORAGE_BACKEND', 'local').lower()
+    app.config['S3_BUCKET'] = os.getenv('S3_BUCKET')
+    app.config['S3_PREFIX'] = os.getenv('S3_PREFIX', '')
+    app.config['S3_ENDPOINT_URL'] = os.getenv('S3_ENDPOINT_URL')  # e.g. a MinIO server
+    app.config['S3_REGION'] = os.getenv('S3_REGION')
+    app.config['STORAGE_URL_EXPIRY'] = int(os.getenv('STORAGE_URL_EXPIRY', '300'))  # seconds a download URL stays valid
+    
+    # Storage garbage collection (storage_gc.py): 'quarantine', 'delete' or 'report' unreferenced files
+    app.config['GC_MODE'] = os.getenv('GC_MODE', 'quarantine').lower()
+    app.config['GC_INTERVAL'] = int(os.getenv('GC_INTERVAL', '86400'))  # seconds between collections, 0 disables
+    app.config['GC_GRACE_SECONDS'] = int(os.getenv('GC_GRACE_SECONDS', '3600'))  # newer files may still be committing
+    app.config['GC_QUARANTINE_DAYS'] = int(os.getenv('GC_QUARANTINE_DAYS', '30'))
+    app.config['GC_BATCH_SIZE'] = int(os.getenv('GC_BATCH_SIZE', '1000'))  # keys or rows per job
+    
+    # Background jobs
+    app.config['JOB_POLL_INTERVAL'] = float(os.getenv('JOB_POLL_INTERVAL', '1.0'))
+    app.config['JOB_MAX_ATTEMPTS'] = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+    app.config['JOB_RETRY_BACKOFF'] = float(os.getenv('JOB_RETRY_BACKOFF', '5'))  # seconds, doubled per attempt
+    app.config['JOB_TIMEOUT'] = int(os.getenv('JOB_TIMEOUT', '600'))  # seconds before a running job is presumed dead
+    
+    # Audit trail
+    app.config['AUDIT_PARTITION_INTERVAL'] = int(os.getenv('AUDIT_PARTITION_INTERVAL', '86400'))  # seconds between partition checks, 0 disables
+    
+    # Delta sync
+    app.config['TOMBSTONE_MAX_AGE_DAYS'] = int(os.getenv('TOMBSTONE_MAX_AGE_DAYS', '30'))  # older sync tokens must resync
+    app.config['TOMBSTONE_PRUNE_INTERVAL'] = int(os.getenv('TOMBSTONE_PRUNE_INTERVAL', '86400'))  # seconds between prunes, 0 disables
+    
+    # Change feed
+    app.config['CHANGE_STREAM_POLL_INTERVAL'] = float(os.getenv('CHANGE_STREAM_POLL_INTERVAL', '1.0'))
+    app.config['CHANGE_STREAM_MAX_DURATION'] = int(os.getenv('CHANGE_STREAM_MAX_DURATION', '300'))  # seconds per SSE connection
+    app.config['CHANGE_RETENTION_DAYS'] = int(os.getenv('CHANGE_RETENTION_DAYS', '7'))
+    app.config['CHANGE_PRUNE_INTERVAL'] = int(os.getenv('CHANGE_PRUNE_INTERVAL', '86400'))  # seconds between prunes, 0 disables
+    
+    # Response compression
+    app.config['COMPRESSION_MIN_SIZE'] = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))  # bytes
+    app.config['RESPONSE_CACHE_SIZE'] = int(os.getenv('RESPONSE_CACHE_SIZE', '64'))  # cached list responses, 0 disables
+    
+    # Reports
+    app.config['REPORT_REFRESH_DELAY'] = int(os.getenv('REPORT_REFRESH_DELAY', '30'))  # seconds after a write
+    app.config['REPORT_REFRESH_INTERVAL'] = int(os.getenv('REPORT_REFRESH_INTERVAL', '3600'))  # seconds between scheduled refreshes
+    
+    # Async serving of the read routes (asgi.py); defaults to the async driver for DATABASE_URI
+    app.config['ASYNC_DATABASE_URI'] = os.getenv('ASYNC_DATABASE_URI')
+    app.config['ASYNC_POOL_SIZE'] = int(os.getenv('ASYNC_POOL_SIZE', '20'))
+    
+    # Rate limiting and admission control (admission.py); off by default, RATE_LIMIT=0 turns the token buckets off
+    app.config['RATE_LIMIT'] = float(os.getenv('RATE_LIMIT', '0'))  # tokens per second per client, e.g. 20
+    app.config['RATE_LIMIT_BURST'] = int(os.getenv('RATE_LIMIT_BURST', '100'))  # bucket size
+    app.config['RATE_LIMIT_CLIENT_HEADER'] = os.getenv('RATE_LIMIT_CLIENT_HEADER')  # e.g. X-Api-Key; remote address when unset
+    app.config['RATE_LIMIT_ROWS_PER_TOKEN'] = int(os.getenv('RATE_LIMIT_ROWS_PER_TOKEN', '500'))
+    app.config['ROW_ESTIMATE_TTL'] = int(os.getenv('ROW_ESTIMATE_TTL', '60'))  # seconds
+    app.config['ROUTE_CONCURRENCY'] = int(os.getenv('ROUTE_CONCURRENCY', '0'))  # per expensive route and process, 0 = off
+    
+    # Tenant scoping
+    app.config['TENANT_HEADER'] = os.getenv('TENANT_HEADER', 'X-Company-Ids')
+    app.config['TENANT_REQUIRED'] = os.getenv('TENANT_REQUIRED', 'false').lower() == 'true'
+    
     # Initialize extensions
     db.init_app(app)
-    CORS(app)  # Enable CORS for all routes
+    # Enable CORS for all routes; asgi.py reads the same settings
+    app.config['CORS_EXPOSE_HEADERS'] = ['X-Data-Version', 'Retry-After']
+    CORS(app)
+    
+    from compression import init_compression
+    init_compression(app)
+    
+    from tenancy import init_tenancy
+    init_tenancy(app)
+    
+    from admission import init_admission
+    init_admission(app)
+    
+    from storage import init_storage
+    init_storage(app)
     
     # Create upload folder if it doesn't exist
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    if app.config['STORAGE_BACKEND'] == 'local':
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     
     # Register blueprints
     from blueprints.company import company_bp
@@ -44,16 +135,63 @@ def create_app():
     from blueprints.driver import driver_bp
     from blueprints.file import file_bp
     from blueprints.search import search_bp
+    from blueprints.job import job_bp
+    from blueprints.change import change_bp
+    from blueprints.sync import sync_bp
+    from blueprints.audit import audit_bp
+    from blueprints.assignment import assignment_bp
+    from blueprints.report import report_bp
+    from blueprints.health import health_bp
     
     app.register_blueprint(company_bp, url_prefix='/api/companies')
     app.register_blueprint(vehicle_bp, url_prefix='/api/vehicles')
     app.register_blueprint(driver_bp, url_prefix='/api/drivers')
     app.register_blueprint(file_bp, url_prefix='/api/files')
     app.register_blueprint(search_bp, url_prefix='/api/search')
+    app.register_blueprint(job_bp, url_prefix='/api/jobs')
+    app.register_blueprint(change_bp, url_prefix='/api/changes')
+    app.register_blueprint(sync_bp, url_prefix='/api/sync')
+    app.register_blueprint(audit_bp, url_prefix='/api/audit')
+    app.register_blueprint(assignment_bp, url_prefix='/api/assignments')
+    app.register_blueprint(report_bp, url_prefix='/api/reports')
+    app.register_blueprint(health_bp, url_prefix='/api/health')
+    
+    from replicas import init_replicas
+    init_replicas(app, db)
+    
+    from startup import SCHEMA_MODES, prepare_database, check_database, warm_pool
+    # Also registers the storage.gc job for workers
+    from storage_gc import GC_MODES, collect_garbage
+    
+    @app.cli.command('init-db')
+    def init_db():
+        """Create or upgrade the database schema"""
+        prepare_database()
+        print('Database ready')
+    
+    @app.cli.command('storage-gc')
+    @click.option('--dry-run', is_flag=True, help='Only report orphaned and missing files')
+    def storage_gc(dry_run):
+        """Reconcile stored files with the files table"""
+        print(json.dumps(collect_garbage('report' if dry_run else None), indent=2))
+    
+    if app.config['SCHEMA_MODE'] not in SCHEMA_MODES:
+        raise ValueError(f"DB_SCHEMA_MODE must be one of {', '.join(SCHEMA_MODES)}")
+    if app.config['GC_MODE'] not in GC_MODES:
+        raise ValueError(f"GC_MODE must be one of {', '.join(GC_MODES)}")
     
-    # Create tables
     with app.app_context():
-        db.create_all()
+        if app.config['SCHEMA_MODE'] == 'create':
+            prepare_database()
+        elif app.config['SCHEMA_MODE'] == 'check':
+            check_database()
+        warm_pool(db.engine, app.config['POOL_WARM'])
+    
+    app.extensions['startup'] = {
+        'schema_mode': app.config['SCHEMA_MODE'],
+        'seconds': round(time.perf_counter() - IMPORT_STARTED, 3)
+    }
+    app.logger.info('Started in %.3fs (schema mode %s)', app.extensions['startup']['seconds'], app.config['SCHEMA_MODE'])
     
     return app
 
@@ -0,0 +1,395 @@
+"""
+Async (ASGI) serving mode for the read API.
+
+    uvicorn asgi:create_asgi_app --factory --port 5000
+
+serves the read-heavy GET routes (company, vehicle, driver and file lists
+and details, file downloads and search) with async SQLAlchemy, so a burst
+of slow requests waits on the database instead of holding one worker
+thread each. Every other route is passed to the Flask app unchanged, so
+this is a drop-in replacement for the WSGI server.
+
+The async routes run the same ORM queries and `to_dict` serializers
+through `AsyncSession.run_sync`, and answer with the same bytes and
+headers as the Flask views: compact JSON, Flask's HTML error pages and
+the CORS headers of the app's flask-cors settings, formats and tenant
+scoping included. They are rate limited like them (see admission.py).
+`python benchmarks/compare_async.py` checks both servers answer alike. They read from the primary (or
+ASYNC_DATABASE_URI) and are not cached in memory.
+
+Needs `pip install starlette uvicorn` and an async driver: asyncpg for
+PostgreSQL, aiosqlite for SQLite.
+"""
+from app import create_app
+from admission import admit, release, request_cost
+from models import Company, Vehicle, Driver, File, SyncState
+from columnar import MSGPACK_MIMETYPE, choose_format, encode_columns, msgpack
+from compression import COMPRESSORS, compress, response_profile
+from documents import search_documents
+from faceting import VEHICLE_SEARCH, DRIVER_SEARCH, apply_filters, apply_sort, facet_counts
+from schema import SchemaError
+from storage import CHUNK_SIZE, LocalStorage, storage_key
+from tenancy import TENANT_KEY, parse_tenant_header
+from sqlalchemy import or_
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from flask_cors.core import get_cors_headers, get_cors_options
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.responses import FileResponse, RedirectResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import Headers, MIMEAccept
+from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.http import parse_accept_header
+from contextlib import asynccontextmanager
+from functools import partial
+from urllib.parse import quote
+import os
+import unicodedata
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    from starlette.middleware.wsgi import WSGIMiddleware
+
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+
+def async_database_uri(uri):
+    """The async-driver version of a database URI"""
+    url = make_url(uri)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise ValueError(f'No async driver known for {url.get_backend_name()}; set ASYNC_DATABASE_URI')
+    return url.set(drivername=driver)
+
+
+def _get(session, model, object_id):
+    obj = session.get(model, object_id)
+    if obj is None:
+        raise NotFound()
+    return obj
+
+
+def _download_headers(filename):
+    """Content-Disposition and Cache-Control as Flask's send_file sets them for a download"""
+    try:
+        filename.encode('ascii')
+        names = {'filename': filename}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': simple, 'filename*': f"UTF-8''{quote(filename, safe='!#$&+-.^_`|~')}"}
+    headers = Headers({'Cache-Control': 'no-cache'})
+    headers.set('Content-Disposition', 'attachment', **names)
+    return dict(headers)
+
+
+class ReadAPI:
+    """Async handlers for the read routes of a Flask app"""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.config = flask_app.config
+        self.storage = flask_app.extensions['storage']
+        # Rate limits and costs are those of the Flask view serving the same URL
+        self.urls = flask_app.url_map.bind('localhost')
+        self.cors_options = get_cors_options(flask_app)
+        uri = self.config['ASYNC_DATABASE_URI'] or async_database_uri(self.config['SQLALCHEMY_DATABASE_URI'])
+        self.engine = create_async_engine(uri, pool_size=self.config['ASYNC_POOL_SIZE'])
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    # --- Responses ---
+
+    def json(self, body):
+        """The bytes `jsonify(body)` sends"""
+        return self.flask_app.json.response(body).get_data()
+
+    async def respond(self, request, body, status=200, media_type='application/json'):
+        if not isinstance(body, bytes):
+            body = self.json(body)
+        headers = {'Vary': 'Accept-Encoding'}
+        if len(body) >= self.config['COMPRESSION_MIN_SIZE']:
+            encoding = parse_accept_header(request.headers.get('accept-encoding')).best_match(list(COMPRESSORS))
+            if encoding is not None:
+                return await run_in_threadpool(self._compressed, body, encoding, request.state.compression_profile,
+                                               status, media_type, headers)
+        return Response(body, status, headers, media_type)
+
+    @staticmethod
+    def _compressed(body, encoding, profile, status, media_type, headers):
+        headers['Content-Encoding'] = encoding
+        return Response(compress(body, encoding, profile), status, headers, media_type)
+
+    def error(self, status, message, headers=None):
+        return Response(self.json({'error': message}), status, {'Vary': 'Accept-Encoding', **(headers or {})},
+                        'application/json')
+
+    @staticmethod
+    def http_error(error):
+        """Flask's default page for an HTTP error"""
+        return Response(error.get_body(), error.code, dict(error.get_headers()))
+
+    def cors(self, request, response):
+        """Add the headers flask-cors adds to the Flask app's responses"""
+        for name, value in get_cors_headers(self.cors_options, request.headers, request.method).items(multi=True):
+            response.headers.append(name, str(value))
+        return response
+
+    async def items(self, request, session, model, load):
+        """Respond with the objects `load(session)` returns, in the requested list format"""
+        accept = parse_accept_header(request.headers.get('accept'), MIMEAccept)
+        fmt = choose_format(request.query_params.get('format'), accept.best)
+        if fmt == 'msgpack' and msgpack is None:
+            return self.error(406, 'MessagePack responses need the msgpack package')
+
+        def serialize(sync_session):
+            result = load(sync_session)
+            objs, extra = result if isinstance(result, tuple) else (result, None)
+            if fmt == 'rows':
+                items = [obj.to_dict() for obj in objs]
+                return {'items': items, **extra} if extra else items
+            payload = encode_columns(model.schema, objs)
+            payload.update(extra or {})
+            return payload
+
+        payload = await session.run_sync(serialize)
+        if fmt == 'msgpack':
+            return await self.respond(request, msgpack.packb(payload), media_type=MSGPACK_MIMETYPE)
+        return await self.respond(request, payload)
+
+    async def one(self, request, session, load):
+        return await self.respond(request, await session.run_sync(lambda s: load(s).to_dict()))
+
+    async def many(self, request, session, load):
+        return await self.respond(request, await session.run_sync(lambda s: [obj.to_dict() for obj in load(s)]))
+
+    def endpoint(self, handler):
+        """Wrap a handler(request, session) with tenant scoping, admission control, error responses and CORS"""
+        async def run(request):
+            return self.cors(request, await scoped(request))
+
+        async def scoped(request):
+            header = request.headers.get(self.config['TENANT_HEADER'])
+            if header is None and self.config['TENANT_REQUIRED']:
+                return self.error(403, f"{self.config['TENANT_HEADER']} header is required")
+            try:
+                ids = parse_tenant_header(header) if header is not None else None
+            except ValueError:
+                return self.error(400, f"Invalid {self.config['TENANT_HEADER']} header")
+
+            route, _ = self.urls.match(request.url.path, 'GET')
+            view = self.flask_app.view_functions[route]
+            request.state.compression_profile = response_profile(view, self.config)
+            cost = getattr(view, 'admission_cost', 1)
+            if callable(cost) and self.config['RATE_LIMIT'] > 0:
+                # Row estimates may query the database
+                cost = await run_in_threadpool(self._cost, view, request.query_params)
+            client_header = self.config['RATE_LIMIT_CLIENT_HEADER']
+            client = (client_header and request.headers.get(client_header)) or request.client.host
+            rejected = admit(route, view, cost, client, self.config)
+            if rejected is not None:
+                status, message, retry_after = rejected
+                return self.error(status, message, {'Retry-After': str(retry_after)})
+
+            try:
+                async with self.sessions() as session:
+                    if ids is not None:
+                        session.info[TENANT_KEY] = ids
+                    try:
+                        if not getattr(view, 'response_cache', False):
+                            return await handler(request, session)
+                        # Lists carry the version read before their query, like @cached views
+                        version = await session.run_sync(
+                            lambda s: s.query(SyncState.version).filter_by(id=1).scalar() or 0)
+                        response = await handler(request, session)
+                        if response.status_code == 200:
+                            response.headers['X-Data-Version'] = str(version)
+                        return response
+                    except HTTPException as e:
+                        return self.http_error(e)
+                    except SchemaError as e:
+                        return self.error(e.status_code, e.message)
+            finally:
+                release(route, view, self.config)
+        return run
+
+    def _cost(self, view, args):
+        with self.flask_app.app_context():
+            return request_cost(view, args)
+
+    # --- Handlers ---
+
+    async def list_companies(self, request, session):
+        return await self.items(request, session, Company, lambda s: s.query(Company).all())
+
+    async def get_company(self, request, session):
+        return await self.one(request, session, lambda s: _get(s, Company, request.path_params['company_id']))
+
+    async def company_vehicles(self, request, session):
+        company_id = request.path_params['company_id']
+
+        def load(s):
+            _get(s, Company, company_id)
+            return s.query(Vehicle).filter_by(company_id=company_id).all()
+        return await self.many(request, session, load)
+
+    async def company_drivers(self, request, session):
+        company_id = request.path_params['company_id']
+
+        def load(s):
+            _get(s, Company, company_id)
+            return s.query(Driver).filter_by(company_id=company_id).all()
+        return await self.many(request, session, load)
+
+    async def list_vehicles(self, request, session):
+        return await self.items(request, session, Vehicle, lambda s: s.query(Vehicle).all())
+
+    async def get_vehicle(self, request, session):
+        return await self.one(request, session, lambda s: _get(s, Vehicle, request.path_params['vehicle_id']))
+
+    async def list_drivers(self, request, session):
+        return await self.items(request, session, Driver, lambda s: s.query(Driver).all())
+
+    async def get_driver(self, request, session):
+        return await self.one(request, session, lambda s: _get(s, Driver, request.path_params['driver_id']))
+
+    async def list_files(self, request, session):
+        return await self.items(request, session, File, lambda s: s.query(File).all())
+
+    async def get_file(self, request, session):
+        return await self.one(request, session, lambda s: _get(s, File, request.path_params['file_id']))
+
+    def _owned_files(self, owner, column):
+        async def handler(request, session):
+            owner_id = request.path_params['owner_id']
+
+            def load(s):
+                _get(s, owner, owner_id)
+                return s.query(File).filter(column == owner_id).all()
+            return await self.items(request, session, File, load)
+        return handler
+
+    async def download_file(self, request, session):
+        file = await session.run_sync(lambda s: _get(s, File, request.path_params['file_id']))
+        key = storage_key(file.file_url)
+        if key is None:
+            return self.error(404, 'File not found on server')
+
+        url = self.storage.url(key, file.filename, self.config['STORAGE_URL_EXPIRY'])
+        if url:
+            return RedirectResponse(url, 302)
+        if isinstance(self.storage, LocalStorage):
+            path = self.storage.path(key)
+            if not os.path.isfile(path):
+                return self.error(404, 'File not found on server')
+            return FileResponse(path, media_type='application/octet-stream', headers=_download_headers(file.filename))
+
+        try:
+            stream = await run_in_threadpool(self.storage.open, key)
+        except FileNotFoundError:
+            return self.error(404, 'File not found on server')
+        chunks = iterate_in_threadpool(iter(partial(stream.read, CHUNK_SIZE), b''))
+        return StreamingResponse(chunks, media_type='application/octet-stream',
+                                 headers=_download_headers(file.filename),
+                                 background=BackgroundTask(stream.close))
+
+    async def search_companies(self, request, session):
+        query = request.query_params.get('q', '').strip()
+
+        def load(s):
+            companies = s.query(Company)
+            if query:
+                companies = companies.filter(or_(
+                    Company.name.ilike(f'%{query}%'),
+                    Company.identity_card.ilike(f'%{query}%')
+                ))
+            return companies.all()
+        return await self.items(request, session, Company, load)
+
+    async def search_vehicles(self, request, session):
+        query = request.query_params.get('q', '').strip()
+
+        def load(s):
+            vehicles = s.query(Vehicle)
+            if query:
+                vehicles = vehicles.filter(Vehicle.license_plate.ilike(f'%{query}%'))
+            vehicles = apply_filters(VEHICLE_SEARCH, vehicles, request.query_params)
+            facets = facet_counts(VEHICLE_SEARCH, vehicles)
+            return apply_sort(VEHICLE_SEARCH, vehicles, request.query_params.get('sort')).all(), {'facets': facets}
+        return await self.items(request, session, Vehicle, load)
+
+    async def search_drivers(self, request, session):
+        query = request.query_params.get('q', '').strip()
+
+        def load(s):
+            drivers = s.query(Driver)
+            if query:
+                drivers = drivers.filter(or_(
+                    Driver.first_name.ilike(f'%{query}%'),
+                    Driver.last_name.ilike(f'%{query}%'),
+                    Driver.identity_card.ilike(f'%{query}%')
+                ))
+            drivers = apply_filters(DRIVER_SEARCH, drivers, request.query_params)
+            facets = facet_counts(DRIVER_SEARCH, drivers)
+            return apply_sort(DRIVER_SEARCH, drivers, request.query_params.get('sort')).all(), {'facets': facets}
+        return await self.items(request, session, Driver, load)
+
+    async def search_files(self, request, session):
+        params = request.query_params
+        query = params.get('q', '').strip()
+        if not query:
+            return self.error(400, 'q is required')
+
+        def int_param(name):
+            try:
+                return int(params[name]) if name in params else None
+            except ValueError:
+                return None
+
+        limit = min(int_param('limit') or 20, 100)
+        scope = {name: int_param(name) for name in ('company_id', 'vehicle_id', 'driver_id')}
+        hits = await session.run_sync(lambda s: [
+            {'file': file.to_dict(), 'rank': rank, 'snippet': snippet}
+            for file, rank, snippet in search_documents(query, limit=limit, session=s, **scope)
+        ])
+        return await self.respond(request, hits)
+
+    def routes(self):
+        def get(path, handler):
+            return Route(path, self.endpoint(handler), methods=['GET'])
+
+        return [
+            get('/api/companies', self.list_companies),
+            get('/api/companies/{company_id:int}', self.get_company),
+            get('/api/companies/{company_id:int}/vehicles', self.company_vehicles),
+            get('/api/companies/{company_id:int}/drivers', self.company_drivers),
+            get('/api/vehicles', self.list_vehicles),
+            get('/api/vehicles/{vehicle_id:int}', self.get_vehicle),
+            get('/api/drivers', self.list_drivers),
+            get('/api/drivers/{driver_id:int}', self.get_driver),
+            get('/api/files', self.list_files),
+            get('/api/files/{file_id:int}', self.get_file),
+            get('/api/files/{file_id:int}/download', self.download_file),
+            get('/api/files/companies/{owner_id:int}', self._owned_files(Company, File.company_id)),
+            get('/api/files/vehicles/{owner_id:int}', self._owned_files(Vehicle, File.vehicle_id)),
+            get('/api/files/drivers/{owner_id:int}', self._owned_files(Driver, File.driver_id)),
+            get('/api/search/companies', self.search_companies),
+            get('/api/search/vehicles', self.search_vehicles),
+            get('/api/search/drivers', self.search_drivers),
+            get('/api/search/files', self.search_files),
+        ]
+
+
+def create_asgi_app(flask_app=None):
+    """ASGI application: async read routes, everything else served by Flask"""
+    flask_app = flask_app or create_app()
+    api = ReadAPI(flask_app)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        await api.engine.dispose()
+
+    # Requests the async routes do not serve, including CORS preflights, go to Flask
+    return Starlette(routes=[*api.routes(), Mount('', WSGIMiddleware(flask_app))], lifespan=lifespan)
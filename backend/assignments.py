@@ -0,0 +1,271 @@
+"""
+Driver-vehicle assignment service.
+
+A driver can be assigned to at most one vehicle. The unique index on
+vehicle.assigned_driver_id enforces that in the database, and the service
+takes row locks (SELECT ... FOR UPDATE) on every driver and vehicle it touches
+so concurrent assignments queue up instead of racing. Drivers are always
+locked before vehicles, each in id order, to avoid deadlocks. Whatever
+still conflicts (a unique violation, deadlock or busy database) is
+retried by `run_with_retry`.
+
+Every change of vehicle.assigned_driver_id, whichever route makes it, also
+closes and opens periods in `assignment_history`, which answers "who drove
+vehicle X at time T" long after the assignment changed. Each period stores
+the vehicle's company, so tenant-scoped callers only read their own.
+"""
+from models import db, Vehicle, Driver, AssignmentHistory
+from changes import record_change
+from tenancy import add_company_column
+from sqlalchemy import event, inspect, select, func, or_, text, update, cast, DateTime
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+from sqlalchemy.orm import Session
+from datetime import datetime
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AssignmentError(Exception):
+    """An assignment request that cannot be carried out"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def run_with_retry(func, retries=3, backoff=0.05):
+    """Run `func` and commit, retrying the whole transaction on conflicts"""
+    for attempt in range(retries + 1):
+        try:
+            result = func()
+            db.session.commit()
+            return result
+        except (IntegrityError, OperationalError):
+            db.session.rollback()
+            if attempt == retries:
+                raise AssignmentError('Assignment conflicted with a concurrent change, please retry', 409)
+            # Jitter so the competing transactions do not collide again
+            time.sleep(backoff * (2 ** attempt) * (0.5 + random.random()))
+        except AssignmentError:
+            db.session.rollback()
+            raise
+
+
+def _lock(model, ids):
+    """Lock rows in id order and return them by id"""
+    if not ids:
+        return {}
+    rows = model.query.filter(model.id.in_(ids)).order_by(model.id).with_for_update().all()
+    return {row.id: row for row in rows}
+
+
+def bulk_assign(pairs):
+    """Apply (vehicle_id, driver_id) pairs atomically in the current transaction.
+
+    driver_id None unassigns the vehicle. Drivers are moved off any vehicle
+    they held before, so swapping drivers between vehicles is one call.
+    Returns the assigned vehicles; the caller commits.
+    """
+    vehicle_ids = [vehicle_id for vehicle_id, _ in pairs]
+    driver_ids = [driver_id for _, driver_id in pairs if driver_id]
+    if len(set(vehicle_ids)) != len(vehicle_ids):
+        raise AssignmentError('Each vehicle can appear only once')
+    if len(set(driver_ids)) != len(driver_ids):
+        raise AssignmentError('A driver can be assigned to only one vehicle')
+
+    drivers = _lock(Driver, sorted(set(driver_ids)))
+    missing = set(driver_ids) - set(drivers)
+    if missing:
+        raise AssignmentError(f'Driver not found: {sorted(missing)[0]}', 404)
+
+    vehicles = _lock(Vehicle, sorted(set(vehicle_ids)))
+    missing = set(vehicle_ids) - set(vehicles)
+    if missing:
+        raise AssignmentError(f'Vehicle not found: {sorted(missing)[0]}', 404)
+
+    # Vehicles currently holding one of the drivers lose them
+    previous = []
+    if driver_ids:
+        previous = (Vehicle.query
+                    .filter(Vehicle.assigned_driver_id.in_(driver_ids), Vehicle.id.notin_(vehicle_ids))
+                    .order_by(Vehicle.id)
+                    .with_for_update()
+                    .all())
+
+    changed = [(vehicles[vehicle_id], driver_id or None) for vehicle_id, driver_id in pairs
+               if vehicles[vehicle_id].assigned_driver_id != (driver_id or None)]
+
+    # Clear first and flush, so the unique index never sees a driver twice mid-swap
+    for vehicle in [vehicle for vehicle, _ in changed] + previous:
+        record_change('driver', vehicle.assigned_driver, 'update')
+        vehicle.assigned_driver_id = None
+    db.session.flush()
+
+    for vehicle, driver_id in changed:
+        vehicle.assigned_driver_id = driver_id
+        record_change('vehicle', vehicle, 'assign')
+        record_change('driver', drivers.get(driver_id), 'update')
+    for vehicle in previous:
+        record_change('vehicle', vehicle, 'assign')
+    db.session.flush()
+
+    return [vehicles[vehicle_id] for vehicle_id in vehicle_ids]
+
+
+def set_vehicle_driver(vehicle_id, driver_id):
+    """Assign `driver_id` (or nobody) to a vehicle; the caller commits"""
+    return bulk_assign([(vehicle_id, driver_id)])[0]
+
+
+# --- Assignment history ---
+
+@event.listens_for(Session, 'after_flush')
+def _record_assignment_periods(session, flush_context):
+    closed = set()
+    opened = []
+    for vehicle in session.new:
+        if isinstance(vehicle, Vehicle) and vehicle.assigned_driver_id:
+            opened.append((vehicle.id, vehicle.assigned_driver_id, vehicle.company_id))
+    for vehicle in session.dirty:
+        if not isinstance(vehicle, Vehicle):
+            continue
+        history = inspect(vehicle).attrs.assigned_driver_id.history
+        if not history.has_changes():
+            continue
+        if history.deleted and history.deleted[0] == vehicle.assigned_driver_id:
+            continue
+        closed.add(vehicle.id)
+        if vehicle.assigned_driver_id:
+            opened.append((vehicle.id, vehicle.assigned_driver_id, vehicle.company_id))
+    for vehicle in session.deleted:
+        if isinstance(vehicle, Vehicle):
+            closed.add(vehicle.id)
+
+    if not closed and not opened:
+        return
+
+    now = datetime.utcnow()
+    table = AssignmentHistory.__table__
+    connection = session.connection()
+    if closed:
+        connection.execute(
+            update(table).where(table.c.vehicle_id.in_(closed), table.c.valid_to.is_(None)).values(valid_to=now)
+        )
+    if opened:
+        connection.execute(table.insert(), [
+            {'vehicle_id': vehicle_id, 'driver_id': driver_id, 'valid_from': now, 'valid_to': None,
+             'company_id': company_id}
+            for vehicle_id, driver_id, company_id in opened
+        ])
+
+
+# GiST indexes over the validity range; btree_gist lets them lead with the id
+POSTGRES_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_assignment_history_period ON assignment_history "
+    "USING gist (tsrange(valid_from, valid_to, '[)'))",
+]
+POSTGRES_BTREE_GIST_INDEXES = [
+    "CREATE EXTENSION IF NOT EXISTS btree_gist",
+    "CREATE INDEX IF NOT EXISTS ix_assignment_history_vehicle_period ON assignment_history "
+    "USING gist (vehicle_id, tsrange(valid_from, valid_to, '[)'))",
+    "CREATE INDEX IF NOT EXISTS ix_assignment_history_driver_period ON assignment_history "
+    "USING gist (driver_id, tsrange(valid_from, valid_to, '[)'))",
+]
+
+
+def ensure_assignment_history():
+    """Create range indexes and open periods for assignments made before history existed"""
+    if add_company_column(AssignmentHistory.__table__.name):
+        # Periods of deleted vehicles keep no company and are only visible unscoped
+        db.session.execute(text(
+            "UPDATE assignment_history SET company_id = "
+            "(SELECT v.company_id FROM vehicle v WHERE v.id = assignment_history.vehicle_id) "
+            "WHERE company_id IS NULL"
+        ))
+        db.session.commit()
+
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.begin() as conn:
+            for statement in POSTGRES_INDEXES:
+                conn.execute(text(statement))
+        try:
+            with db.engine.begin() as conn:
+                for statement in POSTGRES_BTREE_GIST_INDEXES:
+                    conn.execute(text(statement))
+        except ProgrammingError:
+            # Installing extensions needs extra privileges; the plain range index still works
+            logger.warning('btree_gist unavailable, using range-only assignment index', exc_info=True)
+
+    # The real start of these assignments is unknown, so their history starts now
+    db.session.execute(text(
+        "INSERT INTO assignment_history (vehicle_id, driver_id, valid_from, company_id) "
+        "SELECT v.id, v.assigned_driver_id, :now, v.company_id FROM vehicle v "
+        "WHERE v.assigned_driver_id IS NOT NULL AND NOT EXISTS ("
+        "SELECT 1 FROM assignment_history h WHERE h.vehicle_id = v.id AND h.valid_to IS NULL)"
+    ), {'now': datetime.utcnow()})
+    db.session.commit()
+
+
+def ensure_unique_assignments():
+    """Create the one-vehicle-per-driver unique index on databases created before it existed.
+
+    Duplicate assignments left by earlier races would make the index fail, so
+    each doubly assigned driver first keeps only the vehicle updated last;
+    the others are unassigned, with history and change events as usual, and
+    logged.
+    """
+    duplicates = db.session.execute(
+        select(Vehicle.assigned_driver_id).where(Vehicle.assigned_driver_id.isnot(None))
+        .group_by(Vehicle.assigned_driver_id).having(func.count() > 1)
+    ).scalars().all()
+    for driver_id in duplicates:
+        vehicles = Vehicle.query.filter_by(assigned_driver_id=driver_id).all()
+        kept = max(vehicles, key=lambda vehicle: (vehicle.updated_at or datetime.min, vehicle.id))
+        cleared = [vehicle for vehicle in vehicles if vehicle is not kept]
+        logger.warning('Driver %s was assigned to vehicles %s; kept vehicle %s and unassigned the others',
+                       driver_id, sorted(vehicle.id for vehicle in vehicles), kept.id)
+        for vehicle in cleared:
+            vehicle.assigned_driver_id = None
+            record_change('vehicle', vehicle, 'assign')
+        record_change('driver', kept.assigned_driver, 'update')
+    db.session.commit()
+
+    for index in Vehicle.__table__.indexes:
+        if index.name == 'ux_vehicle_assigned_driver_id':
+            index.create(db.engine, checkfirst=True)
+
+
+def _overlapping(query, start, end=None):
+    """Keep periods containing `start`, or overlapping [start, end) when `end` is given"""
+    if db.engine.dialect.name == 'postgresql':
+        # Same expression as the GiST indexes so PostgreSQL can use them
+        period = func.tsrange(AssignmentHistory.valid_from, AssignmentHistory.valid_to, '[)')
+        if end is None:
+            return query.filter(period.op('@>')(cast(start, DateTime)))
+        return query.filter(period.op('&&')(func.tsrange(start, end, '[)')))
+
+    if end is None:
+        end_filter = AssignmentHistory.valid_from <= start
+    else:
+        end_filter = AssignmentHistory.valid_from < end
+    return query.filter(end_filter, or_(AssignmentHistory.valid_to.is_(None), AssignmentHistory.valid_to > start))
+
+
+def assignment_periods(vehicle_id=None, driver_id=None, start=None, end=None, limit=100, offset=0):
+    """Assignment periods, newest first, optionally for one vehicle or driver and a time window"""
+    query = AssignmentHistory.query
+    if vehicle_id is not None:
+        query = query.filter(AssignmentHistory.vehicle_id == vehicle_id)
+    if driver_id is not None:
+        query = query.filter(AssignmentHistory.driver_id == driver_id)
+    if start is not None:
+        query = _overlapping(query, start, end)
+    return (query
+            .order_by(AssignmentHistory.valid_from.desc(), AssignmentHistory.id.desc())
+            .offset(offset)
+            .limit(limit)
+            .all())
@@ -0,0 +1,266 @@
+"""
+Field-level audit trail for companies, vehicles, drivers and files.
+
+Each flush records what changed in audited rows: the changed fields with
+their old and new values for updates, and the non-empty fields for creates
+and deletes. The entries are written with one multi-row INSERT per flush,
+inside the same transaction as the change, so a change is never committed
+without its audit record. Each entry stores the company of its row, and a
+tenant-scoped caller only reads its companies' entries (see tenancy.py).
+
+On PostgreSQL `audit_log` is partitioned by month on changed_at, so history
+lookups only scan the months they cover and old months can be archived by
+detaching whole partitions. The `audit.ensure_partitions` job creates the
+coming months' partitions every AUDIT_PARTITION_INTERVAL seconds. Triggers
+make the table append-only.
+"""
+from flask import request, has_request_context, current_app
+from models import db, Company, Vehicle, Driver, File, AuditLog
+from jobs import job_handler, enqueue, enqueue_unless_pending
+from tenancy import company_of, add_company_column
+from sqlalchemy import event, inspect, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from datetime import date, datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+AUDITED_MODELS = {
+    Company: 'company',
+    Vehicle: 'vehicle',
+    Driver: 'driver',
+    File: 'file'
+}
+
+# Bookkeeping columns that change on every write and would only add noise
+IGNORED_FIELDS = {'updated_at', 'version'}
+
+POSTGRES_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS audit_log (
+        id bigserial,
+        changed_at timestamp NOT NULL,
+        entity_type varchar(20) NOT NULL,
+        entity_id integer NOT NULL,
+        action varchar(10) NOT NULL,
+        actor text,
+        diff json,
+        company_id integer,
+        PRIMARY KEY (id, changed_at)
+    ) PARTITION BY RANGE (changed_at)
+    """,
+    # Tables created before entries were tenant-scoped; partitions get the column too
+    "ALTER TABLE audit_log ADD COLUMN IF NOT EXISTS company_id integer",
+    # Catches rows for months that have no partition yet, so inserts never fail
+    "CREATE TABLE IF NOT EXISTS audit_log_default PARTITION OF audit_log DEFAULT",
+    "CREATE INDEX IF NOT EXISTS ix_audit_log_entity ON audit_log (entity_type, entity_id, changed_at)",
+    """
+    CREATE OR REPLACE FUNCTION audit_log_append_only() RETURNS trigger AS $$
+    BEGIN
+        RAISE EXCEPTION 'audit_log is append-only';
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS audit_log_append_only ON audit_log",
+    """
+    CREATE TRIGGER audit_log_append_only BEFORE UPDATE OR DELETE ON audit_log
+    FOR EACH ROW EXECUTE FUNCTION audit_log_append_only()
+    """
+]
+
+SQLITE_DDL = [
+    """
+    CREATE TRIGGER IF NOT EXISTS audit_log_no_update BEFORE UPDATE ON audit_log
+    BEGIN SELECT RAISE(ABORT, 'audit_log is append-only'); END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS audit_log_no_delete BEFORE DELETE ON audit_log
+    BEGIN SELECT RAISE(ABORT, 'audit_log is append-only'); END
+    """
+]
+
+
+def prepare_audit_table(months_ahead=3):
+    """Create the audit table; must run before db.create_all()"""
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.begin() as conn:
+            for statement in POSTGRES_DDL:
+                conn.execute(text(statement))
+        ensure_partitions(months_ahead)
+        return
+
+    AuditLog.__table__.create(db.engine, checkfirst=True)
+    add_company_column(AuditLog.__table__.name)
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.begin() as conn:
+            for statement in SQLITE_DDL:
+                conn.execute(text(statement))
+
+
+def _month_start(year, month):
+    year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+    return datetime(year, month, 1)
+
+
+AUDIT_COLUMNS = 'id, changed_at, entity_type, entity_id, action, actor, diff, company_id'
+
+
+def _create_partition(conn, name, start, end):
+    """Create one monthly partition, moving its rows out of the default partition"""
+    if conn.execute(text('SELECT to_regclass(:name)'), {'name': name}).scalar() is not None:
+        return False
+    bounds = f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    # Blocks audit inserts until commit, so no row can land in the default partition meanwhile
+    conn.execute(text('LOCK TABLE audit_log IN SHARE ROW EXCLUSIVE MODE'))
+    stranded = conn.execute(text(
+        'SELECT EXISTS (SELECT 1 FROM audit_log_default WHERE changed_at >= :start AND changed_at < :end)'
+    ), {'start': start, 'end': end}).scalar()
+    if not stranded:
+        conn.execute(text(f'CREATE TABLE {name} PARTITION OF audit_log {bounds}'))
+        return True
+
+    # The default partition may not hold rows of a new partition's range: detach it
+    # (which also drops its copy of the append-only trigger), move the rows, reattach
+    conn.execute(text('ALTER TABLE audit_log DETACH PARTITION audit_log_default'))
+    conn.execute(text(f'CREATE TABLE {name} PARTITION OF audit_log {bounds}'))
+    conn.execute(text(
+        f'WITH moved AS (DELETE FROM audit_log_default WHERE changed_at >= :start AND changed_at < :end '
+        f'RETURNING {AUDIT_COLUMNS}) INSERT INTO {name} ({AUDIT_COLUMNS}) SELECT {AUDIT_COLUMNS} FROM moved'
+    ), {'start': start, 'end': end})
+    conn.execute(text('ALTER TABLE audit_log ATTACH PARTITION audit_log_default DEFAULT'))
+    logger.info('Moved audit rows of %s out of the default partition', name)
+    return True
+
+
+def ensure_partitions(months_ahead=3):
+    """Create monthly partitions from this month to `months_ahead` months out"""
+    if db.engine.dialect.name != 'postgresql':
+        return []
+
+    now = datetime.utcnow()
+    created = []
+    for offset in range(months_ahead + 1):
+        start = _month_start(now.year, now.month + offset)
+        end = _month_start(start.year, start.month + 1)
+        name = f'audit_log_y{start.year}m{start.month:02d}'
+        try:
+            with db.engine.begin() as conn:
+                if _create_partition(conn, name, start, end):
+                    created.append(name)
+        except SQLAlchemyError:
+            # Rows keep going to the default partition; the next run tries again
+            logger.error('Could not create audit partition %s', name, exc_info=True)
+    return created
+
+
+@job_handler('audit.ensure_partitions')
+def ensure_partitions_job(payload):
+    """Create the coming months' partitions, then queue the next run"""
+    result = {'partitions': ensure_partitions(payload.get('months_ahead', 3))}
+    if current_app.config['AUDIT_PARTITION_INTERVAL'] > 0:
+        enqueue('audit.ensure_partitions', delay=current_app.config['AUDIT_PARTITION_INTERVAL'])
+    return result
+
+
+def ensure_partition_schedule():
+    """Start the partition chain on PostgreSQL unless it is already queued"""
+    if db.engine.dialect.name != 'postgresql' or current_app.config['AUDIT_PARTITION_INTERVAL'] <= 0:
+        return
+    enqueue_unless_pending('audit.ensure_partitions')
+
+
+def current_actor():
+    """Who is making the change; the API has no login yet, so trust X-User"""
+    if has_request_context():
+        return request.headers.get('X-User') or request.remote_addr
+    return 'system'
+
+
+def _jsonable(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def _snapshot(obj):
+    """Non-empty column values of a row"""
+    snapshot = {}
+    for attr in inspect(obj).mapper.column_attrs:
+        value = getattr(obj, attr.key)
+        if value is not None and attr.key not in IGNORED_FIELDS:
+            snapshot[attr.key] = _jsonable(value)
+    return snapshot
+
+
+def _diff(obj):
+    """Changed columns of a row as {field: [old, new]}"""
+    state = inspect(obj)
+    diff = {}
+    for attr in state.mapper.column_attrs:
+        if attr.key in IGNORED_FIELDS:
+            continue
+        history = state.attrs[attr.key].history
+        if not history.has_changes():
+            continue
+        old = history.deleted[0] if history.deleted else None
+        new = history.added[0] if history.added else None
+        if old != new:
+            diff[attr.key] = [_jsonable(old), _jsonable(new)]
+    return diff
+
+
+@event.listens_for(Session, 'before_flush')
+def _collect_audit_entries(session, flush_context, instances):
+    # History is only available before the flush, ids of new rows only after it
+    entries = session.info.setdefault('audit_entries', [])
+    now = datetime.utcnow()
+    actor = current_actor()
+
+    with session.no_autoflush:
+        for obj in session.new:
+            if type(obj) in AUDITED_MODELS:
+                entries.append((obj, None, 'create', now, actor, None))
+        for obj in session.dirty:
+            if type(obj) in AUDITED_MODELS:
+                diff = _diff(obj)
+                if diff:
+                    entries.append((obj, diff, 'update', now, actor, company_of(session, obj)))
+        for obj in session.deleted:
+            if type(obj) in AUDITED_MODELS:
+                entries.append((obj, _snapshot(obj), 'delete', now, actor, company_of(session, obj)))
+
+
+@event.listens_for(Session, 'after_flush')
+def _write_audit_entries(session, flush_context):
+    entries = session.info.pop('audit_entries', None)
+    if not entries:
+        return
+
+    rows = [{
+        'changed_at': changed_at,
+        'entity_type': AUDITED_MODELS[type(obj)],
+        'entity_id': obj.id,
+        'action': action,
+        'actor': actor,
+        # Creates are snapshotted now that defaults and ids are filled in
+        'diff': _snapshot(obj) if diff is None else diff,
+        'company_id': company_of(session, obj) if action == 'create' else company_id
+    } for obj, diff, action, changed_at, actor, company_id in entries]
+    session.connection().execute(AuditLog.__table__.insert(), rows)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_audit_entries(session):
+    session.info.pop('audit_entries', None)
+
+
+def entity_history(entity_type, entity_id, page=1, per_page=50):
+    """Audit entries of one entity, newest first; returns (items, has_more)"""
+    entries = (AuditLog.query
+               .filter_by(entity_type=entity_type, entity_id=entity_id)
+               .order_by(AuditLog.changed_at.desc(), AuditLog.id.desc())
+               .offset((page - 1) * per_page)
+               .limit(per_page + 1)
+               .all())
+    return entries[:per_page], len(entries) > per_page
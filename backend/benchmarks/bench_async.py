@@ -0,0 +1,192 @@
+"""
+Benchmark the async read API (asgi.py) against the threaded Flask app.
+
+Both servers run against the same SQLite database, with every query
+delayed by --latency-ms to stand in for a database on another host. The
+Flask app gets a fixed pool of worker threads, like gunicorn's gthread
+worker; the async app is a single uvicorn worker. A burst of concurrent
+requests is sent to each and throughput and latency percentiles are
+reported.
+
+Run from the backend directory (needs starlette, uvicorn and aiosqlite):
+    python benchmarks/bench_async.py --concurrency 100 --threads 8
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+PATHS = ['/api/vehicles/{id}', '/api/drivers/{id}', '/api/files/vehicles/{id}']
+
+
+class SlowCursor(sqlite3.Cursor):
+    latency = 0
+
+    def execute(self, *args):
+        time.sleep(self.latency)
+        return super().execute(*args)
+
+
+class SlowConnection(sqlite3.Connection):
+    def cursor(self, factory=SlowCursor):
+        return super().cursor(factory)
+
+
+def _slow_sqlite(latency):
+    # Applies to the sync (sqlite3.dbapi2) and the async (aiosqlite) driver alike,
+    # in the thread running the query
+    SlowCursor.latency = latency
+    sqlite3.connect = sqlite3.dbapi2.connect = partial(sqlite3.dbapi2.connect, factory=SlowConnection)
+
+
+def _environment(database):
+    os.environ.update({
+        'DATABASE_URI': f'sqlite:///{database}',
+        'UPLOAD_FOLDER': os.path.join(os.path.dirname(database), 'uploads'),
+        'DB_SCHEMA_MODE': 'skip',
+        'RESPONSE_CACHE_SIZE': '0',
+        'RATE_LIMIT': '0'
+    })
+
+
+def seed(database, count):
+    _environment(database)
+    os.environ['DB_SCHEMA_MODE'] = 'create'
+    from app import create_app
+    from models import db, Company, Vehicle, Driver
+    app = create_app()
+    with app.app_context():
+        company = Company(identity_card='1', name='Bench')
+        db.session.add(company)
+        db.session.flush()
+        for i in range(count):
+            driver = Driver(identity_card=f'd{i}', first_name='Dan', last_name=f'Driver {i}', company_id=company.id)
+            db.session.add(driver)
+            db.session.flush()
+            db.session.add(Vehicle(license_plate=f'{i:08d}', company_id=company.id, manufacturer='Volvo',
+                                   assigned_driver_id=driver.id))
+        db.session.commit()
+
+
+def serve_flask(database, port, latency, threads):
+    _environment(database)
+    _slow_sqlite(latency)
+    from werkzeug.serving import BaseWSGIServer
+    from app import create_app
+    # Like uvicorn at log_level='warning', no line per request
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    class PooledServer(BaseWSGIServer):
+        """Requests wait for one of a fixed number of threads, like gunicorn's gthread worker"""
+        pool = ThreadPoolExecutor(threads)
+        request_queue_size = 1024
+
+        def process_request(self, request, client_address):
+            self.pool.submit(self._process, request, client_address)
+
+        def _process(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    PooledServer('127.0.0.1', port, create_app()).serve_forever()
+
+
+def serve_asgi(database, port, latency):
+    _environment(database)
+    _slow_sqlite(latency)
+    import uvicorn
+    from asgi import create_asgi_app
+    uvicorn.run(create_asgi_app(), host='127.0.0.1', port=port, log_level='warning')
+
+
+async def fetch(port, path):
+    """Status of one GET over a fresh connection; a raw client keeps the load generator cheap"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n'.encode())
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b' ', 2)[1])
+
+
+async def load(port, requests, concurrency, count):
+    latencies = []
+    errors = 0
+    pending = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in pending:
+            started = time.perf_counter()
+            status = await fetch(port, PATHS[i % len(PATHS)].format(id=i % count + 1))
+            latencies.append(time.perf_counter() - started)
+            errors += status != 200
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return requests / elapsed, percentile(0.5), percentile(0.95), percentile(0.99), errors
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            asyncio.run(fetch(port, '/api/health'))
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Server on port {port} did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=8, help='Flask worker threads')
+    parser.add_argument('--latency-ms', type=float, default=5, help='Delay added to every query')
+    parser.add_argument('--rows', type=int, default=200)
+    args = parser.parse_args()
+
+    database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    seed(database, args.rows)
+    latency = args.latency_ms / 1000
+
+    servers = [
+        (f'flask, {args.threads} threads', serve_flask, (args.threads,), 5301),
+        ('asgi, 1 worker', serve_asgi, (), 5302),
+    ]
+    print(f'{args.requests} requests, {args.concurrency} concurrent, {args.latency_ms:g} ms per query')
+    print(f'{"server":20s} {"req/s":>8s} {"p50 ms":>8s} {"p95 ms":>8s} {"p99 ms":>8s} {"errors":>7s}')
+    for label, target, extra, port in servers:
+        process = multiprocessing.Process(target=target, args=(database, port, latency, *extra), daemon=True)
+        process.start()
+        try:
+            wait_for(port)
+            asyncio.run(load(port, args.concurrency, args.concurrency, args.rows))  # warm up
+            rate, p50, p95, p99, errors = asyncio.run(load(port, args.requests, args.concurrency, args.rows))
+            print(f'{label:20s} {rate:8.0f} {p50:8.1f} {p95:8.1f} {p99:8.1f} {errors:7d}')
+        finally:
+            process.terminate()
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
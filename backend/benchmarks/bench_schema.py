@@ -0,0 +1,120 @@
+"""
+Benchmark the compiled vehicle schema against the hand-written code it replaced.
+
+Run from the backend directory:
+    python benchmarks/bench_schema.py
+"""
+import itertools
+import os
+import sys
+import timeit
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from models import Vehicle
+
+DATE_FIELDS = [
+    'carrier_license_expiry_date', 'license_expiry_date', 'last_safety_inspection',
+    'next_safety_inspection', 'hova_insurance_expiry_date', 'mekif_insurance_expiry_date',
+    'special_equipment_expiry_date', 'hazardous_license_expiry_date', 'tachograph_expiry_date',
+    'winter_inspection_expiry_date', 'brake_inspection_expiry_date'
+]
+PLAIN_FIELDS = [
+    'license_plate', 'company_id', 'assigned_driver_id', 'manufacturer', 'model', 'weight',
+    'department', 'car_type', 'internal_number', 'chassis_number', 'odometer_reading',
+    'production_year', 'equipment', 'has_tow_hook', 'is_operational', 'notes'
+]
+
+
+def parse_date(date_str):
+    """Legacy blueprint helper"""
+    if not date_str:
+        return None
+    try:
+        return datetime.fromisoformat(date_str.replace('Z', '+00:00')).date()
+    except:
+        return None
+
+
+def legacy_to_dict(self):
+    return {
+        'id': self.id,
+        'license_plate': self.license_plate,
+        'company_id': self.company_id,
+        'company_name': self.company.name if self.company else None,
+        'assigned_driver_id': self.assigned_driver_id,
+        'driver_name': f"{self.assigned_driver.first_name} {self.assigned_driver.last_name}" if self.assigned_driver else None,
+        'manufacturer': self.manufacturer,
+        'model': self.model,
+        'weight': self.weight,
+        'department': self.department,
+        'car_type': self.car_type,
+        'carrier_license_expiry_date': self.carrier_license_expiry_date.isoformat() if self.carrier_license_expiry_date else None,
+        'internal_number': self.internal_number,
+        'chassis_number': self.chassis_number,
+        'odometer_reading': self.odometer_reading,
+        'production_year': self.production_year,
+        'license_expiry_date': self.license_expiry_date.isoformat() if self.license_expiry_date else None,
+        'last_safety_inspection': self.last_safety_inspection.isoformat() if self.last_safety_inspection else None,
+        'next_safety_inspection': self.next_safety_inspection.isoformat() if self.next_safety_inspection else None,
+        'hova_insurance_expiry_date': self.hova_insurance_expiry_date.isoformat() if self.hova_insurance_expiry_date else None,
+        'mekif_insurance_expiry_date': self.mekif_insurance_expiry_date.isoformat() if self.mekif_insurance_expiry_date else None,
+        'special_equipment_expiry_date': self.special_equipment_expiry_date.isoformat() if self.special_equipment_expiry_date else None,
+        'hazardous_license_expiry_date': self.hazardous_license_expiry_date.isoformat() if self.hazardous_license_expiry_date else None,
+        'tachograph_expiry_date': self.tachograph_expiry_date.isoformat() if self.tachograph_expiry_date else None,
+        'winter_inspection_expiry_date': self.winter_inspection_expiry_date.isoformat() if self.winter_inspection_expiry_date else None,
+        'brake_inspection_expiry_date': self.brake_inspection_expiry_date.isoformat() if self.brake_inspection_expiry_date else None,
+        'equipment': self.equipment,
+        'has_tow_hook': self.has_tow_hook,
+        'is_operational': self.is_operational,
+        'notes': self.notes,
+        'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+        'version': self.version
+    }
+
+
+def legacy_update(vehicle, data):
+    """The legacy `if 'field' in data` chain, written as the loop it unrolled to"""
+    for name in PLAIN_FIELDS:
+        if name in data:
+            setattr(vehicle, name, data[name])
+    for name in DATE_FIELDS:
+        if name in data:
+            setattr(vehicle, name, parse_date(data[name]))
+
+
+def schema_update(vehicle, data):
+    Vehicle.schema.apply(vehicle, Vehicle.schema.parse_update(data))
+
+
+def main(number=20000):
+    vehicle = Vehicle(id=1, license_plate='12-345-67', manufacturer='Volvo', model='FH', weight=18000,
+                      odometer_reading=120000, production_year=2019, is_operational=True,
+                      updated_at=datetime(2024, 1, 1), version=1,
+                      **{name: date(2025, 6, 30) for name in DATE_FIELDS})
+    assert legacy_to_dict(vehicle) == vehicle.to_dict()
+
+    # An edit form sends the whole object back with one field changed
+    payload = legacy_to_dict(vehicle)
+    payload['notes'] = 'checked'
+    # Every field changes on every call
+    payloads = itertools.cycle([
+        {**payload, 'weight': 18000 + i, 'notes': f'checked {i}', **{name: f'2026-0{i + 1}-15' for name in DATE_FIELDS}}
+        for i in range(2)
+    ])
+    results = [
+        ('to_dict legacy', lambda: legacy_to_dict(vehicle)),
+        ('to_dict schema', lambda: vehicle.to_dict()),
+        ('update legacy', lambda: legacy_update(vehicle, payload)),
+        ('update schema', lambda: schema_update(vehicle, payload)),
+        ('rewrite legacy', lambda: legacy_update(vehicle, next(payloads))),
+        ('rewrite schema', lambda: schema_update(vehicle, next(payloads))),
+    ]
+    for label, func in results:
+        seconds = min(timeit.repeat(func, number=number, repeat=5))
+        print(f'{label:16s} {seconds / number * 1e6:8.2f} us/call')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Check that the async read API (asgi.py) answers exactly like the Flask app.
+
+Every async route is requested from both, in-process and against the same
+SQLite database, with and without an Origin, a tenant header and
+compression, and the status, the body bytes and the headers clients see
+are compared. Rate-limited and tenant-required answers are compared too.
+Content-Length is left out: Flask streams downloads without it.
+
+Run from the backend directory (needs starlette, aiosqlite and httpx):
+    python benchmarks/compare_async.py
+"""
+import asyncio
+import io
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+PATHS = [
+    '/api/companies', '/api/companies/1', '/api/companies/99', '/api/companies/1/vehicles',
+    '/api/companies/2/drivers', '/api/vehicles', '/api/vehicles?format=columnar', '/api/vehicles?format=msgpack',
+    '/api/vehicles/2', '/api/vehicles/99', '/api/drivers', '/api/drivers/1', '/api/files', '/api/files/1',
+    '/api/files/99', '/api/files/1/download', '/api/files/vehicles/1', '/api/files/companies/1',
+    '/api/search/companies?q=B', '/api/search/vehicles?car_type=van&sort=-license_plate',
+    '/api/search/vehicles?sort=nope', '/api/search/drivers?q=dan', '/api/search/files?q=policy',
+    '/api/search/files'
+]
+
+REQUEST_HEADERS = [{}, {'Origin': 'http://example.com'}, {'X-Company-Ids': '1'}, {'X-Company-Ids': 'x'},
+                   {'Accept-Encoding': 'gzip'}]
+
+COMPARED_HEADERS = ['content-type', 'content-encoding', 'content-disposition', 'cache-control', 'vary',
+                    'retry-after', 'location', 'x-data-version', 'access-control-allow-origin',
+                    'access-control-expose-headers']
+
+
+def seed(client):
+    client.post('/api/companies', json={'identity_card': '1', 'name': 'A'})
+    client.post('/api/companies', json={'identity_card': '2', 'name': 'B'})
+    for i in range(30):
+        client.post('/api/vehicles', json={'license_plate': f'P{i}', 'company_id': i % 2 + 1,
+                                           'car_type': 'truck' if i % 3 else 'van', 'manufacturer': 'Volvo'})
+    client.post('/api/drivers', json={'identity_card': 'd', 'company_id': 2, 'first_name': 'Dan', 'last_name': 'Cohen'})
+    client.put('/api/vehicles/2/assign', json={'driver_id': 1})
+    client.post('/api/vehicles/1/files', data={'file': (io.BytesIO(b'policy 12345'), 'policy.txt')},
+                content_type='multipart/form-data')
+
+
+def answer(status, body, headers):
+    return status, body, {name: headers.get_list(name) if hasattr(headers, 'get_list') else headers.getlist(name)
+                          for name in COMPARED_HEADERS}
+
+
+async def compare(flask_client, asgi_client, path, headers):
+    # Raw bytes, as sent: httpx would decompress them
+    async with asgi_client.stream('GET', path, headers=headers) as response:
+        body = b''.join([chunk async for chunk in response.aiter_raw()])
+        asgi = answer(response.status_code, body, response.headers)
+    response = flask_client.get(path, headers=headers)
+    flask = answer(response.status_code, response.get_data(), response.headers)
+    if asgi == flask:
+        return True
+    print(f'{path} {headers}')
+    print(f'  flask {flask[0]} {flask[1][:80]!r} {flask[2]}')
+    print(f'  asgi  {asgi[0]} {asgi[1][:80]!r} {asgi[2]}')
+    return False
+
+
+async def run(flask_app, asgi_app):
+    import httpx
+    from admission import buckets
+    flask_client = flask_app.test_client()
+    seed(flask_client)
+    # The Flask test client sends no Accept-Encoding; httpx would send its own
+    headers = [{'Accept-Encoding': 'identity', **extra} for extra in REQUEST_HEADERS]
+    results = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi_app), base_url='http://localhost') as client:
+        for path in PATHS:
+            for extra in headers:
+                results.append(await compare(flask_client, client, path, extra))
+
+        flask_app.config.update(RATE_LIMIT=1, RATE_LIMIT_BURST=1)
+        for extra in headers[:2]:
+            buckets.clear()
+            await client.get('/api/vehicles/1', headers=extra)
+            flask_client.get('/api/vehicles/1', headers=extra)
+            results.append(await compare(flask_client, client, '/api/vehicles/1', extra))
+        flask_app.config.update(RATE_LIMIT=0, TENANT_REQUIRED=True)
+        results.append(await compare(flask_client, client, '/api/vehicles', headers[0]))
+    return results
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    os.environ.update({
+        'DATABASE_URI': f"sqlite:///{os.path.join(directory, 'compare.db')}",
+        'UPLOAD_FOLDER': os.path.join(directory, 'uploads'),
+        'RATE_LIMIT': '0'
+    })
+    from app import create_app
+    from asgi import create_asgi_app
+    flask_app = create_app()
+    results = asyncio.run(run(flask_app, create_asgi_app(flask_app)))
+    print(f'{sum(results)} of {len(results)} responses identical')
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
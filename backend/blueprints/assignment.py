@@ -0,0 +1,67 @@
+from flask import Blueprint, request, jsonify
+from assignments import assignment_periods
+from datetime import datetime, timedelta, timezone
+
+assignment_bp = Blueprint('assignment', __name__)
+
+def parse_timestamp(value):
+    """Parse an ISO date or datetime into naive UTC"""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def parse_window():
+    """Read the time window from ?at=, or ?from=&to=
+
+    A date-only `at` means the whole day; a datetime `at` is a point in time.
+    Returns (start, end) where end is None for a point, or raises ValueError.
+    """
+    at = request.args.get('at')
+    if at:
+        start = parse_timestamp(at)
+        if len(at) == 10:
+            return start, start + timedelta(days=1)
+        return start, None
+
+    start = request.args.get('from')
+    end = request.args.get('to')
+    if not start and not end:
+        return None, None
+    start = parse_timestamp(start) if start else datetime.min
+    end = parse_timestamp(end) if end else datetime.max
+    return start, end
+
+def periods_response(**filters):
+    try:
+        start, end = parse_window()
+    except ValueError:
+        return jsonify({'error': 'Invalid date, use ISO format (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS)'}), 400
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 100, type=int), 1), 1000)
+
+    periods = assignment_periods(start=start, end=end, limit=per_page + 1, offset=(page - 1) * per_page, **filters)
+    return jsonify({
+        'items': [period.to_dict() for period in periods[:per_page]],
+        'page': page,
+        'per_page': per_page,
+        'has_more': len(periods) > per_page
+    }), 200
+
+@assignment_bp.route('/vehicles/<int:vehicle_id>', methods=['GET'])
+def vehicle_history(vehicle_id):
+    """Drivers of a vehicle, at a time, within a window or over its whole history"""
+    return periods_response(vehicle_id=vehicle_id)
+
+@assignment_bp.route('/drivers/<int:driver_id>', methods=['GET'])
+def driver_history(driver_id):
+    """Vehicles driven by a driver, at a time, within a window or over their whole history"""
+    return periods_response(driver_id=driver_id)
+
+@assignment_bp.route('/occupancy', methods=['GET'])
+def occupancy():
+    """All driver/vehicle assignments active at a time or within a window"""
+    if not request.args.get('at') and not request.args.get('from') and not request.args.get('to'):
+        return jsonify({'error': 'at, or from/to, is required'}), 400
+    return periods_response()
@@ -0,0 +1,32 @@
+from flask import Blueprint, request, jsonify
+from audit import entity_history
+from compression import compression
+
+audit_bp = Blueprint('audit', __name__)
+
+# URL segment -> entity type stored in the audit log
+ENTITY_TYPES = {
+    'companies': 'company',
+    'vehicles': 'vehicle',
+    'drivers': 'driver',
+    'files': 'file'
+}
+
+@audit_bp.route('/<entity>/<int:entity_id>', methods=['GET'])
+@compression('fast')
+def get_history(entity, entity_id):
+    """Get the change history of a company, vehicle, driver or file"""
+    if entity not in ENTITY_TYPES:
+        return jsonify({'error': 'Unknown entity type'}), 404
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 500)
+
+    entries, has_more = entity_history(ENTITY_TYPES[entity], entity_id, page=page, per_page=per_page)
+
+    return jsonify({
+        'items': [entry.to_dict() for entry in entries],
+        'page': page,
+        'per_page': per_page,
+        'has_more': has_more
+    }), 200
@@ -0,0 +1,55 @@
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
+from changes import events_since, latest_version, stream_changes
+from compression import compression
+from tenancy import current_tenant, tenant_from_query
+
+change_bp = Blueprint('change', __name__)
+
+ENTITY_TYPES = {'company', 'vehicle', 'driver', 'file'}
+
+def parse_types():
+    """Parse the comma separated `types` argument"""
+    types = request.args.get('types')
+    if not types:
+        return None
+    return [t for t in types.split(',') if t in ENTITY_TYPES]
+
+@change_bp.route('', methods=['GET'])
+@compression('fast')
+def list_changes():
+    """Get change events newer than `since` to patch cached lists"""
+    since = request.args.get('since', 0, type=int)
+    limit = min(request.args.get('limit', 500, type=int), 5000)
+
+    events = events_since(since, parse_types(), limit=limit + 1, companies=current_tenant())
+    has_more = len(events) > limit
+    events = events[:limit]
+
+    return jsonify({
+        'version': events[-1].version if events else max(since, latest_version()),
+        'has_more': has_more,
+        'events': [event.to_dict() for event in events]
+    }), 200
+
+@change_bp.route('/stream', methods=['GET'])
+@tenant_from_query
+def stream():
+    """Server-sent events stream of changes"""
+    # EventSource sends Last-Event-ID when it reconnects
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    if since is None:
+        since = latest_version()
+
+    generator = stream_changes(
+        since,
+        parse_types(),
+        poll_interval=current_app.config['CHANGE_STREAM_POLL_INTERVAL'],
+        max_duration=current_app.config['CHANGE_STREAM_MAX_DURATION'],
+        companies=current_tenant()
+    )
+    response = Response(stream_with_context(generator), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
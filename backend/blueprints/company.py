@@ -1,61 +1,38 @@
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify
 from models import db, Company, Vehicle, Driver, File
 from werkzeug.utils import secure_filename
-from datetime import datetime
-import os
-import uuid
+from jobs import async_capable
+from changes import record_change
+from columnar import list_response
+from compression import cached
+from admission import admission, table_cost
+from schema import SchemaError
+from storage import save_upload
 
 company_bp = Blueprint('company', __name__)
 
-def parse_date(date_str):
-    """Helper to parse date string"""
-    if not date_str:
-        return None
-    try:
-        return datetime.fromisoformat(date_str.replace('Z', '+00:00')).date()
-    except:
-        return None
-
 @company_bp.route('', methods=['GET'])
+@admission(table_cost(Company))
+@cached
 def list_companies():
     """List all companies"""
     companies = Company.query.all()
-    return jsonify([company.to_dict() for company in companies]), 200
+    return list_response(Company, companies)
 
 @company_bp.route('', methods=['POST'])
+@async_capable
 def create_company():
     """Create a new company"""
-    data = request.get_json()
-    
-    # Validate required fields
-    if not data.get('identity_card'):
-        return jsonify({'error': 'identity_card is required'}), 400
-    
-    # Check if identity_card already exists
-    if Company.query.filter_by(identity_card=data['identity_card']).first():
-        return jsonify({'error': 'Identity card already exists'}), 400
+    try:
+        values = Company.schema.parse_create(request.get_json())
+        Company.schema.check(values)
+    except SchemaError as e:
+        return jsonify({'error': e.message}), e.status_code
     
-    company = Company(
-        identity_card=data['identity_card'],
-        name=data.get('name'),
-        address=data.get('address'),
-        po_box=data.get('po_box'),
-        phone=data.get('phone'),
-        fax=data.get('fax'),
-        contact_person=data.get('contact_person'),
-        contact_phone=data.get('contact_phone'),
-        manager_name=data.get('manager_name'),
-        manager_phone=data.get('manager_phone'),
-        manager_id=data.get('manager_id'),
-        email=data.get('email'),
-        safety_officer=data.get('safety_officer'),
-        carrier_license_expiry=parse_date(data.get('carrier_license_expiry')),
-        established_date=parse_date(data.get('established_date')),
-        inspection_week=data.get('inspection_week'),
-        notes=data.get('notes')
-    )
+    company = Company(**values)
     
     db.session.add(company)
+    record_change('company', company, 'create')
     db.session.commit()
     
     return jsonify(company.to_dict()), 201
@@ -67,58 +44,46 @@ def get_company(company_id):
     return jsonify(company.to_dict()), 200
 
 @company_bp.route('/<int:company_id>', methods=['PUT'])
+@async_capable
 def update_company(company_id):
     """Update company"""
     company = Company.query.get_or_404(company_id)
-    data = request.get_json()
     
-    if 'identity_card' in data:
-        # Check if new identity_card already exists
-        existing = Company.query.filter_by(identity_card=data['identity_card']).first()
-        if existing and existing.id != company_id:
-            return jsonify({'error': 'Identity card already exists'}), 400
-        company.identity_card = data['identity_card']
-    if 'name' in data:
-        company.name = data['name']
-    if 'address' in data:
-        company.address = data['address']
-    if 'po_box' in data:
-        company.po_box = data['po_box']
-    if 'phone' in data:
-        company.phone = data['phone']
-    if 'fax' in data:
-        company.fax = data['fax']
-    if 'contact_person' in data:
-        company.contact_person = data['contact_person']
-    if 'contact_phone' in data:
-        company.contact_phone = data['contact_phone']
-    if 'manager_name' in data:
-        company.manager_name = data['manager_name']
-    if 'manager_phone' in data:
-        company.manager_phone = data['manager_phone']
-    if 'manager_id' in data:
-        company.manager_id = data['manager_id']
-    if 'email' in data:
-        company.email = data['email']
-    if 'safety_officer' in data:
-        company.safety_officer = data['safety_officer']
-    if 'carrier_license_expiry' in data:
-        company.carrier_license_expiry = parse_date(data['carrier_license_expiry'])
-    if 'established_date' in data:
-        company.established_date = parse_date(data['established_date'])
-    if 'inspection_week' in data:
-        company.inspection_week = data['inspection_week']
-    if 'notes' in data:
-        company.notes = data['notes']
+    try:
+        values = Company.schema.parse_update(request.get_json())
+        Company.schema.check(values, instance_id=company_id)
+    except SchemaError as e:
+        return jsonify({'error': e.message}), e.status_code
     
+    if 'name' in values and values['name'] != company.name:
+        # company_name is embedded in every vehicle and driver row
+        for vehicle in company.vehicles:
+            record_change('vehicle', vehicle, 'update')
+        for driver in company.drivers:
+            record_change('driver', driver, 'update')
+    
+    Company.schema.apply(company, values)
+    
+    record_change('company', company, 'update')
     db.session.commit()
     
     return jsonify(company.to_dict()), 200
 
 @company_bp.route('/<int:company_id>', methods=['DELETE'])
+@async_capable
 def delete_company(company_id):
     """Delete company"""
     company = Company.query.get_or_404(company_id)
+    
+    # Vehicles and drivers are removed by the cascade, so announce them too
+    for vehicle in company.vehicles:
+        record_change('vehicle', vehicle, 'delete')
+    for driver in company.drivers:
+        record_change('driver', driver, 'delete')
+    for file in company.files:
+        record_change('file', file, 'delete')
+    record_change('company', company, 'delete')
+    
     db.session.delete(company)
     db.session.commit()
     
@@ -139,6 +104,7 @@ def get_company_drivers(company_id):
     return jsonify([driver.to_dict() for driver in drivers]), 200
 
 @company_bp.route('/<int:company_id>/files', methods=['POST'])
+@async_capable
 def upload_company_file(company_id):
     """Upload file for a company"""
     company = Company.query.get_or_404(company_id)
@@ -151,19 +117,10 @@ def upload_company_file(company_id):
         return jsonify({'error': 'No file selected'}), 400
     
     if file and '.' in file.filename:
-        # Generate unique filename
-        ext = file.filename.rsplit('.', 1)[1].lower()
-        filename = f"{uuid.uuid4()}.{ext}"
         original_filename = secure_filename(file.filename)
         
-        # Save file
-        upload_folder = current_app.config['UPLOAD_FOLDER']
-        os.makedirs(os.path.join(upload_folder, 'companies'), exist_ok=True)
-        file_path = os.path.join(upload_folder, 'companies', filename)
-        file.save(file_path)
-        
-        # Create file URL (relative or absolute)
-        file_url = f"/uploads/companies/{filename}"
+        # Stream the file to storage under a unique name
+        file_url, ext = save_upload(file, 'companies')
         
         # Create file record
         file_record = File(
@@ -175,6 +132,7 @@ def upload_company_file(company_id):
         )
         
         db.session.add(file_record)
+        record_change('file', file_record, 'create')
         db.session.commit()
         
         return jsonify(file_record.to_dict()), 201
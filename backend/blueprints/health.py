@@ -0,0 +1,26 @@
+from flask import Blueprint, current_app, jsonify
+from models import db
+from replicas import primary_only
+from admission import exempt, admission_stats
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+health_bp = Blueprint('health', __name__)
+
+@health_bp.route('', methods=['GET'])
+@primary_only
+@exempt
+def health():
+    """Readiness check: the database answers; includes how long startup took"""
+    startup = current_app.extensions.get('startup', {})
+    try:
+        db.session.execute(text('SELECT 1'))
+    except SQLAlchemyError as e:
+        return jsonify({'status': 'unavailable', 'error': str(e.__cause__ or e), 'startup': startup}), 503
+    return jsonify({'status': 'ok', 'startup': startup}), 200
+
+@health_bp.route('/admission', methods=['GET'])
+@exempt
+def admission_counters():
+    """Rate limiting and admission counters of this process"""
+    return jsonify(admission_stats()), 200
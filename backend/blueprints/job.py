@@ -0,0 +1,66 @@
+from flask import Blueprint, request, jsonify
+from models import db, Job
+from datetime import datetime
+from replicas import primary_only
+
+job_bp = Blueprint('job', __name__)
+
+@job_bp.route('', methods=['GET'])
+@primary_only
+def list_jobs():
+    """List recent jobs, optionally filtered by status or name"""
+    status = request.args.get('status')
+    name = request.args.get('name')
+    limit = min(request.args.get('limit', 50, type=int), 500)
+
+    jobs_query = Job.query
+    if status:
+        jobs_query = jobs_query.filter_by(status=status)
+    if name:
+        jobs_query = jobs_query.filter_by(name=name)
+
+    jobs = jobs_query.order_by(Job.id.desc()).limit(limit).all()
+    return jsonify([job.to_dict() for job in jobs]), 200
+
+@job_bp.route('/<int:job_id>', methods=['GET'])
+@primary_only
+def get_job(job_id):
+    """Get job status, progress and result"""
+    job = Job.query.get_or_404(job_id)
+    return jsonify(job.to_dict()), 200
+
+@job_bp.route('/<int:job_id>/retry', methods=['POST'])
+def retry_job(job_id):
+    """Put a failed job back on the queue"""
+    job = Job.query.get_or_404(job_id)
+
+    if job.status != 'failed':
+        return jsonify({'error': 'Only failed jobs can be retried'}), 400
+
+    job.status = 'queued'
+    job.attempts = 0
+    job.progress = 0
+    job.error = None
+    job.run_after = datetime.utcnow()
+    job.locked_by = None
+    job.locked_at = None
+    job.finished_at = None
+    db.session.commit()
+
+    return jsonify(job.to_dict()), 200
+
+@job_bp.route('/<int:job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a job that has not started yet"""
+    # Conditional update so a worker claiming the job at the same time wins cleanly
+    cancelled = Job.query.filter_by(id=job_id, status='queued').update(
+        {Job.status: 'cancelled', Job.finished_at: datetime.utcnow()},
+        synchronize_session=False
+    )
+    db.session.commit()
+
+    if not cancelled:
+        job = Job.query.get_or_404(job_id)
+        return jsonify({'error': f'Job is already {job.status}'}), 400
+
+    return jsonify({'message': 'Job cancelled successfully'}), 200
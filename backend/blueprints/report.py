@@ -0,0 +1,76 @@
+from flask import Blueprint, request, jsonify, Response, stream_with_context
+from models import db, ReportState
+from reports import REPORTS, refresh_report, is_stale, report_page, report_groups, export_csv
+from tenancy import current_tenant
+from jobs import async_capable
+from replicas import primary_only
+
+report_bp = Blueprint('report', __name__)
+
+@report_bp.route('', methods=['GET'])
+@primary_only
+def list_reports():
+    """List the available reports and when they were last refreshed"""
+    states = {state.name: state for state in ReportState.query.all()}
+    # Stored row counts cover every company
+    scoped = current_tenant() is not None
+    return jsonify([{
+        **report.to_dict(),
+        'refreshed_at': states[name].refreshed_at.isoformat() if name in states else None,
+        'row_count': states[name].row_count if name in states and not scoped else None,
+        'stale': is_stale(states.get(name))
+    } for name, report in REPORTS.items()]), 200
+
+@report_bp.route('/<name>', methods=['GET'])
+@primary_only
+def get_report(name):
+    """Get a page of a report, or all of it as CSV with ?format=csv"""
+    report = REPORTS.get(name)
+    if report is None:
+        return jsonify({'error': 'Report not found'}), 404
+
+    state = db.session.get(ReportState, name)
+    if state is None:
+        # Never computed yet; the first reader pays for it once
+        state = refresh_report(report)
+
+    group = request.args.get('group')
+
+    if request.args.get('format') == 'csv':
+        response = Response(stream_with_context(export_csv(report, group)), mimetype='text/csv')
+        response.headers['Content-Disposition'] = f'attachment; filename="{name}.csv"'
+        return response
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 100, type=int), 1), 1000)
+    items, has_more = report_page(report, page=page, per_page=per_page, group=group)
+
+    result = state.to_dict()
+    if current_tenant() is not None:
+        # Stored counts cover every company
+        groups = report_groups(report)
+        result.update(groups=groups, row_count=sum(group['count'] for group in groups))
+    
+    return jsonify({
+        **report.to_dict(),
+        **result,
+        'stale': is_stale(state),
+        'items': items,
+        'page': page,
+        'per_page': per_page,
+        'has_more': has_more
+    }), 200
+
+@report_bp.route('/<name>/refresh', methods=['POST'])
+@async_capable
+def refresh(name):
+    """Recompute a report now"""
+    report = REPORTS.get(name)
+    if report is None:
+        return jsonify({'error': 'Report not found'}), 404
+
+    if current_tenant() is not None:
+        return jsonify({'error': 'Reports cover all companies and can only be refreshed unscoped'}), 403
+    
+    state = refresh_report(report)
+    return jsonify(state.to_dict()), 200
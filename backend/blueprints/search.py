@@ -1,10 +1,18 @@
 from flask import Blueprint, request, jsonify
 from models import Company, Vehicle, Driver
 from sqlalchemy import or_
+from columnar import list_response
+from compression import cached
+from admission import admission, table_cost
+from faceting import VEHICLE_SEARCH, DRIVER_SEARCH, apply_filters, apply_sort, facet_counts
+from documents import search_documents
+from schema import SchemaError
 
 search_bp = Blueprint('search', __name__)
 
 @search_bp.route('/companies', methods=['GET'])
+@admission(table_cost(Company, unless='q'))
+@cached
 def search_companies():
     """Search companies by name or identity_card"""
     query = request.args.get('q', '').strip()
@@ -20,14 +28,14 @@ def search_companies():
             )
         ).all()
     
-    return jsonify([company.to_dict() for company in companies]), 200
+    return list_response(Company, companies)
 
 @search_bp.route('/vehicles', methods=['GET'])
+@admission(table_cost(Vehicle, unless='q'))
+@cached
 def search_vehicles():
-    """Search vehicles by license plate and filter"""
+    """Search vehicles by license plate, filter, sort and count facets"""
     query = request.args.get('q', '').strip()
-    company_id = request.args.get('company_id', type=int)
-    car_type = request.args.get('car_type')
     
     vehicles_query = Vehicle.query
     
@@ -37,22 +45,21 @@ def search_vehicles():
             Vehicle.license_plate.ilike(f'%{query}%')
         )
     
-    # Filter by company
-    if company_id:
-        vehicles_query = vehicles_query.filter_by(company_id=company_id)
+    try:
+        vehicles_query = apply_filters(VEHICLE_SEARCH, vehicles_query, request.args)
+        facets = facet_counts(VEHICLE_SEARCH, vehicles_query)
+        vehicles = apply_sort(VEHICLE_SEARCH, vehicles_query, request.args.get('sort')).all()
+    except SchemaError as e:
+        return jsonify({'error': e.message}), e.status_code
     
-    # Filter by car_type (renamed from vehicle_type)
-    if car_type:
-        vehicles_query = vehicles_query.filter_by(car_type=car_type)
-    
-    vehicles = vehicles_query.all()
-    return jsonify([vehicle.to_dict() for vehicle in vehicles]), 200
+    return list_response(Vehicle, vehicles, {'facets': facets})
 
 @search_bp.route('/drivers', methods=['GET'])
+@admission(table_cost(Driver, unless='q'))
+@cached
 def search_drivers():
-    """Search drivers by name or identity_card and filter"""
+    """Search drivers by name or identity_card, filter, sort and count facets"""
     query = request.args.get('q', '').strip()
-    company_id = request.args.get('company_id', type=int)
     
     drivers_query = Driver.query
     
@@ -66,9 +73,34 @@ def search_drivers():
             )
         )
     
-    # Filter by company
-    if company_id:
-        drivers_query = drivers_query.filter_by(company_id=company_id)
+    try:
+        drivers_query = apply_filters(DRIVER_SEARCH, drivers_query, request.args)
+        facets = facet_counts(DRIVER_SEARCH, drivers_query)
+        drivers = apply_sort(DRIVER_SEARCH, drivers_query, request.args.get('sort')).all()
+    except SchemaError as e:
+        return jsonify({'error': e.message}), e.status_code
+    
+    return list_response(Driver, drivers, {'facets': facets})
+
+@search_bp.route('/files', methods=['GET'])
+@admission(5)  # ranks and highlights every match
+def search_files():
+    """Search the text of uploaded documents, optionally within a company, vehicle or driver"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'q is required'}), 400
+    
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    hits = search_documents(
+        query,
+        limit=limit,
+        company_id=request.args.get('company_id', type=int),
+        vehicle_id=request.args.get('vehicle_id', type=int),
+        driver_id=request.args.get('driver_id', type=int)
+    )
     
-    drivers = drivers_query.all()
-    return jsonify([driver.to_dict() for driver in drivers]), 200
+    # Not cached: extracted text changes without bumping the sync version
+    return jsonify([
+        {'file': file.to_dict(), 'rank': rank, 'snippet': snippet}
+        for file, rank, snippet in hits
+    ]), 200
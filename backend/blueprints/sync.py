@@ -0,0 +1,29 @@
+from flask import Blueprint, request, jsonify
+from models import db, SyncState
+from versioning import SYNC_MODELS, changes_since
+from compression import compression
+
+sync_bp = Blueprint('sync', __name__)
+
+@sync_bp.route('', methods=['GET'])
+@compression('fast')
+def sync():
+    """Return rows changed and deleted since a sync token"""
+    since = request.args.get('since', 0, type=int)
+    limit = min(request.args.get('limit', 1000, type=int), 10000)
+    types = request.args.get('types')
+    entity_types = [t for t in types.split(',') if t in SYNC_MODELS] if types else None
+
+    # Deletions older than the pruned tombstones can no longer be reported
+    state = db.session.get(SyncState, 1)
+    if since and state and since < state.purged_version:
+        return jsonify({'error': 'Sync token expired, full resync required', 'resync': True}), 410
+
+    changes, deleted, token, has_more = changes_since(since, entity_types, limit=limit)
+
+    return jsonify({
+        'token': token,
+        'has_more': has_more,
+        'changes': changes,
+        'deleted': deleted
+    }), 200
@@ -1,78 +1,55 @@
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify
 from models import db, Vehicle, Company, Driver, File
 from werkzeug.utils import secure_filename
-from datetime import datetime
-import os
-import uuid
+from jobs import async_capable
+from changes import record_change
+from columnar import list_response
+from compression import cached
+from admission import admission, table_cost
+from assignments import AssignmentError, bulk_assign, set_vehicle_driver, run_with_retry
+from sqlalchemy.exc import IntegrityError
+from schema import SchemaError
+from storage import save_upload
 
 vehicle_bp = Blueprint('vehicle', __name__)
 
-def parse_date(date_str):
-    """Helper to parse date string"""
-    if not date_str:
-        return None
-    try:
-        return datetime.fromisoformat(date_str.replace('Z', '+00:00')).date()
-    except:
-        return None
-
 @vehicle_bp.route('', methods=['GET'])
+@admission(table_cost(Vehicle))
+@cached
 def list_vehicles():
     """List all vehicles"""
     vehicles = Vehicle.query.all()
-    return jsonify([vehicle.to_dict() for vehicle in vehicles]), 200
+    return list_response(Vehicle, vehicles)
 
 @vehicle_bp.route('', methods=['POST'])
+@async_capable
 def create_vehicle():
     """Create a new vehicle"""
-    data = request.get_json()
+    try:
+        values = Vehicle.schema.parse_create(request.get_json())
+        Vehicle.schema.check(values)
+    except SchemaError as e:
+        return jsonify({'error': e.message}), e.status_code
     
-    # Validate required fields
-    if not data.get('license_plate'):
-        return jsonify({'error': 'license_plate is required'}), 400
-    
-    # Check if license_plate already exists
-    if Vehicle.query.filter_by(license_plate=data['license_plate']).first():
-        return jsonify({'error': 'License plate already exists'}), 400
-    
-    # Validate company exists if provided
-    if data.get('company_id'):
-        company = Company.query.get(data['company_id'])
-        if not company:
-            return jsonify({'error': 'Company not found'}), 404
-    
-    vehicle = Vehicle(
-        license_plate=data['license_plate'],
-        company_id=data.get('company_id'),
-        assigned_driver_id=data.get('assigned_driver_id'),
-        manufacturer=data.get('manufacturer'),
-        model=data.get('model'),
-        weight=data.get('weight'),
-        department=data.get('department'),
-        car_type=data.get('car_type'),
-        carrier_license_expiry_date=parse_date(data.get('carrier_license_expiry_date')),
-        internal_number=data.get('internal_number'),
-        chassis_number=data.get('chassis_number'),
-        odometer_reading=data.get('odometer_reading'),
-        production_year=data.get('production_year'),
-        license_expiry_date=parse_date(data.get('license_expiry_date')),
-        last_safety_inspection=parse_date(data.get('last_safety_inspection')),
-        next_safety_inspection=parse_date(data.get('next_safety_inspection')),
-        hova_insurance_expiry_date=parse_date(data.get('hova_insurance_expiry_date')),
-        mekif_insurance_expiry_date=parse_date(data.get('mekif_insurance_expiry_date')),
-        special_equipment_expiry_date=parse_date(data.get('special_equipment_expiry_date')),
-        hazardous_license_expiry_date=parse_date(data.get('hazardous_license_expiry_date')),
-        tachograph_expiry_date=parse_date(data.get('tachograph_expiry_date')),
-        winter_inspection_expiry_date=parse_date(data.get('winter_inspection_expiry_date')),
-        brake_inspection_expiry_date=parse_date(data.get('brake_inspection_expiry_date')),
-        equipment=data.get('equipment'),
-        has_tow_hook=data.get('has_tow_hook'),
-        is_operational=data.get('is_operational', True),
-        notes=data.get('notes')
-    )
+    # Assigned through the service so the driver is validated and moved off any other vehicle
+    driver_id = values.pop('assigned_driver_id')
+    vehicle = Vehicle(**values)
     
     db.session.add(vehicle)
-    db.session.commit()
+    record_change('vehicle', vehicle, 'create')
+    record_change('company', vehicle.company_id and Company.query.get(vehicle.company_id), 'update')
+    
+    try:
+        if driver_id:
+            db.session.flush()
+            set_vehicle_driver(vehicle.id, driver_id)
+        db.session.commit()
+    except AssignmentError as e:
+        db.session.rollback()
+        return jsonify({'error': e.message}), e.status_code
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Driver is already assigned to another vehicle'}), 409
     
     return jsonify(vehicle.to_dict()), 201
 
@@ -83,119 +60,93 @@ def get_vehicle(vehicle_id):
     return jsonify(vehicle.to_dict()), 200
 
 @vehicle_bp.route('/<int:vehicle_id>', methods=['PUT'])
+@async_capable
 def update_vehicle(vehicle_id):
     """Update vehicle"""
     vehicle = Vehicle.query.get_or_404(vehicle_id)
-    data = request.get_json()
     
-    if 'license_plate' in data:
-        # Check if new license_plate already exists
-        existing = Vehicle.query.filter_by(license_plate=data['license_plate']).first()
-        if existing and existing.id != vehicle_id:
-            return jsonify({'error': 'License plate already exists'}), 400
-        vehicle.license_plate = data['license_plate']
-    if 'company_id' in data:
-        if data['company_id']:
-            company = Company.query.get(data['company_id'])
-            if not company:
-                return jsonify({'error': 'Company not found'}), 404
-        vehicle.company_id = data['company_id']
-    if 'assigned_driver_id' in data:
-        if data['assigned_driver_id']:
-            driver = Driver.query.get(data['assigned_driver_id'])
-            if not driver:
-                return jsonify({'error': 'Driver not found'}), 404
-        vehicle.assigned_driver_id = data['assigned_driver_id']
-    if 'manufacturer' in data:
-        vehicle.manufacturer = data['manufacturer']
-    if 'model' in data:
-        vehicle.model = data['model']
-    if 'weight' in data:
-        vehicle.weight = data['weight']
-    if 'department' in data:
-        vehicle.department = data['department']
-    if 'car_type' in data:
-        vehicle.car_type = data['car_type']
-    if 'carrier_license_expiry_date' in data:
-        vehicle.carrier_license_expiry_date = parse_date(data['carrier_license_expiry_date'])
-    if 'internal_number' in data:
-        vehicle.internal_number = data['internal_number']
-    if 'chassis_number' in data:
-        vehicle.chassis_number = data['chassis_number']
-    if 'odometer_reading' in data:
-        vehicle.odometer_reading = data['odometer_reading']
-    if 'production_year' in data:
-        vehicle.production_year = data['production_year']
-    if 'license_expiry_date' in data:
-        vehicle.license_expiry_date = parse_date(data['license_expiry_date'])
-    if 'last_safety_inspection' in data:
-        vehicle.last_safety_inspection = parse_date(data['last_safety_inspection'])
-    if 'next_safety_inspection' in data:
-        vehicle.next_safety_inspection = parse_date(data['next_safety_inspection'])
-    if 'hova_insurance_expiry_date' in data:
-        vehicle.hova_insurance_expiry_date = parse_date(data['hova_insurance_expiry_date'])
-    if 'mekif_insurance_expiry_date' in data:
-        vehicle.mekif_insurance_expiry_date = parse_date(data['mekif_insurance_expiry_date'])
-    if 'special_equipment_expiry_date' in data:
-        vehicle.special_equipment_expiry_date = parse_date(data['special_equipment_expiry_date'])
-    if 'hazardous_license_expiry_date' in data:
-        vehicle.hazardous_license_expiry_date = parse_date(data['hazardous_license_expiry_date'])
-    if 'tachograph_expiry_date' in data:
-        vehicle.tachograph_expiry_date = parse_date(data['tachograph_expiry_date'])
-    if 'winter_inspection_expiry_date' in data:
-        vehicle.winter_inspection_expiry_date = parse_date(data['winter_inspection_expiry_date'])
-    if 'brake_inspection_expiry_date' in data:
-        vehicle.brake_inspection_expiry_date = parse_date(data['brake_inspection_expiry_date'])
-    if 'equipment' in data:
-        vehicle.equipment = data['equipment']
-    if 'has_tow_hook' in data:
-        vehicle.has_tow_hook = data['has_tow_hook']
-    if 'is_operational' in data:
-        vehicle.is_operational = data['is_operational']
-    if 'notes' in data:
-        vehicle.notes = data['notes']
-    
-    db.session.commit()
+    try:
+        values = Vehicle.schema.parse_update(request.get_json())
+        Vehicle.schema.check(values, instance_id=vehicle_id)
+    except SchemaError as e:
+        return jsonify({'error': e.message}), e.status_code
+    
+    if 'license_plate' in values:
+        # vehicle_plate is embedded in the driver row
+        record_change('driver', vehicle.assigned_driver, 'update')
+    if 'company_id' in values and values['company_id'] != vehicle.company_id:
+        # vehicles_count changes on both companies
+        record_change('company', vehicle.company, 'update')
+        record_change('company', values['company_id'] and Company.query.get(values['company_id']), 'update')
+    
+    driver_id = values.pop('assigned_driver_id', vehicle.assigned_driver_id)
+    if driver_id != vehicle.assigned_driver_id:
+        try:
+            set_vehicle_driver(vehicle_id, driver_id)
+        except AssignmentError as e:
+            db.session.rollback()
+            return jsonify({'error': e.message}), e.status_code
+    
+    Vehicle.schema.apply(vehicle, values)
+    
+    record_change('vehicle', vehicle, 'update')
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Driver is already assigned to another vehicle'}), 409
     
     return jsonify(vehicle.to_dict()), 200
 
 @vehicle_bp.route('/<int:vehicle_id>', methods=['DELETE'])
+@async_capable
 def delete_vehicle(vehicle_id):
     """Delete vehicle"""
     vehicle = Vehicle.query.get_or_404(vehicle_id)
+    record_change('vehicle', vehicle, 'delete')
+    for file in vehicle.files:
+        record_change('file', file, 'delete')
+    record_change('company', vehicle.company, 'update')
+    record_change('driver', vehicle.assigned_driver, 'update')
     db.session.delete(vehicle)
     db.session.commit()
     
     return jsonify({'message': 'Vehicle deleted successfully'}), 200
 
 @vehicle_bp.route('/<int:vehicle_id>/assign', methods=['PUT'])
+@async_capable
 def assign_driver(vehicle_id):
     """Assign driver to vehicle"""
-    vehicle = Vehicle.query.get_or_404(vehicle_id)
     data = request.get_json()
-    
     driver_id = data.get('driver_id') or data.get('assigned_driver_id')
     
-    if driver_id:
-        # Validate driver exists
-        driver = Driver.query.get(driver_id)
-        if not driver:
-            return jsonify({'error': 'Driver not found'}), 404
-        
-        # Unassign driver from previous vehicle if any
-        previous_vehicle = Vehicle.query.filter_by(assigned_driver_id=driver_id).first()
-        if previous_vehicle and previous_vehicle.id != vehicle_id:
-            previous_vehicle.assigned_driver_id = None
-        
-        vehicle.assigned_driver_id = driver_id
-    else:
-        # Unassign driver
-        vehicle.assigned_driver_id = None
-    
-    db.session.commit()
+    try:
+        vehicle = run_with_retry(lambda: set_vehicle_driver(vehicle_id, driver_id))
+    except AssignmentError as e:
+        return jsonify({'error': e.message}), e.status_code
     
     return jsonify(vehicle.to_dict()), 200
 
+@vehicle_bp.route('/assignments', methods=['PUT'])
+@async_capable
+def bulk_assign_drivers():
+    """Assign many drivers to vehicles in one transaction (all or nothing)"""
+    data = request.get_json()
+    assignments = data.get('assignments')
+    
+    if not isinstance(assignments, list) or not assignments:
+        return jsonify({'error': 'assignments must be a non-empty list'}), 400
+    if any(not isinstance(a, dict) or not a.get('vehicle_id') for a in assignments):
+        return jsonify({'error': 'Each assignment needs a vehicle_id'}), 400
+    
+    pairs = [(a['vehicle_id'], a.get('driver_id')) for a in assignments]
+    try:
+        vehicles = run_with_retry(lambda: bulk_assign(pairs))
+    except AssignmentError as e:
+        return jsonify({'error': e.message}), e.status_code
+    
+    return jsonify([vehicle.to_dict() for vehicle in vehicles]), 200
+
 @vehicle_bp.route('/<int:vehicle_id>/driver', methods=['GET'])
 def get_vehicle_driver(vehicle_id):
     """Get assigned driver of vehicle"""
@@ -209,6 +160,7 @@ def get_vehicle_driver(vehicle_id):
     return jsonify({'message': 'No driver assigned'}), 404
 
 @vehicle_bp.route('/<int:vehicle_id>/files', methods=['POST'])
+@async_capable
 def upload_vehicle_file(vehicle_id):
     """Upload file for a vehicle"""
     vehicle = Vehicle.query.get_or_404(vehicle_id)
@@ -221,19 +173,10 @@ def upload_vehicle_file(vehicle_id):
         return jsonify({'error': 'No file selected'}), 400
     
     if file and '.' in file.filename:
-        # Generate unique filename
-        ext = file.filename.rsplit('.', 1)[1].lower()
-        filename = f"{uuid.uuid4()}.{ext}"
         original_filename = secure_filename(file.filename)
         
-        # Save file
-        upload_folder = current_app.config['UPLOAD_FOLDER']
-        os.makedirs(os.path.join(upload_folder, 'vehicles'), exist_ok=True)
-        file_path = os.path.join(upload_folder, 'vehicles', filename)
-        file.save(file_path)
-        
-        # Create file URL (relative or absolute)
-        file_url = f"/uploads/vehicles/{filename}"
+        # Stream the file to storage under a unique name
+        file_url, ext = save_upload(file, 'vehicles')
         
         # Create file record
         file_record = File(
@@ -245,6 +188,7 @@ def upload_vehicle_file(vehicle_id):
         )
         
         db.session.add(file_record)
+        record_change('file', file_record, 'create')
         db.session.commit()
         
         return jsonify(file_record.to_dict()), 201
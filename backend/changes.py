@@ -0,0 +1,212 @@
+"""
+Change feed for companies, vehicles, drivers and files.
+
+Blueprints call `record_change` next to their mutations. The events are
+written in the same transaction as the change itself, so the feed never
+shows a change that was rolled back. Each event takes its version from the
+sync_state counter (see versioning.py), which stays locked until the
+transaction commits, so versions become visible in commit order and a
+reader never moves past a version that commits later. Clients pass the
+last version they saw back as `since`; lists answer with the version they
+were read at in `X-Data-Version`, so a client can load a list and then
+follow the feed from that version without missing a change.
+
+Each event records the company of its row, and a tenant-scoped caller only
+gets events of its companies; a row moved to another company shows up in
+the new company's feed only. Events older than CHANGE_RETENTION_DAYS are
+deleted by the `changes.prune` job every CHANGE_PRUNE_INTERVAL seconds.
+"""
+from flask import current_app
+from models import db, ChangeEvent
+from jobs import job_handler, enqueue, enqueue_unless_pending
+from tenancy import company_of, add_company_column
+from versioning import allocate_versions, current_version
+from sqlalchemy import event, func, inspect, select, update, bindparam, text
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+import json
+import threading
+import time
+
+# Wakes up streams in this process as soon as a change commits
+_new_events = threading.Condition()
+
+
+# When one transaction touches an entity several times, the strongest action wins
+ACTION_PRIORITY = {'update': 0, 'assign': 1, 'create': 2, 'delete': 3}
+
+
+def record_change(entity_type, obj, action):
+    """Queue a change event for `obj`; it is written when the session commits.
+
+    The payload is serialized at commit time, after every other change in the
+    transaction, so it reflects the final state of the row.
+    """
+    if not obj:
+        return
+    pending = db.session.info.setdefault('pending_changes', [])
+    # Deleted rows cannot be reloaded later, so remember their id and company now
+    company_id = company_of(db.session, obj) if action == 'delete' else None
+    pending.append((entity_type, obj, obj.id, action, company_id))
+
+
+@event.listens_for(Session, 'before_commit')
+def _write_pending_changes(session):
+    pending = session.info.pop('pending_changes', None)
+    if not pending:
+        return
+
+    session.flush()
+    merged = {}
+    for entity_type, obj, entity_id, action, company_id in pending:
+        key = (entity_type, entity_id if action == 'delete' else obj.id)
+        current = merged.get(key)
+        if current is None or ACTION_PRIORITY[action] > ACTION_PRIORITY[current[2]]:
+            merged[key] = (entity_type, obj, action, company_id)
+
+    events = []
+    for (entity_type, entity_id), (_, obj, action, company_id) in merged.items():
+        if action == 'delete':
+            events.append(ChangeEvent(entity_type=entity_type, entity_id=entity_id, action=action,
+                                      company_id=company_id))
+            continue
+        # Reload so relationship-derived fields (names, counts) are current
+        session.expire(obj)
+        events.append(ChangeEvent(entity_type=entity_type, entity_id=entity_id, action=action, data=obj.to_dict(),
+                                  company_id=company_of(session, obj)))
+
+    for change, version in zip(events, allocate_versions(session.connection(), len(events))):
+        change.version = version
+    session.add_all(events)
+    session.info['changes_written'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_streams(session):
+    if session.info.pop('changes_written', False):
+        with _new_events:
+            _new_events.notify_all()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending_changes(session):
+    session.info.pop('pending_changes', None)
+    session.info.pop('changes_written', None)
+
+
+def latest_version():
+    """Return the newest version handed out; every event up to it has committed"""
+    return current_version()
+
+
+def events_since(since, entity_types=None, limit=500, companies=None):
+    """Return up to `limit` events newer than `since`, oldest first.
+
+    `companies` limits the events to rows of those company ids, usually the
+    caller's `current_tenant()`; None returns the events of every company.
+    """
+    query = ChangeEvent.query.filter(ChangeEvent.version > since)
+    if entity_types:
+        query = query.filter(ChangeEvent.entity_type.in_(entity_types))
+    if companies is not None:
+        query = query.filter(ChangeEvent.company_id.in_(companies))
+    return query.order_by(ChangeEvent.version).limit(limit).all()
+
+
+def format_sse(change):
+    """Format an event for a text/event-stream response"""
+    return f"id: {change['version']}\nevent: change\ndata: {json.dumps(change)}\n\n"
+
+
+def stream_changes(since, entity_types=None, poll_interval=1.0, heartbeat=15, max_duration=300, companies=None):
+    """Yield SSE messages for new events until `max_duration` elapses.
+
+    Streams end periodically so long-lived connections do not pin workers
+    forever; EventSource reconnects on its own and resumes via Last-Event-ID.
+    `companies` is taken by the view: the request's session, and its tenant,
+    are gone by the time the response is streamed.
+    """
+    started = last_sent = time.monotonic()
+    cursor = since
+    yield 'retry: 2000\n\n'
+
+    while time.monotonic() - started < max_duration:
+        changes = [e.to_dict() for e in events_since(cursor, entity_types, companies=companies)]
+        # Release the connection while idle; other requests need the pool
+        db.session.remove()
+
+        if changes:
+            cursor = changes[-1]['version']
+            for change in changes:
+                yield format_sse(change)
+            last_sent = time.monotonic()
+            continue
+
+        if time.monotonic() - last_sent >= heartbeat:
+            yield ': keep-alive\n\n'
+            last_sent = time.monotonic()
+
+        # Other workers' commits are only seen by polling, local ones wake us early
+        with _new_events:
+            _new_events.wait(timeout=poll_interval)
+
+
+def prune_changes(max_age_days):
+    """Delete events older than `max_age_days`"""
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+    # Versions grow with time, so deleting by version keeps to its index
+    last_version = db.session.query(func.max(ChangeEvent.version)).filter(ChangeEvent.created_at < cutoff).scalar()
+    if last_version is None:
+        return {'pruned': 0}
+    pruned = ChangeEvent.query.filter(ChangeEvent.version <= last_version).delete(synchronize_session=False)
+    db.session.commit()
+    return {'pruned': pruned}
+
+
+@job_handler('changes.prune')
+def prune_changes_job(payload):
+    """Prune old events, then queue the next run"""
+    config = current_app.config
+    result = prune_changes(payload.get('max_age_days', config['CHANGE_RETENTION_DAYS']))
+    if config['CHANGE_PRUNE_INTERVAL'] > 0:
+        enqueue('changes.prune', delay=config['CHANGE_PRUNE_INTERVAL'])
+    return result
+
+
+def _add_event_columns():
+    """Add company_id and version to change_event tables created before they existed"""
+    add_company_column(ChangeEvent.__table__.name)
+    existing = {column['name'] for column in inspect(db.engine).get_columns(ChangeEvent.__table__.name)}
+    with db.engine.begin() as connection:
+        if 'version' not in existing:
+            connection.execute(text('ALTER TABLE change_event ADD COLUMN version BIGINT'))
+            # Replaced by the (company_id, version) index
+            connection.execute(text('DROP INDEX IF EXISTS ix_change_event_company_id'))
+
+
+def _version_old_events():
+    """Give events written before versions came from the counter a version, in id order"""
+    table = ChangeEvent.__table__
+    connection = db.session.connection()
+    ids = [row[0] for row in connection.execute(select(table.c.id).where(table.c.version.is_(None)).order_by(table.c.id))]
+    if ids:
+        versions = allocate_versions(connection, len(ids))
+        connection.execute(
+            update(table).where(table.c.id == bindparam('event_id')).values(version=bindparam('event_version')),
+            [{'event_id': i, 'event_version': v} for i, v in zip(ids, versions)]
+        )
+    db.session.commit()
+
+
+def ensure_change_feed():
+    """Migrate change_event tables created before company_id and version existed and start the pruning chain.
+
+    Runs after `ensure_versions`, which creates the counter row.
+    """
+    _add_event_columns()
+    _version_old_events()
+    for index in ChangeEvent.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+    if current_app.config['CHANGE_PRUNE_INTERVAL'] > 0:
+        enqueue_unless_pending('changes.prune')
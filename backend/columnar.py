@@ -0,0 +1,81 @@
+"""
+Columnar responses for list and search endpoints.
+
+`?format=columnar` answers with one array per column instead of one object
+per row, so key names are sent once. Columns marked `dictionary` in the
+model schema send each distinct string once and row indexes into it; dates
+are epoch days and datetimes epoch milliseconds.
+
+`?format=msgpack` (or `Accept: application/x-msgpack`) sends the same
+structure as MessagePack; compression.py compresses it like any other
+response. It needs the optional `msgpack` package.
+"""
+from flask import request, jsonify, make_response
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+
+
+def encode_columns(schema, objs):
+    """Encode model instances as {count, columns, types, dictionaries}"""
+    rows = [schema.to_row(obj) for obj in objs]
+    values = list(zip(*rows)) if rows else [() for _ in schema.columns]
+
+    columns = {}
+    dictionaries = {}
+    for name, column in zip(schema.columns, values):
+        if name not in schema.dictionary_columns:
+            columns[name] = list(column)
+            continue
+        index = {}
+        columns[name] = [None if value is None else index.setdefault(value, len(index)) for value in column]
+        dictionaries[name] = list(index)
+
+    return {
+        'format': 'columnar',
+        'count': len(rows),
+        'types': schema.kinds,
+        'columns': columns,
+        'dictionaries': dictionaries
+    }
+
+
+def choose_format(fmt, best_mimetype):
+    """'msgpack', 'columnar' or 'rows' from the format parameter and the preferred Accept type"""
+    if fmt in ('msgpack', 'columnar', 'rows'):
+        return fmt
+    if best_mimetype == MSGPACK_MIMETYPE:
+        return 'msgpack'
+    return 'rows'
+
+
+def requested_format():
+    """'msgpack', 'columnar' or 'rows' for the current request"""
+    return choose_format(request.args.get('format'), request.accept_mimetypes.best)
+
+
+def list_response(model, objs, extra=None):
+    """Respond with `objs` in the format the client asked for.
+
+    `extra` (e.g. facet counts) turns the row format into {'items': [...], **extra}
+    and is merged into the columnar payload.
+    """
+    fmt = requested_format()
+    if fmt == 'rows':
+        items = [obj.to_dict() for obj in objs]
+        return jsonify({'items': items, **extra} if extra else items), 200
+
+    payload = encode_columns(model.schema, objs)
+    payload.update(extra or {})
+    if fmt == 'columnar':
+        return jsonify(payload), 200
+
+    if msgpack is None:
+        return jsonify({'error': 'MessagePack responses need the msgpack package'}), 406
+    response = make_response(msgpack.packb(payload), 200)
+    response.mimetype = MSGPACK_MIMETYPE
+    return response
@@ -0,0 +1,190 @@
+"""
+Negotiated response compression and a cache of compressed list responses.
+
+Responses above COMPRESSION_MIN_SIZE are compressed with the best encoding
+the client accepts: zstd and brotli when their optional packages are
+installed, gzip otherwise. Views pick a level profile with `@compression`.
+
+Views decorated with `@cached` keep their last responses in memory, one
+body per encoding, keyed by the URL, the tenant (see tenancy.py) and the
+global sync version (see versioning.py). Any write to a company, vehicle,
+driver or file bumps the version, so cached lists are never served stale,
+and repeated requests skip the query, serialization and compression.
+Their responses carry that version in `X-Data-Version`, cache on or off,
+so a client can follow the change feed (see changes.py) from the version
+its list was read at.
+"""
+from flask import request, current_app, make_response
+from versioning import current_version
+from tenancy import current_tenant
+from collections import OrderedDict
+from functools import wraps
+import gzip
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-msgpack', 'text/plain', 'text/csv', 'text/html'}
+
+# Per-encoding levels for each profile: 'fast' for one-off responses,
+# 'best' for responses that are cached and compressed once
+LEVELS = {
+    'fast': {'zstd': 1, 'br': 1, 'gzip': 1},
+    'default': {'zstd': 3, 'br': 4, 'gzip': 6},
+    'best': {'zstd': 12, 'br': 9, 'gzip': 9}
+}
+
+# In order of preference when the client accepts several equally
+COMPRESSORS = {}
+if zstandard is not None:
+    COMPRESSORS['zstd'] = lambda data, level: zstandard.ZstdCompressor(level=level).compress(data)
+if brotli is not None:
+    COMPRESSORS['br'] = lambda data, level: brotli.compress(data, quality=level)
+COMPRESSORS['gzip'] = lambda data, level: gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def choose_encoding():
+    """Best encoding accepted by the client, or None"""
+    return request.accept_encodings.best_match(list(COMPRESSORS))
+
+
+def compress(data, encoding, profile='default'):
+    return COMPRESSORS[encoding](data, LEVELS[profile][encoding])
+
+
+def compression(profile):
+    """Set the compression profile ('fast', 'default' or 'best') of a view"""
+    if profile not in LEVELS:
+        raise ValueError(f'Unknown compression profile: {profile}')
+
+    def decorator(view):
+        view.compression_profile = profile
+        return view
+    return decorator
+
+
+def response_profile(view, config):
+    """Profile the responses of a view are compressed with"""
+    cached = getattr(view, 'response_cache', False) and config['RESPONSE_CACHE_SIZE']
+    return getattr(view, 'compression_profile', 'best' if cached else 'default')
+
+
+def _view_profile():
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(view, 'compression_profile', 'default')
+
+
+def _compressible(response):
+    return (not response.direct_passthrough
+            and not response.is_streamed
+            and 'Content-Encoding' not in response.headers
+            and response.mimetype in COMPRESSIBLE_MIMETYPES)
+
+
+def compress_response(response):
+    """after_request hook compressing large responses"""
+    if not _compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.content_length is None or response.content_length < current_app.config['COMPRESSION_MIN_SIZE']:
+        return response
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    response.set_data(compress(response.get_data(), encoding, _view_profile()))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+class CachedResponse:
+    """A response body kept uncompressed and in each encoding asked for so far"""
+
+    def __init__(self, body, mimetype):
+        self.body = body
+        self.mimetype = mimetype
+        self.encoded = {}
+
+    def respond(self, encoding, profile):
+        if encoding is None or len(self.body) < current_app.config['COMPRESSION_MIN_SIZE']:
+            response = make_response(self.body, 200)
+        else:
+            if encoding not in self.encoded:
+                # Two requests may compress at once; both results are identical
+                self.encoded[encoding] = compress(self.body, encoding, profile)
+            response = make_response(self.encoded[encoding], 200)
+            response.headers['Content-Encoding'] = encoding
+        response.mimetype = self.mimetype
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+class ResponseCache:
+    """Small thread-safe LRU of CachedResponse entries"""
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry, max_entries):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+response_cache = ResponseCache()
+
+
+def cached(view):
+    """Serve repeated requests from memory until synced data changes"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # The version is read before the query, so the data is never older than it
+        version = current_version()
+        response = _cached_response(wrapper, version, view, args, kwargs)
+        if response.status_code == 200:
+            response.headers['X-Data-Version'] = str(version)
+        return response
+    wrapper.response_cache = True
+    return wrapper
+
+
+def _cached_response(wrapper, version, view, args, kwargs):
+    max_entries = current_app.config['RESPONSE_CACHE_SIZE']
+    if not max_entries:
+        return make_response(view(*args, **kwargs))
+
+    key = (request.full_path, request.headers.get('Accept'), current_tenant(), version)
+    entry = response_cache.get(key)
+    if entry is None:
+        response = make_response(view(*args, **kwargs))
+        if response.status_code != 200 or not _compressible(response):
+            return response
+        entry = CachedResponse(response.get_data(), response.mimetype)
+        response_cache.put(key, entry, max_entries)
+    return entry.respond(choose_encoding(), getattr(wrapper, 'compression_profile', 'best'))
+
+
+def init_compression(app):
+    app.after_request(compress_response)
@@ -0,0 +1,237 @@
+"""
+Full-text search inside uploaded documents.
+
+Every new File gets a `documents.extract` job that reads it from storage,
+pulls out its text and stores it in `file_text`. Workers run these jobs in
+parallel (see worker.py), so uploads never wait for extraction.
+
+Text is extracted from TXT, DOCX (read directly from the document XML) and
+PDF files; PDF needs `pip install pypdf`. Other types are recorded as
+unsupported.
+
+The text is indexed by a generated tsvector column with a GIN index on
+PostgreSQL and by an FTS5 table kept in sync by triggers on SQLite.
+`search_documents` returns files ranked by relevance with a snippet around
+the matches; queries go through the File model, so tenant scoping applies.
+"""
+from models import db, File, Vehicle, Driver, FileText
+from jobs import job_handler, enqueue, enqueue_unless_pending, report_progress
+from storage import get_storage, storage_key
+from sqlalchemy import event, text, func, select, or_, literal_column, table, column
+from sqlalchemy.orm import Session
+from xml.etree import ElementTree
+from datetime import datetime
+import logging
+import shutil
+import tempfile
+import zipfile
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+logger = logging.getLogger(__name__)
+
+# A PostgreSQL tsvector is limited to 1 MB; long documents are indexed up to here
+MAX_TEXT_LENGTH = 500000
+
+# Extraction jobs queued per transaction by the backfill
+BACKFILL_BATCH = 500
+
+# Matches are wrapped in these in snippets
+MATCH_START, MATCH_STOP = '**', '**'
+
+POSTGRES_DDL = [
+    """
+    ALTER TABLE file_text ADD COLUMN IF NOT EXISTS document tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, ''))) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_file_text_document ON file_text USING gin (document)"
+]
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS file_text_fts USING fts5(content, content='file_text', content_rowid='file_id')",
+    """
+    CREATE TRIGGER IF NOT EXISTS file_text_fts_insert AFTER INSERT ON file_text BEGIN
+        INSERT INTO file_text_fts (rowid, content) VALUES (new.file_id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS file_text_fts_delete AFTER DELETE ON file_text BEGIN
+        INSERT INTO file_text_fts (file_text_fts, rowid, content) VALUES ('delete', old.file_id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS file_text_fts_update AFTER UPDATE ON file_text BEGIN
+        INSERT INTO file_text_fts (file_text_fts, rowid, content) VALUES ('delete', old.file_id, old.content);
+        INSERT INTO file_text_fts (rowid, content) VALUES (new.file_id, new.content);
+    END
+    """
+]
+
+
+# --- Extraction ---
+
+WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+
+def _extract_txt(handle):
+    return handle.read(MAX_TEXT_LENGTH * 4).decode('utf-8', errors='replace')
+
+
+def _extract_docx(handle):
+    paragraphs, current = [], []
+    with zipfile.ZipFile(handle) as archive, archive.open('word/document.xml') as document:
+        for _, element in ElementTree.iterparse(document):
+            if element.tag == WORD_NAMESPACE + 't' and element.text:
+                current.append(element.text)
+            elif element.tag == WORD_NAMESPACE + 'p':
+                paragraphs.append(''.join(current))
+                current = []
+                element.clear()
+    return '\n'.join(paragraphs)
+
+
+def _extract_pdf(handle):
+    reader = pypdf.PdfReader(handle)
+    return '\n'.join(page.extract_text() or '' for page in reader.pages)
+
+
+EXTRACTORS = {
+    'txt': _extract_txt,
+    'docx': _extract_docx,
+}
+if pypdf is not None:
+    EXTRACTORS['pdf'] = _extract_pdf
+
+
+def index_file(file):
+    """Extract and store the text of one file"""
+    record = file.document_text or FileText(file_id=file.id)
+    record.extracted_at = datetime.utcnow()
+    record.status, record.content, record.error = 'unsupported', None, None
+    extractor = EXTRACTORS.get((file.file_type or '').lower())
+    key = storage_key(file.file_url)
+    if extractor is not None and key is None:
+        record.status, record.error = 'failed', 'File is not in storage'
+    elif extractor is not None:
+        # DOCX and PDF need to seek, which remote storage streams cannot;
+        # storage errors propagate so the job is retried
+        with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as local:
+            try:
+                with get_storage().open(key) as stream:
+                    shutil.copyfileobj(stream, local)
+            except FileNotFoundError:
+                record.status, record.error = 'failed', 'File not found in storage'
+            else:
+                local.seek(0)
+                try:
+                    content = extractor(local)[:MAX_TEXT_LENGTH].replace('\x00', '').strip()
+                except Exception as e:
+                    # Damaged or encrypted documents fail the same way every time; retrying will not help
+                    logger.warning('Could not extract text from file %s', file.id, exc_info=True)
+                    record.status, record.error = 'failed', str(e)[:1000]
+                else:
+                    record.status, record.content = ('indexed' if content else 'empty'), content or None
+    db.session.add(record)
+    db.session.commit()
+    return record
+
+
+@job_handler('documents.extract')
+def extract_job(payload):
+    """Index the text of payload['file_id']"""
+    file = db.session.get(File, payload['file_id'])
+    if file is None:
+        return {'skipped': 'deleted'}
+    return {'status': index_file(file).status}
+
+
+@job_handler('documents.backfill')
+def backfill_job(payload):
+    """Queue extraction for files that have no extracted text yet"""
+    missing = db.session.execute(
+        select(File.id).outerjoin(FileText, FileText.file_id == File.id)
+        .where(FileText.file_id.is_(None)).execution_options(all_tenants=True)
+    ).scalars().all()
+    for start in range(0, len(missing), BACKFILL_BATCH):
+        for file_id in missing[start:start + BACKFILL_BATCH]:
+            enqueue('documents.extract', {'file_id': file_id}, commit=False)
+        db.session.commit()
+        report_progress(100 * (start + BACKFILL_BATCH) / len(missing))
+    return {'queued': len(missing)}
+
+
+@event.listens_for(Session, 'after_flush')
+def _note_new_files(session, flush_context):
+    new = [obj.id for obj in session.new if isinstance(obj, File)]
+    if new:
+        session.info.setdefault('new_file_ids', []).extend(new)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _queue_extraction(session, flush_context):
+    # Queued in the upload's own transaction; the commit flushes the jobs too
+    for file_id in session.info.pop('new_file_ids', []):
+        enqueue('documents.extract', {'file_id': file_id}, commit=False)
+
+
+def ensure_document_search():
+    """Create the text index and queue extraction of files uploaded before it existed"""
+    statements = {'postgresql': POSTGRES_DDL, 'sqlite': SQLITE_DDL}.get(db.engine.dialect.name, [])
+    with db.engine.begin() as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+
+    unindexed = (select(File.id).outerjoin(FileText, FileText.file_id == File.id)
+                 .where(FileText.file_id.is_(None)).limit(1).execution_options(all_tenants=True))
+    if db.session.execute(unindexed).first() is not None:
+        enqueue_unless_pending('documents.backfill')
+
+
+# --- Search ---
+
+def _scope(query, company_id=None, vehicle_id=None, driver_id=None):
+    if company_id is not None:
+        # A company's documents include those of its vehicles and drivers
+        query = query.filter(or_(
+            File.company_id == company_id,
+            File.vehicle_id.in_(select(Vehicle.id).where(Vehicle.company_id == company_id)),
+            File.driver_id.in_(select(Driver.id).where(Driver.company_id == company_id))
+        ))
+    if vehicle_id is not None:
+        query = query.filter(File.vehicle_id == vehicle_id)
+    if driver_id is not None:
+        query = query.filter(File.driver_id == driver_id)
+    return query
+
+
+def search_documents(q, limit=20, session=None, **scope):
+    """Files whose text matches `q`, best first; returns [(file, rank, snippet)]"""
+    session = session or db.session
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        query_vector = func.websearch_to_tsquery('simple', q)
+        document = literal_column('file_text.document')
+        rank = func.ts_rank_cd(document, query_vector)
+        snippet = func.ts_headline('simple', FileText.content, query_vector,
+                                   f'StartSel={MATCH_START}, StopSel={MATCH_STOP}, MaxFragments=2, MaxWords=20, MinWords=5')
+        query = (session.query(File, rank, snippet)
+                 .join(FileText, FileText.file_id == File.id)
+                 .filter(document.op('@@')(query_vector))
+                 .order_by(rank.desc(), File.id))
+    elif dialect == 'sqlite':
+        fts = table('file_text_fts', column('rowid'))
+        # Each word is quoted, so user input cannot break FTS5 query syntax
+        match = ' '.join('"{}"'.format(word.replace('"', '""')) for word in q.split())
+        # bm25 is lower for better matches
+        rank = func.bm25(literal_column('file_text_fts'))
+        snippet = func.snippet(literal_column('file_text_fts'), 0, MATCH_START, MATCH_STOP, '...', 16)
+        query = (session.query(File, -rank, snippet)
+                 .join(fts, fts.c.rowid == File.id)
+                 .filter(literal_column('file_text_fts').op('MATCH')(match))
+                 .order_by(rank, File.id))
+    else:
+        raise NotImplementedError(f'Document search is not available on {dialect}')
+    return _scope(query, **scope).limit(limit).all()
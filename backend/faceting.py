@@ -0,0 +1,109 @@
+"""
+Filtering, sorting and facet counts for the vehicle and driver search.
+
+Facet fields are filtered with `field=value`; repeat the parameter to match
+any of several values. Date fields take ranges as `<field>_from` and
+`<field>_to` (inclusive). `sort=company_name,-license_expiry_date` sorts by
+several columns, `-` meaning descending.
+
+Facet counts cover the filtered rows and come from one grouped query:
+GROUPING SETS on PostgreSQL, a UNION ALL of per-field GROUP BYs elsewhere.
+"""
+from models import db, Company, Vehicle, Driver
+from schema import CONVERTERS, SchemaError
+from sqlalchemy import select, func, literal, union_all
+
+
+class SearchSpec:
+    """Which fields of a model can be filtered, faceted and sorted on"""
+
+    def __init__(self, model, facets):
+        self.model = model
+        self.facets = facets
+        self.kinds = model.schema.kinds
+        self.date_fields = [name for name, kind in self.kinds.items()
+                            if kind == 'date' and hasattr(model.__table__.c, name)]
+
+    def column(self, name):
+        return getattr(self.model, name)
+
+
+VEHICLE_SEARCH = SearchSpec(Vehicle, ['company_id', 'car_type', 'manufacturer', 'department', 'is_operational'])
+DRIVER_SEARCH = SearchSpec(Driver, ['company_id', 'license_class', 'was_license_revoked',
+                                    'has_hazardous_materials_permit', 'has_crane_operation_permit'])
+
+
+def ensure_search_indexes():
+    """Create the search indexes on databases created before they existed"""
+    for model in (Vehicle, Driver):
+        for index in model.__table__.indexes:
+            if not index.unique:
+                index.create(db.engine, checkfirst=True)
+
+
+def apply_filters(spec, query, args):
+    """Filter `query` by facet values and date ranges in `args`"""
+    for name in spec.facets:
+        convert = CONVERTERS[spec.kinds[name]]
+        values = [convert(value, name) for value in args.getlist(name) if value != '']
+        if len(values) == 1:
+            query = query.filter(spec.column(name) == values[0])
+        elif values:
+            query = query.filter(spec.column(name).in_(values))
+
+    for name in spec.date_fields:
+        start = CONVERTERS['date'](args.get(f'{name}_from'), f'{name}_from')
+        end = CONVERTERS['date'](args.get(f'{name}_to'), f'{name}_to')
+        if start:
+            query = query.filter(spec.column(name) >= start)
+        if end:
+            query = query.filter(spec.column(name) <= end)
+    return query
+
+
+def apply_sort(spec, query, sort):
+    """Order `query` by a comma-separated list of fields; ties fall back to id"""
+    order = []
+    joined = False
+    for item in filter(None, (part.strip() for part in (sort or '').split(','))):
+        name = item.lstrip('-')
+        if name == 'company_name':
+            if not joined:
+                query = query.outerjoin(Company, spec.model.company_id == Company.id)
+                joined = True
+            column = Company.name
+        elif hasattr(spec.model.__table__.c, name):
+            column = spec.column(name)
+        else:
+            raise SchemaError(f'Cannot sort by {name}')
+        order.append((column.desc() if item.startswith('-') else column.asc()).nulls_last())
+    return query.order_by(*order, spec.model.id)
+
+
+def facet_counts(spec, query):
+    """Count filtered rows per value of each facet field"""
+    filtered = query.with_entities(*[spec.column(name) for name in spec.facets]).subquery()
+    columns = [filtered.c[name] for name in spec.facets]
+    session = query.session
+
+    if session.get_bind().dialect.name == 'postgresql':
+        # GROUPING(col) is 0 only in the rows grouped by that column
+        statement = (select(*[func.grouping(column) for column in columns], *columns, func.count())
+                     .group_by(func.grouping_sets(*columns)))
+        rows = []
+        for row in session.execute(statement):
+            index = list(row[:len(columns)]).index(0)
+            rows.append((spec.facets[index], row[len(columns) + index], row[-1]))
+    else:
+        statement = union_all(*[
+            select(literal(name).label('facet'), column.label('value'), func.count().label('count')).group_by(column)
+            for name, column in zip(spec.facets, columns)
+        ])
+        rows = session.execute(statement).all()
+
+    facets = {name: [] for name in spec.facets}
+    for name, value, count in rows:
+        facets[name].append({'value': CONVERTERS[spec.kinds[name]](value, name), 'count': count})
+    for counts in facets.values():
+        counts.sort(key=lambda item: -item['count'])
+    return facets
@@ -0,0 +1,411 @@
+"""
+Database-backed background job queue.
+
+Jobs are rows in the ``job`` table, so any process that can reach the database
+can enqueue or run them without an external broker. Workers (see worker.py)
+claim the oldest runnable job, run the registered handler and record the
+outcome, retrying failures with exponential backoff.
+"""
+from flask import request, jsonify, current_app, url_for
+from models import db, Job
+from storage import get_storage
+from sqlalchemy import update, text
+from sqlalchemy.exc import SQLAlchemyError
+from datetime import datetime, timedelta
+from functools import wraps
+from urllib.parse import urlencode
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Name -> (handler, on_failure) for every registered job type
+HANDLERS = {}
+
+# Storage key prefix of uploads waiting for their request to be replayed
+STAGING_PREFIX = '_staging/'
+
+# Marks requests that are being replayed by a worker so they run inline
+REPLAY_ENVIRON_KEY = 'ziv.job_replay'
+
+# Headers that describe the original HTTP exchange and must not be replayed
+# Accept-Encoding is dropped so replayed responses stay readable JSON
+SKIPPED_REPLAY_HEADERS = {'host', 'content-length', 'content-type', 'cookie', 'connection', 'accept-encoding'}
+
+_state = threading.local()
+
+
+class JobError(Exception):
+    """Raised by handlers for failures that are worth retrying"""
+
+
+class PermanentJobError(JobError):
+    """Raised by handlers for failures that retrying cannot fix"""
+
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.result = result
+
+
+def job_handler(name, on_failure=None):
+    """Register a function as the handler for jobs called `name`.
+
+    The handler receives the job payload and returns a JSON-serializable
+    result. `on_failure(payload)` runs once the job has failed for good.
+    """
+    def decorator(func):
+        HANDLERS[name] = (func, on_failure)
+        return func
+    return decorator
+
+
+def enqueue(name, payload=None, max_attempts=None, delay=0, commit=True):
+    """Add a job to the queue and return it"""
+    if max_attempts is None:
+        max_attempts = current_app.config.get('JOB_MAX_ATTEMPTS', 3)
+    job = Job(
+        name=name,
+        payload=payload or {},
+        status='queued',
+        progress=0,
+        attempts=0,
+        max_attempts=max_attempts,
+        run_after=datetime.utcnow() + timedelta(seconds=delay)
+    )
+    db.session.add(job)
+    if commit:
+        db.session.commit()
+    return job
+
+
+def enqueue_unless_pending(name, payload=None, delay=0):
+    """Queue a job unless one called `name` is queued or running; returns it, or None.
+
+    Starts the perpetual job chains, which every web and job process does at
+    startup. The check and the insert run under a lock, so processes
+    starting together cannot each start a chain.
+    """
+    db.session.commit()
+    if db.engine.dialect.name == 'postgresql':
+        # Released by the commit
+        db.session.execute(text('SELECT pg_advisory_xact_lock(hashtext(:name))'), {'name': name})
+    elif db.engine.dialect.name == 'sqlite':
+        # Takes the database write lock before the check instead of at the insert
+        db.session.execute(text('BEGIN IMMEDIATE'))
+    pending = Job.query.filter(Job.name == name, Job.status.in_(('queued', 'running'))).first()
+    if pending is not None:
+        db.session.commit()
+        return None
+    return enqueue(name, payload, delay=delay)
+
+
+def report_progress(progress):
+    """Record progress (0-100) for the job currently running in this thread.
+
+    Written on its own connection so it is visible immediately without
+    committing the handler's unfinished work. Also refreshes the job's
+    lock, so `requeue_stale` knows it is still alive.
+    """
+    job_id = getattr(_state, 'job_id', None)
+    if job_id is None:
+        return
+    progress = max(0, min(100, int(progress)))
+    with db.engine.begin() as conn:
+        conn.execute(update(Job.__table__).where(Job.__table__.c.id == job_id)
+                     .values(progress=progress, locked_at=datetime.utcnow()))
+
+
+def _heartbeat(engine, job_id, interval, stop_event):
+    """Refresh locked_at every `interval` seconds until `stop_event` is set"""
+    jobs = Job.__table__
+    while not stop_event.wait(interval):
+        try:
+            with engine.begin() as conn:
+                conn.execute(update(jobs).where(jobs.c.id == job_id, jobs.c.status == 'running')
+                             .values(locked_at=datetime.utcnow()))
+        except SQLAlchemyError:
+            # The next beat tries again; a job that misses several is requeued as stale
+            logger.warning('Could not refresh the lock of job %s', job_id, exc_info=True)
+
+
+def claim_next(worker_id):
+    """Atomically claim the oldest runnable job, or return None"""
+    now = datetime.utcnow()
+    job = (Job.query
+           .filter(Job.status == 'queued', Job.run_after <= now)
+           .order_by(Job.run_after, Job.id)
+           .with_for_update(skip_locked=True)
+           .first())
+    if job is None:
+        db.session.rollback()
+        return None
+
+    # The conditional update keeps claiming safe on databases without SKIP LOCKED
+    claimed = Job.query.filter(Job.id == job.id, Job.status == 'queued').update({
+        Job.status: 'running',
+        Job.attempts: Job.attempts + 1,
+        Job.locked_by: worker_id,
+        Job.locked_at: now,
+        Job.started_at: now
+    }, synchronize_session=False)
+    db.session.commit()
+
+    if not claimed:
+        return None
+    return db.session.get(Job, job.id)
+
+
+def requeue_stale(timeout):
+    """Return jobs whose worker died mid-run to the queue"""
+    cutoff = datetime.utcnow() - timedelta(seconds=timeout)
+    stale = Job.query.filter(Job.status == 'running', Job.locked_at < cutoff)
+    stale.filter(Job.attempts >= Job.max_attempts).update({
+        Job.status: 'failed',
+        Job.error: 'Worker timed out',
+        Job.finished_at: datetime.utcnow()
+    }, synchronize_session=False)
+    count = stale.filter(Job.attempts < Job.max_attempts).update({
+        Job.status: 'queued',
+        Job.locked_by: None,
+        Job.locked_at: None
+    }, synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def run_job(job):
+    """Run a claimed job and record success, retry or failure"""
+    job_id = job.id
+    name = job.name
+    payload = job.payload or {}
+    handler, on_failure = HANDLERS.get(name, (None, None))
+
+    _state.job_id = job_id
+    # Long jobs keep their lock fresh, so they are not presumed dead after JOB_TIMEOUT
+    stop_heartbeat = threading.Event()
+    interval = current_app.config.get('JOB_TIMEOUT', 600) / 3
+    threading.Thread(target=_heartbeat, args=(db.engine, job_id, interval, stop_heartbeat), daemon=True).start()
+    failed = False
+    try:
+        if handler is None:
+            raise PermanentJobError(f'No handler registered for job "{name}"')
+        result = handler(payload)
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        permanent = isinstance(e, PermanentJobError)
+        job.error = str(e) if permanent else traceback.format_exc()
+        if permanent:
+            job.result = e.result
+
+        if not permanent and job.attempts < job.max_attempts:
+            backoff = current_app.config.get('JOB_RETRY_BACKOFF', 5)
+            job.status = 'queued'
+            job.run_after = datetime.utcnow() + timedelta(seconds=backoff * 2 ** (job.attempts - 1))
+            job.locked_by = None
+            job.locked_at = None
+        else:
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+            failed = True
+    else:
+        job = db.session.get(Job, job_id)
+        job.status = 'succeeded'
+        job.progress = 100
+        job.result = result
+        job.error = None
+        job.finished_at = datetime.utcnow()
+    finally:
+        _state.job_id = None
+        stop_heartbeat.set()
+
+    db.session.commit()
+    # After the failure is recorded, so an error here cannot leave the job running to be retried
+    if failed and on_failure:
+        try:
+            on_failure(payload)
+        except Exception:
+            db.session.rollback()
+            logger.exception('Failure handler of job %s failed', job_id)
+    return job
+
+
+def work(app, worker_id=None, poll_interval=None, stop_event=None, burst=False):
+    """Process jobs until `stop_event` is set (or the queue is empty in burst mode)"""
+    worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+    processed = 0
+
+    with app.app_context():
+        if poll_interval is None:
+            poll_interval = app.config.get('JOB_POLL_INTERVAL', 1.0)
+        stale_timeout = app.config.get('JOB_TIMEOUT', 600)
+        last_recovery = 0
+
+        while not (stop_event and stop_event.is_set()):
+            if time.monotonic() - last_recovery > min(stale_timeout, 60):
+                requeue_stale(stale_timeout)
+                last_recovery = time.monotonic()
+
+            job = claim_next(worker_id)
+            if job is None:
+                if burst:
+                    break
+                if stop_event:
+                    stop_event.wait(poll_interval)
+                else:
+                    time.sleep(poll_interval)
+                continue
+
+            run_job(job)
+            db.session.remove()
+            processed += 1
+
+    return processed
+
+
+def _worker_process(stop_event, poll_interval):
+    """Entry point of a pool process"""
+    # Ctrl+C goes to the whole process group; let the parent coordinate shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from app import create_app
+    app = create_app()
+    work(app, poll_interval=poll_interval, stop_event=stop_event)
+
+
+def run_pool(processes=2, poll_interval=None):
+    """Run `processes` worker processes until interrupted"""
+    stop_event = multiprocessing.Event()
+
+    def start():
+        proc = multiprocessing.Process(target=_worker_process, args=(stop_event, poll_interval))
+        proc.start()
+        return proc
+
+    def stop(*args):
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    pool = [start() for _ in range(processes)]
+    try:
+        while not stop_event.is_set():
+            for i, proc in enumerate(pool):
+                proc.join(timeout=1)
+                # Replace workers that crashed so the pool keeps its size
+                if not proc.is_alive() and not stop_event.is_set():
+                    pool[i] = start()
+    except KeyboardInterrupt:
+        stop_event.set()
+
+    for proc in pool:
+        proc.join()
+
+
+# --- Handing off HTTP requests ---
+
+def wants_async():
+    """Whether the current request asked to be run in the background"""
+    if request.environ.get(REPLAY_ENVIRON_KEY):
+        return False
+    if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+
+def enqueue_request():
+    """Serialize the current request into an `http.replay` job"""
+    files = []
+    for field, upload in request.files.items(multi=True):
+        # Staged in shared storage, so a worker on any host can replay the request
+        key = f'{STAGING_PREFIX}{uuid.uuid4().hex}'
+        get_storage().save(key, upload.stream, upload.content_type)
+        files.append({
+            'field': field,
+            'filename': upload.filename,
+            'content_type': upload.content_type,
+            'key': key
+        })
+
+    payload = {
+        'method': request.method,
+        'path': request.path,
+        'query': [(k, v) for k, v in request.args.items(multi=True) if k != 'async'],
+        'headers': {k: v for k, v in request.headers.items() if k.lower() not in SKIPPED_REPLAY_HEADERS},
+        'json': request.get_json(silent=True) if request.is_json else None,
+        'form': request.form.to_dict(),
+        'files': files
+    }
+    return enqueue('http.replay', payload)
+
+
+def async_capable(view):
+    """Let clients run a view in the background with ?async=1 or Prefer: respond-async.
+
+    The request is stored as a job and a worker later replays it through the
+    same view, so the handler code does not need to know about jobs at all.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not wants_async():
+            return view(*args, **kwargs)
+
+        job = enqueue_request()
+        status_url = url_for('job.get_job', job_id=job.id)
+        response = jsonify({'job_id': job.id, 'status': job.status, 'status_url': status_url})
+        response.headers['Location'] = status_url
+        return response, 202
+    return wrapper
+
+
+def _remove_staged_files(payload):
+    for f in payload.get('files', []):
+        if 'key' in f:
+            get_storage().delete(f['key'])
+        elif os.path.exists(f['path']):
+            # Staged on local disk before uploads moved to storage.py
+            os.remove(f['path'])
+
+
+@job_handler('http.replay', on_failure=_remove_staged_files)
+def replay_request(payload):
+    """Run a request captured by `enqueue_request` through the app"""
+    data = dict(payload.get('form') or {})
+    opened = []
+    for f in payload.get('files', []):
+        handle = get_storage().open(f['key']) if 'key' in f else open(f['path'], 'rb')
+        opened.append(handle)
+        data[f['field']] = (handle, f['filename'], f['content_type'])
+
+    kwargs = {
+        'method': payload['method'],
+        'query_string': urlencode(payload.get('query') or []),
+        'headers': payload.get('headers') or {},
+        'environ_base': {REPLAY_ENVIRON_KEY: True}
+    }
+    if payload.get('json') is not None:
+        kwargs['json'] = payload['json']
+    elif data:
+        kwargs['data'] = data
+
+    try:
+        with current_app.test_request_context(payload['path'], **kwargs):
+            response = current_app.make_response(current_app.full_dispatch_request())
+    finally:
+        for handle in opened:
+            handle.close()
+
+    result = {'status_code': response.status_code, 'body': response.get_json(silent=True)}
+    if response.status_code >= 500:
+        raise JobError(f'Request failed with status {response.status_code}')
+    if response.status_code >= 400:
+        _remove_staged_files(payload)
+        raise PermanentJobError(f'Request failed with status {response.status_code}', result=result)
+
+    _remove_staged_files(payload)
+    return result
@@ -1,10 +1,12 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Date, Text, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, DateTime, Date, Text, Boolean, JSON, Index
 from sqlalchemy.orm import relationship
+from schema import Schema, Field, Computed
+from replicas import RoutingSession
 
 # This will be initialized in app.py
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class Company(db.Model):
     __tablename__ = 'company'
@@ -28,34 +30,40 @@ class Company(db.Model):
     inspection_week = Column(Integer)
     notes = Column(Text)
     
+    # Stamped on every write by versioning.py for delta sync
+    updated_at = Column(DateTime)
+    version = Column(BigInteger, index=True)
+    
     # Relationships
     vehicles = relationship('Vehicle', back_populates='company', cascade='all, delete-orphan')
     drivers = relationship('Driver', back_populates='company', cascade='all, delete-orphan')
     files = relationship('File', back_populates='company', cascade='all, delete-orphan')
     
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'identity_card': self.identity_card,
-            'name': self.name,
-            'address': self.address,
-            'po_box': self.po_box,
-            'phone': self.phone,
-            'fax': self.fax,
-            'contact_person': self.contact_person,
-            'contact_phone': self.contact_phone,
-            'manager_name': self.manager_name,
-            'manager_phone': self.manager_phone,
-            'manager_id': self.manager_id,
-            'email': self.email,
-            'safety_officer': self.safety_officer,
-            'carrier_license_expiry': self.carrier_license_expiry.isoformat() if self.carrier_license_expiry else None,
-            'established_date': self.established_date.isoformat() if self.established_date else None,
-            'inspection_week': self.inspection_week,
-            'notes': self.notes,
-            'vehicles_count': len(self.vehicles) if self.vehicles else 0,
-            'drivers_count': len(self.drivers) if self.drivers else 0
-        }
+    schema = Schema({
+        'id': Field('int', writable=False),
+        'identity_card': Field(required=True, unique=True),
+        'name': Field(),
+        'address': Field(),
+        'po_box': Field(),
+        'phone': Field(),
+        'fax': Field(),
+        'contact_person': Field(),
+        'contact_phone': Field(),
+        'manager_name': Field(),
+        'manager_phone': Field(),
+        'manager_id': Field(),
+        'email': Field(),
+        'safety_officer': Field(),
+        'carrier_license_expiry': Field('date'),
+        'established_date': Field('date'),
+        'inspection_week': Field('int'),
+        'notes': Field(),
+        'vehicles_count': Computed('len(obj.vehicles) if obj.vehicles else 0', 'int'),
+        'drivers_count': Computed('len(obj.drivers) if obj.drivers else 0', 'int'),
+        'updated_at': Field('datetime', writable=False),
+        'version': Field('int', writable=False)
+    })
+    to_dict = schema.to_dict
 
 class Vehicle(db.Model):
     __tablename__ = 'vehicle'
@@ -89,44 +97,64 @@ class Vehicle(db.Model):
     is_operational = Column(Boolean)
     notes = Column(Text)
     
+    # Stamped on every write by versioning.py for delta sync
+    updated_at = Column(DateTime)
+    version = Column(BigInteger, index=True)
+    
+    # A driver can drive only one vehicle; NULLs (unassigned) do not collide
+    __table_args__ = (
+        Index('ux_vehicle_assigned_driver_id', 'assigned_driver_id', unique=True),
+        # Search filters and facet counts (faceting.py)
+        Index('ix_vehicle_car_type', 'car_type'),
+        Index('ix_vehicle_manufacturer', 'manufacturer'),
+        Index('ix_vehicle_department', 'department'),
+        Index('ix_vehicle_is_operational', 'is_operational'),
+        Index('ix_vehicle_license_expiry_date', 'license_expiry_date'),
+        # Per-tenant lookups (tenancy.py); these also serve plain company_id filters
+        Index('ix_vehicle_company_car_type', 'company_id', 'car_type'),
+        Index('ix_vehicle_company_license_expiry', 'company_id', 'license_expiry_date'),
+    )
+    
     # Relationships
     company = relationship('Company', back_populates='vehicles')
     assigned_driver = relationship('Driver', back_populates='assigned_vehicle', foreign_keys=[assigned_driver_id])
     files = relationship('File', back_populates='vehicle', cascade='all, delete-orphan')
     
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'license_plate': self.license_plate,
-            'company_id': self.company_id,
-            'company_name': self.company.name if self.company else None,
-            'assigned_driver_id': self.assigned_driver_id,
-            'driver_name': f"{self.assigned_driver.first_name} {self.assigned_driver.last_name}" if self.assigned_driver else None,
-            'manufacturer': self.manufacturer,
-            'model': self.model,
-            'weight': self.weight,
-            'department': self.department,
-            'car_type': self.car_type,
-            'carrier_license_expiry_date': self.carrier_license_expiry_date.isoformat() if self.carrier_license_expiry_date else None,
-            'internal_number': self.internal_number,
-            'chassis_number': self.chassis_number,
-            'odometer_reading': self.odometer_reading,
-            'production_year': self.production_year,
-            'license_expiry_date': self.license_expiry_date.isoformat() if self.license_expiry_date else None,
-            'last_safety_inspection': self.last_safety_inspection.isoformat() if self.last_safety_inspection else None,
-            'next_safety_inspection': self.next_safety_inspection.isoformat() if self.next_safety_inspection else None,
-            'hova_insurance_expiry_date': self.hova_insurance_expiry_date.isoformat() if self.hova_insurance_expiry_date else None,
-            'mekif_insurance_expiry_date': self.mekif_insurance_expiry_date.isoformat() if self.mekif_insurance_expiry_date else None,
-            'special_equipment_expiry_date': self.special_equipment_expiry_date.isoformat() if self.special_equipment_expiry_date else None,
-            'hazardous_license_expiry_date': self.hazardous_license_expiry_date.isoformat() if self.hazardous_license_expiry_date else None,
-            'tachograph_expiry_date': self.tachograph_expiry_date.isoformat() if self.tachograph_expiry_date else None,
-            'winter_inspection_expiry_date': self.winter_inspection_expiry_date.isoformat() if self.winter_inspection_expiry_date else None,
-            'brake_inspection_expiry_date': self.brake_inspection_expiry_date.isoformat() if self.brake_inspection_expiry_date else None,
-            'equipment': self.equipment,
-            'has_tow_hook': self.has_tow_hook,
-            'is_operational': self.is_operational,
-            'notes': self.notes
-        }
+    schema = Schema({
+        'id': Field('int', writable=False),
+        'license_plate': Field(required=True, unique=True),
+        'company_id': Field('int', references=Company),
+        'company_name': Computed('obj.company.name if obj.company else None', dictionary=True),
+        'assigned_driver_id': Field('int'),
+        'driver_name': Computed('f"{obj.assigned_driver.first_name} {obj.assigned_driver.last_name}" if obj.assigned_driver else None'),
+        'manufacturer': Field(dictionary=True),
+        'model': Field(dictionary=True),
+        'weight': Field('int'),
+        'department': Field(dictionary=True),
+        'car_type': Field(dictionary=True),
+        'carrier_license_expiry_date': Field('date'),
+        'internal_number': Field('int'),
+        'chassis_number': Field(),
+        'odometer_reading': Field('int'),
+        'production_year': Field('int'),
+        'license_expiry_date': Field('date'),
+        'last_safety_inspection': Field('date'),
+        'next_safety_inspection': Field('date'),
+        'hova_insurance_expiry_date': Field('date'),
+        'mekif_insurance_expiry_date': Field('date'),
+        'special_equipment_expiry_date': Field('date'),
+        'hazardous_license_expiry_date': Field('date'),
+        'tachograph_expiry_date': Field('date'),
+        'winter_inspection_expiry_date': Field('date'),
+        'brake_inspection_expiry_date': Field('date'),
+        'equipment': Field(),
+        'has_tow_hook': Field('bool'),
+        'is_operational': Field('bool', default=True),
+        'notes': Field(),
+        'updated_at': Field('datetime', writable=False),
+        'version': Field('int', writable=False)
+    })
+    to_dict = schema.to_dict
     
     def is_expired(self, field='license_expiry_date'):
         """Check if a date field is expired"""
@@ -162,41 +190,55 @@ class Driver(db.Model):
     email = Column(Text)
     notes = Column(Text)
     
+    # Stamped on every write by versioning.py for delta sync
+    updated_at = Column(DateTime)
+    version = Column(BigInteger, index=True)
+    
     # Relationships
     company = relationship('Company', back_populates='drivers')
     assigned_vehicle = relationship('Vehicle', back_populates='assigned_driver', uselist=False, foreign_keys='Vehicle.assigned_driver_id')
     files = relationship('File', back_populates='driver', cascade='all, delete-orphan')
     
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'identity_card': self.identity_card,
-            'company_id': self.company_id,
-            'company_name': self.company.name if self.company else None,
-            'first_name': self.first_name,
-            'last_name': self.last_name,
-            'full_name': f"{self.first_name} {self.last_name}" if self.first_name and self.last_name else None,
-            'license_class': self.license_class,
-            'license_expiry_date': self.license_expiry_date.isoformat() if self.license_expiry_date else None,
-            'traffic_info_expiry_date': self.traffic_info_expiry_date.isoformat() if self.traffic_info_expiry_date else None,
-            'address': self.address,
-            'phone_mobile': self.phone_mobile,
-            'phone_home': self.phone_home,
-            'job_title': self.job_title,
-            'work_location': self.work_location,
-            'marital_status': self.marital_status,
-            'birth_date': self.birth_date.isoformat() if self.birth_date else None,
-            'employment_start_date': self.employment_start_date.isoformat() if self.employment_start_date else None,
-            'education': self.education,
-            'was_license_revoked': self.was_license_revoked,
-            'has_hazardous_materials_permit': self.has_hazardous_materials_permit,
-            'has_crane_operation_permit': self.has_crane_operation_permit,
-            'personal_number_in_company': self.personal_number_in_company,
-            'email': self.email,
-            'notes': self.notes,
-            'vehicle_id': self.assigned_vehicle.id if self.assigned_vehicle else None,
-            'vehicle_plate': self.assigned_vehicle.license_plate if self.assigned_vehicle else None
-        }
+    __table_args__ = (
+        # Search filters and facet counts (faceting.py)
+        Index('ix_driver_license_class', 'license_class'),
+        Index('ix_driver_license_expiry_date', 'license_expiry_date'),
+        # Per-tenant lookups (tenancy.py); also serves plain company_id filters
+        Index('ix_driver_company_license_expiry', 'company_id', 'license_expiry_date'),
+    )
+    
+    schema = Schema({
+        'id': Field('int', writable=False),
+        'identity_card': Field(required=True, unique=True),
+        'company_id': Field('int', references=Company),
+        'company_name': Computed('obj.company.name if obj.company else None', dictionary=True),
+        'first_name': Field(),
+        'last_name': Field(),
+        'full_name': Computed('f"{obj.first_name} {obj.last_name}" if obj.first_name and obj.last_name else None'),
+        'license_class': Field(dictionary=True),
+        'license_expiry_date': Field('date'),
+        'traffic_info_expiry_date': Field('date'),
+        'address': Field(),
+        'phone_mobile': Field(),
+        'phone_home': Field(),
+        'job_title': Field(dictionary=True),
+        'work_location': Field(dictionary=True),
+        'marital_status': Field(dictionary=True),
+        'birth_date': Field('date'),
+        'employment_start_date': Field('date'),
+        'education': Field(dictionary=True),
+        'was_license_revoked': Field('bool', default=False),
+        'has_hazardous_materials_permit': Field('bool', default=False),
+        'has_crane_operation_permit': Field('bool', default=False),
+        'personal_number_in_company': Field(),
+        'email': Field(),
+        'notes': Field(),
+        'vehicle_id': Computed('obj.assigned_vehicle.id if obj.assigned_vehicle else None', 'int'),
+        'vehicle_plate': Computed('obj.assigned_vehicle.license_plate if obj.assigned_vehicle else None'),
+        'updated_at': Field('datetime', writable=False),
+        'version': Field('int', writable=False)
+    })
+    to_dict = schema.to_dict
     
     def is_expired(self, field='license_expiry_date'):
         """Check if a date field is expired"""
@@ -218,20 +260,229 @@ class File(db.Model):
     vehicle_id = Column(Integer, ForeignKey('vehicle.id'), nullable=True)
     driver_id = Column(Integer, ForeignKey('driver.id'), nullable=True)
     
+    # Stamped on every write by versioning.py for delta sync
+    updated_at = Column(DateTime)
+    version = Column(BigInteger, index=True)
+    
     # Relationships
     company = relationship('Company', back_populates='files')
     vehicle = relationship('Vehicle', back_populates='files')
     driver = relationship('Driver', back_populates='files')
+    document_text = relationship('FileText', uselist=False, cascade='all, delete-orphan')
+    
+    __table_args__ = (
+        Index('ix_files_company_id', 'company_id'),
+        Index('ix_files_vehicle_id', 'vehicle_id'),
+        Index('ix_files_driver_id', 'driver_id'),
+        # Storage garbage collection looks stored keys up by URL
+        Index('ix_files_file_url', 'file_url'),
+    )
+    
+    schema = Schema({
+        'id': Field('int', writable=False),
+        'filename': Field(),
+        'file_type': Field(dictionary=True),
+        'file_url': Field(required=True),
+        'uploaded_at': Field('datetime', writable=False),
+        'notes': Field(),
+        'company_id': Field('int', references=Company),
+        'vehicle_id': Field('int', references=Vehicle),
+        'driver_id': Field('int', references=Driver),
+        'updated_at': Field('datetime', writable=False),
+        'version': Field('int', writable=False)
+    })
+    to_dict = schema.to_dict
+
+class Job(db.Model):
+    __tablename__ = 'job'
+    
+    id = Column(Integer, primary_key=True)
+    name = Column(Text, nullable=False)
+    payload = Column(JSON)
+    status = Column(String(20), nullable=False, default='queued')
+    progress = Column(Integer, default=0)
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=3)
+    result = Column(JSON)
+    error = Column(Text)
+    run_after = Column(DateTime, default=datetime.utcnow)
+    locked_by = Column(Text)
+    locked_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    
+    # Workers poll for the oldest runnable job, so keep that lookup on an index
+    __table_args__ = (
+        Index('ix_job_status_run_after', 'status', 'run_after'),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'progress': self.progress,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'result': self.result,
+            'error': self.error,
+            'run_after': self.run_after.isoformat() if self.run_after else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+class ChangeEvent(db.Model):
+    __tablename__ = 'change_event'
+    
+    id = Column(Integer, primary_key=True)
+    entity_type = Column(String(20), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    action = Column(String(20), nullable=False)
+    data = Column(JSON)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Company the row belongs to, so scoped callers only see their companies' events
+    company_id = Column(Integer)
+    # Feed version clients resume from, taken from the sync_state counter at commit
+    version = Column(BigInteger)
+    
+    __table_args__ = (
+        Index('ix_change_event_version', 'version'),
+        Index('ix_change_event_company_version', 'company_id', 'version'),
+    )
+    
+    def to_dict(self):
+        return {
+            'version': self.version,
+            'entity': self.entity_type,
+            'id': self.entity_id,
+            'action': self.action,
+            'data': self.data,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+class SyncState(db.Model):
+    __tablename__ = 'sync_state'
+    
+    # Single row holding the global row-version counter
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+    # Tombstones at or below this version were pruned; older sync tokens must resync
+    purged_version = Column(BigInteger, nullable=False, default=0)
+
+class Tombstone(db.Model):
+    __tablename__ = 'tombstone'
+    
+    id = Column(Integer, primary_key=True)
+    entity_type = Column(String(20), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    version = Column(BigInteger, nullable=False, index=True)
+    deleted_at = Column(DateTime, default=datetime.utcnow)
+    # Company of the deleted row, so scoped callers only see their own deletes
+    company_id = Column(Integer)
+
+class AuditLog(db.Model):
+    __tablename__ = 'audit_log'
+    
+    # On PostgreSQL audit.py creates this table partitioned by month on changed_at
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    changed_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    entity_type = Column(String(20), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    action = Column(String(10), nullable=False)
+    actor = Column(Text)
+    # create/delete: {field: value}; update: {field: [old, new]}
+    diff = Column(JSON)
+    # Company of the row at the time of the change, for tenant scoping
+    company_id = Column(Integer)
+    
+    __table_args__ = (
+        Index('ix_audit_log_entity', 'entity_type', 'entity_id', 'changed_at'),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'changed_at': self.changed_at.isoformat() if self.changed_at else None,
+            'entity': self.entity_type,
+            'entity_id': self.entity_id,
+            'action': self.action,
+            'actor': self.actor,
+            'diff': self.diff
+        }
+
+class AssignmentHistory(db.Model):
+    __tablename__ = 'assignment_history'
+    
+    # No foreign keys: history must outlive deleted vehicles and drivers
+    id = Column(Integer, primary_key=True)
+    vehicle_id = Column(Integer, nullable=False)
+    driver_id = Column(Integer, nullable=False)
+    valid_from = Column(DateTime, nullable=False)
+    valid_to = Column(DateTime)  # NULL while the assignment is current
+    # Company of the vehicle when the period opened, for tenant scoping
+    company_id = Column(Integer)
+    
+    # Periods of one vehicle (or driver) never overlap, so the latest period starting
+    # before a point in time is the only candidate; these indexes find it directly
+    __table_args__ = (
+        Index('ix_assignment_history_vehicle', 'vehicle_id', 'valid_from'),
+        Index('ix_assignment_history_driver', 'driver_id', 'valid_from'),
+        Index('ux_assignment_history_open_vehicle', 'vehicle_id', unique=True,
+              postgresql_where=valid_to.is_(None), sqlite_where=valid_to.is_(None)),
+    )
     
     def to_dict(self):
         return {
             'id': self.id,
-            'filename': self.filename,
-            'file_type': self.file_type,
-            'file_url': self.file_url,
-            'uploaded_at': self.uploaded_at.isoformat() if self.uploaded_at else None,
-            'notes': self.notes,
-            'company_id': self.company_id,
             'vehicle_id': self.vehicle_id,
-            'driver_id': self.driver_id
+            'driver_id': self.driver_id,
+            'valid_from': self.valid_from.isoformat() if self.valid_from else None,
+            'valid_to': self.valid_to.isoformat() if self.valid_to else None
         }
+
+class ReportRow(db.Model):
+    __tablename__ = 'report_row'
+    
+    # Materialized rows of a report (reports.py), replaced on every refresh
+    id = Column(Integer, primary_key=True)
+    report = Column(String(50), nullable=False)
+    position = Column(Integer, nullable=False)
+    group_key = Column(Text)
+    company_id = Column(Integer)  # owner of the row, for tenant-scoped reads
+    data = Column(JSON, nullable=False)
+    
+    __table_args__ = (
+        Index('ix_report_row_report_position', 'report', 'position'),
+        Index('ix_report_row_report_group', 'report', 'group_key'),
+        Index('ix_report_row_report_company', 'report', 'company_id', 'position'),
+    )
+
+class ReportState(db.Model):
+    __tablename__ = 'report_state'
+    
+    name = Column(String(50), primary_key=True)
+    refreshed_at = Column(DateTime)
+    source_version = Column(BigInteger)  # sync version the rows were computed at
+    row_count = Column(Integer, default=0)
+    groups = Column(JSON)  # [{'key': ..., 'count': ...}]
+    
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'refreshed_at': self.refreshed_at.isoformat() if self.refreshed_at else None,
+            'source_version': self.source_version,
+            'row_count': self.row_count,
+            'groups': self.groups or []
+        }
+
+# Text extracted from uploaded documents for full-text search (see documents.py)
+class FileText(db.Model):
+    __tablename__ = 'file_text'
+    
+    file_id = Column(Integer, ForeignKey('files.id', ondelete='CASCADE'), primary_key=True)
+    status = Column(String(20), nullable=False)  # indexed, empty, unsupported, failed
+    content = Column(Text)
+    error = Column(Text)
+    extracted_at = Column(DateTime, default=datetime.utcnow)
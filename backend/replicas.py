@@ -0,0 +1,149 @@
+"""
+Read-replica routing.
+
+With DATABASE_REPLICA_URIS set, GET and HEAD requests run their queries
+on a replica; everything else, and any request that starts writing, uses
+the primary. Views that must read from the primary are marked
+`@primary_only`.
+
+Read-your-writes: every successful write answers with `X-Data-Version`,
+the global sync version after the commit (see versioning.py), and sets it
+as a cookie. A later read sending that version (cookie or `X-Min-Version`
+header) only goes to a replica that has replicated at least that far.
+
+Replicas are health-checked at most every REPLICA_CHECK_INTERVAL seconds
+by reading their sync version; a replica that fails the check or raises
+a connection error is skipped until a later check succeeds, and reads
+fall back to the primary when no replica qualifies.
+
+Locally, a read-only connection to the primary's SQLite file stands in for
+a replica: DATABASE_REPLICA_URIS=sqlite:///file:/path/ziv.db?mode=ro&uri=true
+"""
+from flask import request, current_app
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+REPLICA_KEY = 'replica_bind'
+VERSION_COOKIE = 'min_version'
+
+
+class RoutingSession(FlaskSession):
+    """Session that sends reads to the replica chosen for the request"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = self.info.get(REPLICA_KEY)
+        if bind is None and replica is not None and not self._flushing:
+            return self._db.engines[replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(Session, 'before_flush')
+def _writes_use_primary(session, flush_context, instances):
+    # Reads after a write in the same request must see it
+    session.info.pop(REPLICA_KEY, None)
+
+
+def primary_only(view):
+    """Always run a GET view against the primary"""
+    view.primary_only = True
+    return view
+
+
+class ReplicaHealth:
+    """Last known state of each replica in this process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}  # bind key -> (healthy, version, checked_at)
+
+    def mark_down(self, name):
+        with self.lock:
+            self.states[name] = (False, 0, time.monotonic())
+
+    def check(self, db, name, interval):
+        with self.lock:
+            state = self.states.get(name)
+            if state is not None and time.monotonic() - state[2] < interval:
+                return state
+        try:
+            with db.engines[name].connect() as conn:
+                version = conn.execute(text('SELECT version FROM sync_state WHERE id = 1')).scalar() or 0
+            state = (True, version, time.monotonic())
+        except Exception as e:
+            logger.warning('Replica %s failed its health check: %s', name, e)
+            state = (False, 0, time.monotonic())
+        with self.lock:
+            self.states[name] = state
+        return state
+
+
+health = ReplicaHealth()
+
+
+def choose_replica(db, min_version):
+    """A healthy replica caught up to `min_version`, or None for the primary"""
+    interval = current_app.config['REPLICA_CHECK_INTERVAL']
+    candidates = []
+    for name in current_app.config['REPLICA_BINDS']:
+        healthy, version, _ = health.check(db, name, interval)
+        if healthy and version >= min_version:
+            candidates.append(name)
+    return random.choice(candidates) if candidates else None
+
+
+def _requested_min_version():
+    value = request.headers.get('X-Min-Version') or request.cookies.get(VERSION_COOKIE)
+    try:
+        return int(value) if value else 0
+    except ValueError:
+        return 0
+
+
+def init_replicas(app, db):
+    replicas = app.config['REPLICA_BINDS']
+    if not replicas:
+        return
+
+    def _on_error(name):
+        def handle_error(context):
+            if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+                health.mark_down(name)
+        return handle_error
+
+    with app.app_context():
+        for name in replicas:
+            event.listen(db.engines[name], 'handle_error', _on_error(name))
+
+    @app.before_request
+    def _route_reads():
+        if request.method not in ('GET', 'HEAD'):
+            return
+        view = app.view_functions.get(request.endpoint)
+        if view is None or getattr(view, 'primary_only', False):
+            return
+        replica = choose_replica(db, _requested_min_version())
+        if replica is not None:
+            db.session.info[REPLICA_KEY] = replica
+
+    @app.after_request
+    def _remember_write_version(response):
+        if request.method in ('GET', 'HEAD', 'OPTIONS') or response.status_code >= 400:
+            return response
+        db.session.info.pop(REPLICA_KEY, None)
+        version = db.session.execute(text('SELECT version FROM sync_state WHERE id = 1')).scalar() or 0
+        response.headers['X-Data-Version'] = str(version)
+        response.set_cookie(VERSION_COOKIE, str(version), max_age=app.config['REPLICA_STICKY_SECONDS'],
+                            httponly=True, samesite='Lax')
+        return response
+
+    @app.teardown_request
+    def _release_replica(exc):
+        db.session.info.pop(REPLICA_KEY, None)
@@ -0,0 +1,237 @@
+"""
+Operational reports served from summary tables.
+
+Each report is declared once as a `Report`: the model it lists, a filter,
+the columns to keep and the field rows are grouped by. Refreshing a report
+runs its query once and stores the rows in `report_row` with per-group
+counts in `report_state`, so reading a page is an indexed range scan
+instead of a full scan of the fleet.
+
+Reports are refreshed by the `reports.refresh` job shortly after any
+company, vehicle or driver write (debounced by REPORT_REFRESH_DELAY) and
+by `reports.scheduled_refresh` every REPORT_REFRESH_INTERVAL seconds,
+which also moves date-based reports past midnight without any write.
+"""
+from flask import current_app
+from models import db, Company, Vehicle, Driver, Job, ReportRow, ReportState
+from jobs import job_handler, enqueue, enqueue_unless_pending, report_progress
+from versioning import current_version
+from tenancy import current_tenant, unscoped
+from sqlalchemy import event, func, or_, and_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from datetime import date, datetime, timedelta
+import csv
+import io
+import itertools
+
+# Writes to these models may change report contents
+SOURCE_MODELS = (Company, Vehicle, Driver)
+
+
+class Report:
+    """A saved query over one model, grouped by one of its output fields"""
+
+    def __init__(self, name, title, model, where, columns, group_by):
+        self.name = name
+        self.title = title
+        self.model = model
+        self.where = where  # today -> SQL filter
+        self.columns = columns
+        self.group_by = group_by
+
+    def compute(self, today):
+        """Rows of the report as (group_key, company_id, data) in output order"""
+        objs = self.model.query.filter(self.where(today)).order_by(self.model.id).all()
+        rows = []
+        for obj in objs:
+            data = obj.to_dict()
+            data = {column: data[column] for column in self.columns}
+            group_key = data[self.group_by]
+            rows.append((None if group_key is None else str(group_key), obj.company_id, data))
+        # Groups in name order, rows without a group last
+        rows.sort(key=lambda row: (row[0] is None, row[0] or ''))
+        return rows
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'title': self.title,
+            'columns': self.columns,
+            'group_by': self.group_by
+        }
+
+
+REPORTS = {report.name: report for report in [
+    Report(
+        'expired_insurance',
+        'Vehicles with expired insurance, per company',
+        Vehicle,
+        lambda today: or_(Vehicle.hova_insurance_expiry_date < today, Vehicle.mekif_insurance_expiry_date < today),
+        ['id', 'license_plate', 'company_id', 'company_name', 'hova_insurance_expiry_date',
+         'mekif_insurance_expiry_date'],
+        'company_name'
+    ),
+    Report(
+        'hazmat_drivers_expired_license',
+        'Drivers with a hazardous materials permit and an expired license, per company',
+        Driver,
+        lambda today: and_(Driver.has_hazardous_materials_permit.is_(True), Driver.license_expiry_date < today),
+        ['id', 'identity_card', 'full_name', 'company_id', 'company_name', 'license_class',
+         'license_expiry_date', 'vehicle_plate'],
+        'company_name'
+    ),
+    Report(
+        'non_operational_vehicles',
+        'Non-operational vehicles by department',
+        Vehicle,
+        lambda today: Vehicle.is_operational.is_(False),
+        ['id', 'license_plate', 'department', 'company_name', 'car_type', 'manufacturer', 'model', 'notes'],
+        'department'
+    ),
+]}
+
+
+def _lock_state(name):
+    """The state row of a report, locked until commit; created first on PostgreSQL so there is a row to lock"""
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(postgresql.insert(ReportState.__table__).values(name=name).on_conflict_do_nothing())
+    return (db.session.query(ReportState).filter_by(name=name)
+            .with_for_update().populate_existing().first()) or ReportState(name=name)
+
+
+def refresh_report(report, today=None):
+    """Recompute a report and replace its stored rows in one transaction"""
+    today = today or date.today()
+    # Refreshes of one report take turns; otherwise each would delete only the rows
+    # it saw and both would insert theirs. SQLite already serializes the writes.
+    state = _lock_state(report.name)
+    # Read before the query, so the rows are at least as new as this version
+    source_version = current_version()
+    # Stored rows serve every tenant, so they are computed over all companies
+    with unscoped():
+        rows = report.compute(today)
+
+    ReportRow.query.filter_by(report=report.name).delete(synchronize_session=False)
+    if rows:
+        db.session.execute(ReportRow.__table__.insert(), [
+            {'report': report.name, 'position': position, 'group_key': group_key, 'company_id': company_id, 'data': data}
+            for position, (group_key, company_id, data) in enumerate(rows)
+        ])
+
+    state.refreshed_at = datetime.utcnow()
+    state.source_version = source_version
+    state.row_count = len(rows)
+    state.groups = [{'key': key, 'count': len(list(group))}
+                    for key, group in itertools.groupby(rows, key=lambda row: row[0])]
+    db.session.add(state)
+    db.session.commit()
+    return state
+
+
+def is_stale(state):
+    """Whether data changed, or the day turned, since the report was computed"""
+    if state is None or state.refreshed_at is None:
+        return True
+    return state.source_version < current_version() or state.refreshed_at.date() < date.today()
+
+
+def _rows(report, group=None):
+    query = ReportRow.query.filter_by(report=report.name)
+    tenant = current_tenant()
+    if tenant is not None:
+        query = query.filter(ReportRow.company_id.in_(tenant))
+    if group is not None:
+        query = query.filter_by(group_key=group or None)
+    return query
+
+
+def report_groups(report):
+    """Row counts per group, limited to the caller's companies"""
+    counts = (db.session.query(ReportRow.group_key, func.count())
+              .filter(ReportRow.id.in_(_rows(report).with_entities(ReportRow.id)))
+              .group_by(ReportRow.group_key)
+              .all())
+    counts.sort(key=lambda item: (item[0] is None, item[0] or ''))
+    return [{'key': key, 'count': count} for key, count in counts]
+
+
+def report_page(report, page=1, per_page=100, group=None):
+    """Stored rows of a report; returns (items, has_more)"""
+    rows = _rows(report, group).order_by(ReportRow.position).offset((page - 1) * per_page).limit(per_page + 1).all()
+    return [row.data for row in rows[:per_page]], len(rows) > per_page
+
+
+def export_csv(report, group=None):
+    """Yield the stored rows of a report as CSV, a chunk of rows at a time"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=report.columns)
+    writer.writeheader()
+    for row in _rows(report, group).order_by(ReportRow.position).yield_per(500):
+        writer.writerow(row.data)
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+# --- Refresh scheduling ---
+
+def _queued(name, statuses=('queued',), before=None):
+    query = Job.query.filter(Job.name == name, Job.status.in_(statuses))
+    if before is not None:
+        query = query.filter(Job.run_after <= before)
+    return db.session.query(query.exists()).scalar()
+
+
+def _touches_sources(objs):
+    return any(isinstance(obj, SOURCE_MODELS) for obj in objs)
+
+
+@event.listens_for(Session, 'before_flush')
+def _note_source_writes(session, flush_context, instances):
+    if _touches_sources(itertools.chain(session.new, session.dirty, session.deleted)):
+        session.info['reports_dirty'] = True
+
+
+@event.listens_for(Session, 'before_commit')
+def _schedule_refresh_on_write(session):
+    dirty = session.info.pop('reports_dirty', False)
+    if not dirty and not _touches_sources(itertools.chain(session.new, session.dirty, session.deleted)):
+        return
+    delay = current_app.config.get('REPORT_REFRESH_DELAY', 30)
+    with session.no_autoflush:
+        # One queued refresh covers every write until it starts
+        if _queued('reports.refresh', before=datetime.utcnow() + timedelta(seconds=delay)):
+            return
+        enqueue('reports.refresh', delay=delay, commit=False)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_source_writes(session):
+    session.info.pop('reports_dirty', None)
+
+
+@job_handler('reports.refresh')
+def refresh_reports_job(payload):
+    """Refresh every report, or the ones named in payload['reports']"""
+    names = [name for name in payload.get('reports') or list(REPORTS) if name in REPORTS]
+    refreshed = {}
+    for done, name in enumerate(names):
+        refreshed[name] = refresh_report(REPORTS[name]).row_count
+        report_progress(100 * (done + 1) / len(names))
+    return {'refreshed': refreshed}
+
+
+@job_handler('reports.scheduled_refresh')
+def scheduled_refresh_job(payload):
+    """Refresh all reports, then queue the next run"""
+    result = refresh_reports_job({})
+    enqueue('reports.scheduled_refresh', delay=current_app.config.get('REPORT_REFRESH_INTERVAL', 3600))
+    return result
+
+
+def ensure_report_schedule():
+    """Start the scheduled refresh chain unless it is already queued"""
+    enqueue_unless_pending('reports.scheduled_refresh')
@@ -0,0 +1,94 @@
+"""
+Database preparation at application startup.
+
+DB_SCHEMA_MODE picks what create_app does with the schema:
+
+- `create` (default): create missing tables, indexes, partitions and seed
+  rows on every start; convenient in development.
+- `check`: one catalog query confirming every table exists, so a worker
+  fails fast on an unmigrated database instead of on its first request.
+- `skip`: no schema work at all.
+
+In production run `flask --app app init-db` once per deploy and start the
+web and job workers with `check` or `skip`; a new worker then only imports
+the code and opens its pool.
+
+DB_POOL_WARM opens that many connections during startup so the first
+requests do not pay for connecting. With gunicorn, do not combine it with
+`--preload`: connections opened before the fork must not be shared.
+"""
+from models import db
+from sqlalchemy import inspect
+import threading
+
+SCHEMA_MODES = ('create', 'check', 'skip')
+
+
+def prepare_database():
+    """Create or upgrade everything the application expects in the database"""
+    # The audit table is partitioned on PostgreSQL, so it is created by hand first
+    from audit import prepare_audit_table
+    prepare_audit_table()
+    # Replica binds only serve reads; the schema is created on the primary
+    db.create_all(bind_key=None)
+    from audit import ensure_partition_schedule
+    ensure_partition_schedule()
+
+    # Importing versioning registers the flush hook that stamps row versions
+    from versioning import ensure_versions, ensure_tombstone_pruning
+    ensure_versions()
+    ensure_tombstone_pruning()
+
+    from changes import ensure_change_feed
+    ensure_change_feed()
+
+    from assignments import ensure_assignment_history, ensure_unique_assignments
+    ensure_assignment_history()
+    ensure_unique_assignments()
+
+    from faceting import ensure_search_indexes
+    ensure_search_indexes()
+
+    from tenancy import ensure_tenant_indexes
+    ensure_tenant_indexes()
+
+    # Importing documents registers the extract-on-upload hook and extraction jobs
+    from documents import ensure_document_search
+    ensure_document_search()
+
+    # Importing reports registers the refresh-on-write hook and report jobs
+    from reports import ensure_report_schedule
+    ensure_report_schedule()
+
+    from storage_gc import ensure_storage_gc
+    ensure_storage_gc()
+
+
+def check_database():
+    """Raise if a table of the models is missing from the primary database"""
+    existing = set(inspect(db.engine).get_table_names())
+    missing = sorted(set(db.metadata.tables) - existing)
+    if missing:
+        raise RuntimeError(f"Missing tables: {', '.join(missing)}. "
+                           f"Run 'flask --app app init-db' or start with DB_SCHEMA_MODE=create.")
+
+
+def warm_pool(engine, size):
+    """Open `size` connections at once and return them to the pool"""
+    if size <= 0:
+        return
+    connections = []
+    lock = threading.Lock()
+
+    def connect():
+        connection = engine.connect()
+        with lock:
+            connections.append(connection)
+
+    threads = [threading.Thread(target=connect) for _ in range(size)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for connection in connections:
+        connection.close()
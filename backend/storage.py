@@ -0,0 +1,221 @@
+"""
+Storage for uploaded files.
+
+Uploads are stored under a key such as `vehicles/<uuid>.pdf`; a File row
+keeps it as `file_url` = `/uploads/<key>`. STORAGE_BACKEND picks where the
+bytes live:
+
+- `local` (default): files under UPLOAD_FOLDER, downloads streamed by Flask.
+- `s3`: an S3-compatible bucket (S3_BUCKET, optionally S3_ENDPOINT_URL for
+  MinIO and S3_PREFIX). Downloads redirect to a presigned URL valid for
+  STORAGE_URL_EXPIRY seconds, so file bytes never pass through the API
+  workers. Credentials come from the usual AWS environment variables.
+  Requires `pip install boto3`.
+
+Reads and writes are streamed; uploads are never held in memory whole.
+"""
+from flask import current_app
+from datetime import datetime
+import os
+import shutil
+import uuid
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+URL_PREFIX = '/uploads/'
+CHUNK_SIZE = 64 * 1024
+
+
+class StorageError(Exception):
+    """A storage backend is misconfigured"""
+
+
+class Storage:
+    """Interface of a storage backend; keys are '/'-separated relative paths"""
+
+    def save(self, key, stream, content_type=None):
+        raise NotImplementedError
+
+    def open(self, key):
+        """Readable binary file object; raises FileNotFoundError"""
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove a key; missing keys are ignored"""
+        raise NotImplementedError
+
+    def url(self, key, filename, expires):
+        """Direct download URL, or None when downloads must go through the API"""
+        return None
+
+    def move(self, key, new_key):
+        """Rename a key; its last modified time becomes now"""
+        raise NotImplementedError
+
+    def keys(self, prefix='', start_after=None):
+        """Yield (key, last modified datetime) of every stored key under `prefix`,
+        in key order, starting after the key `start_after`"""
+        raise NotImplementedError
+
+
+class LocalStorage(Storage):
+    """Files in a directory on this host"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f'Invalid storage key: {key}')
+        return path
+
+    def save(self, key, stream, content_type=None):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write next to the target and rename, so readers never see a partial file
+        partial = f'{path}.{uuid.uuid4().hex}.part'
+        try:
+            with open(partial, 'wb') as out:
+                shutil.copyfileobj(stream, out, CHUNK_SIZE)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def move(self, key, new_key):
+        path = self.path(new_key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.path(key), path)
+        os.utime(path)
+
+    def keys(self, prefix='', start_after=None):
+        return self._walk(self.root, '', prefix, start_after or '')
+
+    def _walk(self, directory, relative, prefix, start_after):
+        # A directory sorts as 'name/', so its keys come out in the same order as plain key strings
+        entries = sorted(os.scandir(directory), key=lambda entry: entry.name + '/' if entry.is_dir() else entry.name)
+        for entry in entries:
+            key = relative + entry.name
+            if entry.is_dir():
+                # Skip directories whose keys all sort before start_after or outside prefix
+                key += '/'
+                if (key < start_after and not start_after.startswith(key)) or not (key.startswith(prefix) or prefix.startswith(key)):
+                    continue
+                yield from self._walk(entry.path, key, prefix, start_after)
+            elif key > start_after and key.startswith(prefix):
+                try:
+                    modified = entry.stat().st_mtime
+                except FileNotFoundError:
+                    # Deleted since the directory was listed
+                    continue
+                yield key, datetime.utcfromtimestamp(modified)
+
+
+class S3Storage(Storage):
+    """Objects in an S3-compatible bucket"""
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None):
+        if boto3 is None:
+            raise StorageError('STORAGE_BACKEND=s3 requires boto3 (pip install boto3)')
+        if not bucket:
+            raise StorageError('STORAGE_BACKEND=s3 requires S3_BUCKET')
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.client = boto3.client('s3', endpoint_url=endpoint_url or None, region_name=region or None)
+
+    def save(self, key, stream, content_type=None):
+        extra = {'ContentType': content_type} if content_type else None
+        # Multipart for large files, reading the stream a part at a time
+        self.client.upload_fileobj(stream, self.bucket, self.prefix + key, ExtraArgs=extra)
+
+    def open(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                raise FileNotFoundError(key) from e
+            raise
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return False
+            raise
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def url(self, key, filename, expires):
+        return self.client.generate_presigned_url('get_object', ExpiresIn=expires, Params={
+            'Bucket': self.bucket,
+            'Key': self.prefix + key,
+            'ResponseContentDisposition': f'attachment; filename="{filename}"'
+        })
+
+    def move(self, key, new_key):
+        self.client.copy_object(Bucket=self.bucket, Key=self.prefix + new_key,
+                                CopySource={'Bucket': self.bucket, 'Key': self.prefix + key})
+        self.delete(key)
+
+    def keys(self, prefix='', start_after=None):
+        # S3 lists keys in UTF-8 byte order, which is the order of Python strings
+        extra = {'StartAfter': self.prefix + start_after} if start_after else {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix, **extra):
+            for item in page.get('Contents', []):
+                yield item['Key'][len(self.prefix):], item['LastModified'].replace(tzinfo=None)
+
+
+def make_storage(config):
+    backend = config['STORAGE_BACKEND']
+    if backend == 'local':
+        return LocalStorage(config['UPLOAD_FOLDER'])
+    if backend == 's3':
+        return S3Storage(config['S3_BUCKET'], config['S3_PREFIX'], config['S3_ENDPOINT_URL'], config['S3_REGION'])
+    raise StorageError(f'Unknown STORAGE_BACKEND: {backend}')
+
+
+def get_storage():
+    return current_app.extensions['storage']
+
+
+def storage_key(file_url):
+    """Storage key of a File row's file_url, or None for URLs outside storage"""
+    if file_url and file_url.startswith(URL_PREFIX):
+        return file_url[len(URL_PREFIX):]
+    return None
+
+
+def save_upload(upload, folder):
+    """Store an uploaded file under `folder`; returns (file_url, extension)"""
+    ext = upload.filename.rsplit('.', 1)[1].lower()
+    key = f'{folder}/{uuid.uuid4()}.{ext}'
+    get_storage().save(key, upload.stream, upload.content_type)
+    return URL_PREFIX + key, ext
+
+
+def init_storage(app):
+    app.extensions['storage'] = make_storage(app.config)
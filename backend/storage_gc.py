@@ -0,0 +1,223 @@
+"""
+Garbage collection of uploaded files and storage consistency checks.
+
+Deleting a company, vehicle or driver deletes its File rows but not their
+bytes. An upload whose transaction fails after the file was stored leaves
+its bytes behind too. A collection reconciles the files table with
+storage in two passes:
+
+1. Orphans: stored keys are read in key order and looked up by file_url in
+   batches. GC_MODE decides what happens to keys that no File row refers
+   to:
+   - `quarantine` (default) moves them under `_quarantine/`, where they
+     are deleted after GC_QUARANTINE_DAYS.
+   - `delete` removes them.
+   - `report` only counts them.
+   Some keys are always left alone:
+   - Keys newer than GC_GRACE_SECONDS, which may belong to uploads that
+     are still committing.
+   - Staged uploads while a queued request job still refers to them.
+2. Missing files: File rows are read in id order, and those whose bytes
+   are not in storage are reported.
+
+Each `storage.gc` job handles at most GC_BATCH_SIZE keys or rows, using a
+short read transaction per batch, then queues the next job with its
+position. No lock is held for long, and a collection interrupted by a
+worker restart carries on where it stopped. The last job's result is the
+report, and the next collection is queued GC_INTERVAL seconds later.
+
+`flask --app app storage-gc [--dry-run]` runs a whole collection at once.
+Restore a quarantined file by moving `_quarantine/<key>` back to `<key>`.
+"""
+from flask import current_app
+from models import db, File, Job
+from jobs import job_handler, enqueue, enqueue_unless_pending, report_progress, STAGING_PREFIX
+from storage import get_storage, storage_key, URL_PREFIX
+from sqlalchemy import select
+from datetime import datetime, timedelta
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+GC_MODES = ('quarantine', 'delete', 'report')
+
+QUARANTINE_PREFIX = '_quarantine/'
+
+# Keys or rows per query
+LOOKUP_BATCH = 200
+
+# Orphan keys and missing file ids listed in a report; the counts cover all of them
+REPORT_SAMPLE = 100
+
+
+def new_collection(mode):
+    if mode not in GC_MODES:
+        raise ValueError(f"GC_MODE must be one of {', '.join(GC_MODES)}")
+    return {
+        'phase': 'orphans',
+        'after': None,
+        'report': {
+            'mode': mode,
+            'started_at': datetime.utcnow().isoformat(),
+            'keys_scanned': 0,
+            'recent': 0,
+            'orphans': 0,
+            'purged': 0,
+            'files_checked': 0,
+            'missing': 0,
+            'outside_storage': 0,
+            'orphan_keys': [],
+            'missing_files': []
+        }
+    }
+
+
+def _sample(report, name, value):
+    if len(report[name]) < REPORT_SAMPLE:
+        report[name].append(value)
+
+
+def _staged_keys():
+    """Staged uploads of request jobs that have not finished"""
+    payloads = db.session.execute(
+        select(Job.payload).where(Job.name == 'http.replay', Job.status.in_(('queued', 'running')))
+    ).scalars()
+    return {f['key'] for payload in payloads for f in (payload or {}).get('files', []) if 'key' in f}
+
+
+def _referenced(keys):
+    """The subset of `keys` some File row refers to"""
+    if not keys:
+        return set()
+    urls = db.session.execute(
+        select(File.file_url).where(File.file_url.in_([URL_PREFIX + key for key in keys]))
+        .execution_options(all_tenants=True)
+    ).scalars()
+    return {storage_key(url) for url in urls}
+
+
+def _collect_orphans(storage, report, after, limit):
+    """Handle up to `limit` keys after the key `after`; returns the last key, or None at the end"""
+    config = current_app.config
+    now = datetime.utcnow()
+    recent_since = now - timedelta(seconds=config['GC_GRACE_SECONDS'])
+    purge_before = now - timedelta(days=config['GC_QUARANTINE_DAYS'])
+    mode = report['mode']
+    keys = itertools.islice(storage.keys(start_after=after), limit)
+    staged = None
+    seen = 0
+    while True:
+        batch = list(itertools.islice(keys, LOOKUP_BATCH))
+        if not batch:
+            break
+        seen += len(batch)
+        after = batch[-1][0]
+        candidates = []
+        for key, modified in batch:
+            if key.startswith(QUARANTINE_PREFIX):
+                if modified < purge_before and mode != 'report':
+                    storage.delete(key)
+                    report['purged'] += 1
+            elif modified > recent_since:
+                report['recent'] += 1
+            else:
+                candidates.append(key)
+
+        if staged is None and any(key.startswith(STAGING_PREFIX) for key in candidates):
+            staged = _staged_keys()
+        referenced = _referenced([key for key in candidates if not key.startswith(STAGING_PREFIX)])
+        # End the read transaction before touching storage
+        db.session.commit()
+
+        for key in candidates:
+            if key in referenced or key in (staged or ()):
+                continue
+            if mode == 'delete':
+                storage.delete(key)
+            elif mode == 'quarantine':
+                storage.move(key, QUARANTINE_PREFIX + key)
+            report['orphans'] += 1
+            _sample(report, 'orphan_keys', key)
+        report['keys_scanned'] += len(batch)
+        report_progress(100 * seen / limit)
+    return after if seen == limit else None
+
+
+def _check_files(storage, report, after, limit):
+    """Check up to `limit` File rows after id `after`; returns the last id, or None at the end"""
+    checked = 0
+    while checked < limit:
+        size = min(LOOKUP_BATCH, limit - checked)
+        rows = db.session.execute(
+            select(File.id, File.file_url).where(File.id > after).order_by(File.id).limit(size)
+            .execution_options(all_tenants=True)
+        ).all()
+        db.session.commit()
+        for file_id, file_url in rows:
+            key = storage_key(file_url)
+            if key is None:
+                report['outside_storage'] += 1
+            elif not storage.exists(key):
+                report['missing'] += 1
+                _sample(report, 'missing_files', file_id)
+        report['files_checked'] += len(rows)
+        checked += len(rows)
+        report_progress(100 * checked / limit)
+        if len(rows) < size:
+            return None
+        after = rows[-1][0]
+    return after
+
+
+def collect_step(state):
+    """Run one bounded step of a collection; returns the state of the next step, or None when it is done"""
+    storage = get_storage()
+    report = state['report']
+    limit = current_app.config['GC_BATCH_SIZE']
+    if state['phase'] == 'orphans':
+        after = _collect_orphans(storage, report, state['after'], limit)
+        if after is not None:
+            return {**state, 'after': after}
+        return {**state, 'phase': 'missing', 'after': 0}
+
+    after = _check_files(storage, report, state['after'], limit)
+    if after is not None:
+        return {**state, 'after': after}
+    report['finished_at'] = datetime.utcnow().isoformat()
+    if report['missing']:
+        logger.warning('%d files have no stored bytes, e.g. file ids %s', report['missing'], report['missing_files'][:10])
+    return None
+
+
+def collect_garbage(mode=None):
+    """Run a whole collection in this process and return its report"""
+    state = new_collection(mode or current_app.config['GC_MODE'])
+    report = state['report']
+    while state is not None:
+        state = collect_step(state)
+    return report
+
+
+@job_handler('storage.gc')
+def gc_job(payload):
+    """Run one step of a collection, then queue the next step or the next collection"""
+    state = payload.get('state') or new_collection(current_app.config['GC_MODE'])
+    following = collect_step(state)
+    if following is not None:
+        enqueue('storage.gc', {'state': following})
+        return {'phase': following['phase'], 'after': following['after']}
+    if current_app.config['GC_INTERVAL'] > 0:
+        enqueue('storage.gc', delay=current_app.config['GC_INTERVAL'])
+    return state['report']
+
+
+def ensure_storage_gc():
+    """Create the file_url index and start the collection chain unless it is already queued"""
+    for index in File.__table__.indexes:
+        if index.name == 'ix_files_file_url':
+            index.create(db.engine, checkfirst=True)
+
+    if current_app.config['GC_INTERVAL'] <= 0:
+        return
+    enqueue_unless_pending('storage.gc')
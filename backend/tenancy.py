@@ -0,0 +1,166 @@
+"""
+Tenant scoping for companies and their vehicles, drivers and files.
+
+A request carrying the TENANT_HEADER (default `X-Company-Ids: 3,7`, set by
+the gateway in front of the API) only sees and writes rows of those
+companies. Every ORM query on Company, Vehicle, Driver and File gets a
+company filter through `with_loader_criteria`, relationship loads included,
+and a flush that would write a row of another company is refused with 403.
+Records about those rows (change events, tombstones, audit entries and
+assignment periods) store the company of their row when they are written;
+audit entries, periods and tombstones get the same filter, and records
+without a company, written before the column existed, are only visible
+unscoped.
+Requests without the header (internal tools, workers) are unscoped unless
+TENANT_REQUIRED is set. Views marked `@tenant_from_query`, such as the
+change stream that browsers open with EventSource (which cannot send
+headers), also take the ids as `?company_ids=3,7` when the header is
+missing; a gateway that sets the header must set or strip that parameter
+too.
+
+Queries that must see every tenant, such as global uniqueness checks, opt
+out with `.execution_options(all_tenants=True)`; `unscoped()` lifts the
+scope for a whole block.
+"""
+from flask import request, current_app, jsonify
+from models import db, Company, Vehicle, Driver, File, AuditLog, AssignmentHistory, Tombstone
+from sqlalchemy import event, inspect, select, or_, text
+from sqlalchemy.orm import Session, with_loader_criteria
+from contextlib import contextmanager
+import itertools
+
+TENANT_KEY = 'tenant_company_ids'
+
+
+class TenantError(Exception):
+    """A write outside the caller's companies"""
+
+
+def current_tenant():
+    """Company ids the current session is scoped to, or None when unscoped"""
+    return db.session.info.get(TENANT_KEY)
+
+
+@contextmanager
+def unscoped():
+    """Run a block with the current session unscoped, e.g. to compute shared data"""
+    ids = db.session.info.pop(TENANT_KEY, None)
+    try:
+        yield
+    finally:
+        if ids is not None:
+            db.session.info[TENANT_KEY] = ids
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _scope_queries(execute_state):
+    ids = execute_state.session.info.get(TENANT_KEY)
+    if ids is None or not execute_state.is_select or execute_state.execution_options.get('all_tenants'):
+        return
+    execute_state.statement = execute_state.statement.options(
+        with_loader_criteria(Company, lambda cls: cls.id.in_(ids), include_aliases=True),
+        with_loader_criteria(Vehicle, lambda cls: cls.company_id.in_(ids), include_aliases=True),
+        with_loader_criteria(Driver, lambda cls: cls.company_id.in_(ids), include_aliases=True),
+        # Files hang off a company, a vehicle or a driver
+        with_loader_criteria(File, lambda cls: or_(
+            cls.company_id.in_(ids),
+            cls.vehicle_id.in_(select(Vehicle.id).where(Vehicle.company_id.in_(ids))),
+            cls.driver_id.in_(select(Driver.id).where(Driver.company_id.in_(ids)))
+        ), include_aliases=True),
+        # Records about rows, which may outlive them
+        with_loader_criteria(AuditLog, lambda cls: cls.company_id.in_(ids), include_aliases=True),
+        with_loader_criteria(AssignmentHistory, lambda cls: cls.company_id.in_(ids), include_aliases=True),
+        with_loader_criteria(Tombstone, lambda cls: cls.company_id.in_(ids), include_aliases=True)
+    )
+
+
+def company_of(session, obj):
+    """Company id a row of Company, Vehicle, Driver or File belongs to"""
+    if isinstance(obj, Company):
+        return obj.id
+    if isinstance(obj, (Vehicle, Driver)) or obj.company_id:
+        return obj.company_id
+    parent = session.get(Vehicle, obj.vehicle_id) if obj.vehicle_id else None
+    parent = parent or (session.get(Driver, obj.driver_id) if obj.driver_id else None)
+    return parent.company_id if parent else None
+
+
+@event.listens_for(Session, 'before_flush')
+def _check_tenant_writes(session, flush_context, instances):
+    ids = session.info.get(TENANT_KEY)
+    if ids is None:
+        return
+    with session.no_autoflush:
+        for obj in itertools.chain(session.new, session.dirty, session.deleted):
+            if isinstance(obj, (Company, Vehicle, Driver, File)) and company_of(session, obj) not in ids:
+                raise TenantError(f'{type(obj).__name__} is outside your companies')
+
+
+def tenant_from_query(view):
+    """Let a view take the company ids from `?company_ids=` when the tenant header is missing"""
+    view.tenant_from_query = True
+    return view
+
+
+def parse_tenant_header(header):
+    """Company ids of a tenant header value; raises ValueError"""
+    return tuple(sorted({int(part) for part in header.split(',') if part.strip()}))
+
+
+def _bind_tenant():
+    header = request.headers.get(current_app.config['TENANT_HEADER'])
+    if header is None and getattr(current_app.view_functions.get(request.endpoint), 'tenant_from_query', False):
+        header = request.args.get('company_ids')
+    if header is None:
+        if current_app.config['TENANT_REQUIRED'] and request.method != 'OPTIONS':
+            return jsonify({'error': f"{current_app.config['TENANT_HEADER']} header is required"}), 403
+        return None
+    try:
+        ids = parse_tenant_header(header)
+    except ValueError:
+        return jsonify({'error': f"Invalid {current_app.config['TENANT_HEADER']} header"}), 400
+    db.session.info[TENANT_KEY] = ids
+    return None
+
+
+def _release_tenant(exc):
+    # Workers replay many requests on one session; never carry a scope over
+    db.session.info.pop(TENANT_KEY, None)
+
+
+def _tenant_error(error):
+    return jsonify({'error': str(error)}), 403
+
+
+def init_tenancy(app):
+    app.before_request(_bind_tenant)
+    app.teardown_request(_release_tenant)
+    app.register_error_handler(TenantError, _tenant_error)
+
+
+# Per-tenant lookups: each leads with company_id so a tenant's rows are one index range
+TENANT_INDEXES = [
+    'ix_vehicle_company_car_type',
+    'ix_vehicle_company_license_expiry',
+    'ix_driver_company_license_expiry',
+    'ix_files_company_id',
+    'ix_files_vehicle_id',
+    'ix_files_driver_id'
+]
+
+
+def add_company_column(table_name):
+    """Add company_id to a table created before it existed; returns whether it was added"""
+    if 'company_id' in {column['name'] for column in inspect(db.engine).get_columns(table_name)}:
+        return False
+    with db.engine.begin() as connection:
+        connection.execute(text(f'ALTER TABLE {table_name} ADD COLUMN company_id INTEGER'))
+    return True
+
+
+def ensure_tenant_indexes():
+    """Create the per-tenant indexes on databases created before they existed"""
+    for model in (Vehicle, Driver, File):
+        for index in model.__table__.indexes:
+            if index.name in TENANT_INDEXES:
+                index.create(db.engine, checkfirst=True)
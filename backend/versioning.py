@@ -0,0 +1,226 @@
+"""
+Row versioning for delta sync.
+
+Every insert or update of a synced model takes a fresh value from one global,
+monotonic counter (the single `sync_state` row), and every delete leaves a
+tombstone with its own version. A client that remembers the highest version
+it has seen can therefore ask for exactly what changed since then.
+
+The counter row stays locked until the writing transaction commits, so
+versions become visible in order and a reader never skips a version that
+commits later.
+
+Tombstones store the company of the deleted row, so a tenant-scoped caller
+only learns about its own deletes (see tenancy.py).
+"""
+from models import db, Company, Vehicle, Driver, File, SyncState, Tombstone
+from flask import current_app
+from jobs import job_handler, enqueue, enqueue_unless_pending
+from tenancy import company_of, add_company_column
+from sqlalchemy import event, inspect, select, update, bindparam, func, text
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+
+# Synced models and the entity names used by the sync API
+SYNC_MODELS = {
+    'company': Company,
+    'vehicle': Vehicle,
+    'driver': Driver,
+    'file': File
+}
+ENTITY_NAMES = {model: name for name, model in SYNC_MODELS.items()}
+
+
+def allocate_versions(connection, count):
+    """Reserve `count` consecutive versions and return them as a range"""
+    table = SyncState.__table__
+    connection.execute(update(table).where(table.c.id == 1).values(version=table.c.version + count))
+    last = connection.execute(select(table.c.version).where(table.c.id == 1)).scalar()
+    return range(last - count + 1, last + 1)
+
+
+def current_version():
+    """Highest version handed out so far"""
+    return db.session.query(SyncState.version).filter_by(id=1).scalar() or 0
+
+
+def _values(state, attr):
+    """Old and new non-empty values of an attribute in this flush"""
+    history = state.attrs[attr].history
+    return {v for v in (*history.deleted, *history.added, *history.unchanged) if v}
+
+
+def _dependents(session, obj, created_or_deleted):
+    """Rows whose serialized form embeds fields of `obj` and must be re-synced"""
+    state = inspect(obj)
+
+    def changed(attr):
+        return created_or_deleted or state.attrs[attr].history.has_changes()
+
+    related = []
+    # vehicles_count / drivers_count on the company
+    if isinstance(obj, (Vehicle, Driver)) and changed('company_id'):
+        related += [session.get(Company, cid) for cid in _values(state, 'company_id')]
+    # vehicle_id / vehicle_plate on the driver
+    if isinstance(obj, Vehicle) and (changed('assigned_driver_id') or changed('license_plate')):
+        related += [session.get(Driver, did) for did in _values(state, 'assigned_driver_id')]
+    # driver_name on the vehicle
+    if isinstance(obj, Driver) and obj.id and (changed('first_name') or changed('last_name')):
+        related += Vehicle.query.filter_by(assigned_driver_id=obj.id).all()
+    # company_name on vehicles and drivers
+    if isinstance(obj, Company) and obj.id and changed('name'):
+        related += Vehicle.query.filter_by(company_id=obj.id).all()
+        related += Driver.query.filter_by(company_id=obj.id).all()
+    return related
+
+
+@event.listens_for(Session, 'before_flush')
+def _stamp_versions(session, flush_context, instances):
+    created = [o for o in session.new if type(o) in ENTITY_NAMES]
+    updated = [o for o in session.dirty
+               if type(o) in ENTITY_NAMES and session.is_modified(o, include_collections=False)]
+    deleted = [o for o in session.deleted if type(o) in ENTITY_NAMES]
+    if not created and not updated and not deleted:
+        return
+
+    changed = set(created) | set(updated)
+    with session.no_autoflush:
+        for obj in created + deleted:
+            changed.update(_dependents(session, obj, True))
+        for obj in updated:
+            changed.update(_dependents(session, obj, False))
+        deleted_companies = [company_of(session, obj) for obj in deleted]
+    changed = [o for o in changed if o is not None and o not in session.deleted]
+
+    versions = iter(allocate_versions(session.connection(), len(changed) + len(deleted)))
+    now = datetime.utcnow()
+    for obj in changed:
+        obj.version = next(versions)
+        obj.updated_at = now
+    for obj, company_id in zip(deleted, deleted_companies):
+        session.add(Tombstone(entity_type=ENTITY_NAMES[type(obj)], entity_id=obj.id, version=next(versions),
+                              deleted_at=now, company_id=company_id))
+
+
+def _add_version_columns():
+    """Add updated_at and version to synced tables created before versioning existed"""
+    engine = db.engine
+    preparer = engine.dialect.identifier_preparer
+    for model in SYNC_MODELS.values():
+        table = model.__table__
+        existing = {column['name'] for column in inspect(engine).get_columns(table.name)}
+        with engine.begin() as connection:
+            for column in (table.c.updated_at, table.c.version):
+                if column.name not in existing:
+                    connection.execute(text(f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN '
+                                            f'{preparer.format_column(column)} {column.type.compile(engine.dialect)}'))
+        for index in table.indexes:
+            if index.name == f'ix_{table.name}_version':
+                index.create(engine, checkfirst=True)
+
+
+def ensure_versions():
+    """Add the version columns, the counter row and versions of rows written before versioning existed"""
+    _add_version_columns()
+    if db.session.get(SyncState, 1) is None:
+        db.session.add(SyncState(id=1, version=0, purged_version=0))
+        db.session.commit()
+    if add_company_column(Tombstone.__table__.name):
+        # Tombstones without a company cannot be scoped; tokens older than them resync instead
+        last_version = db.session.query(func.max(Tombstone.version)).scalar()
+        if last_version is not None:
+            _purge_tombstones(last_version)
+
+    connection = db.session.connection()
+    for model in SYNC_MODELS.values():
+        table = model.__table__
+        ids = [row[0] for row in connection.execute(
+            select(table.c.id).where(table.c.version.is_(None)).order_by(table.c.id)
+        )]
+        if not ids:
+            continue
+        versions = allocate_versions(connection, len(ids))
+        connection.execute(
+            update(table).where(table.c.id == bindparam('row_id')).values(version=bindparam('row_version')),
+            [{'row_id': i, 'row_version': v} for i, v in zip(ids, versions)]
+        )
+    db.session.commit()
+
+
+def changes_since(since, entity_types=None, limit=1000):
+    """Collect rows and tombstones with a version in (since, current version].
+
+    Returns (changes, deleted, token, has_more). When a type has more than
+    `limit` rows the token only advances to the last row sent for it; rows of
+    other types may then be sent again on the next page, which is harmless
+    because clients upsert by id.
+    """
+    until = current_version()
+    token = until
+    has_more = False
+    changes = {}
+    deleted = {}
+
+    for name, model in SYNC_MODELS.items():
+        if entity_types and name not in entity_types:
+            continue
+        rows = (model.query
+                .filter(model.version > since, model.version <= until)
+                .order_by(model.version)
+                .limit(limit + 1)
+                .all())
+        if len(rows) > limit:
+            rows = rows[:limit]
+            has_more = True
+            token = min(token, rows[-1].version)
+        changes[name] = [row.to_dict() for row in rows]
+
+    # A client syncing from scratch has nothing to delete
+    if since:
+        tombstones_query = Tombstone.query.filter(Tombstone.version > since, Tombstone.version <= until)
+        if entity_types:
+            tombstones_query = tombstones_query.filter(Tombstone.entity_type.in_(entity_types))
+        tombstones = tombstones_query.order_by(Tombstone.version).limit(limit + 1).all()
+        if len(tombstones) > limit:
+            tombstones = tombstones[:limit]
+            has_more = True
+            token = min(token, tombstones[-1].version)
+        for tombstone in tombstones:
+            deleted.setdefault(tombstone.entity_type, []).append(tombstone.entity_id)
+
+    return changes, deleted, token, has_more
+
+
+def prune_tombstones(max_age_days):
+    """Delete tombstones older than `max_age_days`; older sync tokens must resync"""
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+    purged_version = db.session.query(func.max(Tombstone.version)).filter(Tombstone.deleted_at < cutoff).scalar()
+    if purged_version is None:
+        return {'pruned': 0}
+    return {'pruned': _purge_tombstones(purged_version), 'purged_version': purged_version}
+
+
+def _purge_tombstones(purged_version):
+    """Delete tombstones up to `purged_version` and make older sync tokens resync; returns the count"""
+    pruned = Tombstone.query.filter(Tombstone.version <= purged_version).delete(synchronize_session=False)
+    state = db.session.get(SyncState, 1)
+    state.purged_version = max(state.purged_version, purged_version)
+    db.session.commit()
+    return pruned
+
+
+@job_handler('sync.prune_tombstones')
+def prune_tombstones_job(payload):
+    """Prune old tombstones, then queue the next run"""
+    config = current_app.config
+    result = prune_tombstones(payload.get('max_age_days', config['TOMBSTONE_MAX_AGE_DAYS']))
+    if config['TOMBSTONE_PRUNE_INTERVAL'] > 0:
+        enqueue('sync.prune_tombstones', delay=config['TOMBSTONE_PRUNE_INTERVAL'])
+    return result
+
+
+def ensure_tombstone_pruning():
+    """Start the pruning chain unless it is already queued"""
+    if current_app.config['TOMBSTONE_PRUNE_INTERVAL'] <= 0:
+        return
+    enqueue_unless_pending('sync.prune_tombstones')
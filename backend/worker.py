@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+"""
+Run background job workers
+"""
+import argparse
+from jobs import run_pool, work
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run Ziv System background job workers')
+    parser.add_argument('--processes', type=int, default=2, help='Number of worker processes')
+    parser.add_argument('--poll-interval', type=float, default=None, help='Seconds to wait when the queue is empty')
+    parser.add_argument('--burst', action='store_true', help='Process queued jobs in this process and exit')
+    args = parser.parse_args()
+
+    if args.burst:
+        from app import create_app
+        processed = work(create_app(), poll_interval=args.poll_interval, burst=True)
+        print(f"Processed {processed} job(s)")
+    else:
+        print("=" * 50)
+        print(f"Starting {args.processes} Ziv System worker process(es)")
+        print("=" * 50)
+        run_pool(processes=args.processes, poll_interval=args.poll_interval)
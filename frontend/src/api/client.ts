@@ -1,5 +1,17 @@
 const API_BASE_URL = import.meta.env.VITE_API_URL || 'http://localhost:5000/api';
 
+// Data version of our latest write; reads ask for at least this version so a
+// read replica that has not caught up yet is skipped
+let minVersion = 0;
+
+// Company ids the API is scoped to (X-Company-Ids), when the app sets them
+// itself instead of a gateway in front of the API
+let tenantIds: string | null = null;
+
+export function setTenant(companyIds: number[] | null) {
+  tenantIds = companyIds ? companyIds.join(',') : null;
+}
+
 // Helper function to handle fetch requests
 async function fetchAPI(
   endpoint: string,
@@ -7,9 +19,15 @@ async function fetchAPI(
 ): Promise<Response> {
   const url = `${API_BASE_URL}${endpoint}`;
   
-  const defaultHeaders: HeadersInit = {
+  const defaultHeaders: Record<string, string> = {
     'Content-Type': 'application/json',
   };
+  if (minVersion) {
+    defaultHeaders['X-Min-Version'] = String(minVersion);
+  }
+  if (tenantIds) {
+    defaultHeaders['X-Company-Ids'] = tenantIds;
+  }
 
   // If body is FormData, don't set Content-Type (browser will set it with boundary)
   const isFormData = options.body instanceof FormData;
@@ -17,7 +35,11 @@ async function fetchAPI(
   const config: RequestInit = {
     ...options,
     headers: isFormData
-      ? options.headers || {}
+      ? {
+          ...(minVersion ? { 'X-Min-Version': String(minVersion) } : {}),
+          ...(tenantIds ? { 'X-Company-Ids': tenantIds } : {}),
+          ...options.headers,
+        }
       : {
           ...defaultHeaders,
           ...options.headers,
@@ -25,13 +47,26 @@ async function fetchAPI(
   };
 
   try {
-    const response = await fetch(url, config);
-    
+    let response = await fetch(url, config);
+
+    // Rate limited or overloaded: wait as long as the server asks and retry a read once
+    const retryAfter = Number(response.headers.get('Retry-After'));
+    const isRead = !config.method || config.method === 'GET';
+    if ((response.status === 429 || response.status === 503) && isRead && retryAfter > 0 && retryAfter <= 5) {
+      await new Promise((resolve) => setTimeout(resolve, retryAfter * 1000));
+      response = await fetch(url, config);
+    }
+
     if (!response.ok) {
       const errorText = await response.text().catch(() => 'Unknown error');
       throw new Error(`HTTP error! status: ${response.status}, message: ${errorText}`);
     }
     
+    const version = Number(response.headers.get('X-Data-Version'));
+    if (version > minVersion) {
+      minVersion = version;
+    }
+    
     return response;
   } catch (error) {
     if (error instanceof TypeError && error.message.includes('Failed to fetch')) {
@@ -41,19 +76,66 @@ async function fetchAPI(
   }
 }
 
+// Version a list was read at; the change feed resumes from it
+function dataVersion(response: Response): number {
+  return Number(response.headers.get('X-Data-Version')) || 0;
+}
+
 // Helper to parse JSON response
-async function getJSON<T>(response: Response): Promise<{ data: T }> {
+async function getJSON<T>(response: Response): Promise<{ data: T; version: number }> {
   const data = await response.json();
-  return { data };
+  return { data, version: dataVersion(response) };
+}
+
+// Column-per-field list format (?format=columnar), see backend/columnar.py
+interface ColumnarPayload {
+  count: number;
+  facets?: Facets;
+  types: Record<string, string>;
+  columns: Record<string, any[]>;
+  dictionaries: Record<string, any[]>;
+}
+
+const DAY_MS = 24 * 60 * 60 * 1000;
+
+function decodeValue(value: any, type: string): any {
+  if (value === null) return null;
+  if (type === 'date') return new Date(value * DAY_MS).toISOString().slice(0, 10);
+  if (type === 'datetime') return new Date(value).toISOString().slice(0, 23);
+  return value;
+}
+
+// Facet counts returned by the vehicle and driver search
+export type Facets = Record<string, { value: string | number | boolean | null; count: number }[]>;
+
+// Helper to turn a columnar response back into row objects
+async function getColumnar<T>(response: Response): Promise<{ data: T[]; facets?: Facets; version: number }> {
+  const payload: ColumnarPayload = await response.json();
+  const names = Object.keys(payload.columns);
+  const data = new Array(payload.count);
+  for (let i = 0; i < payload.count; i++) {
+    const row: Record<string, any> = {};
+    for (const name of names) {
+      const dictionary = payload.dictionaries[name];
+      const value = payload.columns[name][i];
+      row[name] = dictionary && value !== null ? dictionary[value] : decodeValue(value, payload.types[name]);
+    }
+    data[i] = row;
+  }
+  return { data, facets: payload.facets, version: dataVersion(response) };
 }
 
 // Helper to build query string
 function buildQueryString(params: Record<string, any>): string {
   const searchParams = new URLSearchParams();
   Object.entries(params).forEach(([key, value]) => {
-    if (value !== undefined && value !== null) {
-      searchParams.append(key, String(value));
-    }
+    // Arrays repeat the parameter, e.g. car_type=truck&car_type=van
+    const values = Array.isArray(value) ? value : [value];
+    values.forEach((item) => {
+      if (item !== undefined && item !== null) {
+        searchParams.append(key, String(item));
+      }
+    });
   });
   const queryString = searchParams.toString();
   return queryString ? `?${queryString}` : '';
@@ -146,9 +228,34 @@ export interface Driver {
   vehicle_plate?: string;
 }
 
+export interface ChangeEvent<T = any> {
+  version: number;
+  entity: 'company' | 'vehicle' | 'driver' | 'file';
+  id: number;
+  action: 'create' | 'update' | 'delete' | 'assign';
+  data: T | null;
+  created_at: string;
+}
+
+// Apply a change event to a cached list instead of re-downloading it
+export function applyChange<T extends { id: number }>(items: T[], event: ChangeEvent<T>, addCreated = true): T[] {
+  if (event.action === 'delete') {
+    return items.filter((item) => item.id !== event.id);
+  }
+  if (!event.data) return items;
+
+  const index = items.findIndex((item) => item.id === event.id);
+  if (index === -1) {
+    return addCreated ? [...items, event.data] : items;
+  }
+  const next = [...items];
+  next[index] = event.data;
+  return next;
+}
+
 // Companies API
 export const companiesApi = {
-  getAll: async (): Promise<{ data: Company[] }> => {
+  getAll: async (): Promise<{ data: Company[]; version: number }> => {
     const response = await fetchAPI('/companies');
     return getJSON<Company[]>(response);
   },
@@ -199,9 +306,9 @@ export const companiesApi = {
 
 // Vehicles API
 export const vehiclesApi = {
-  getAll: async (): Promise<{ data: Vehicle[] }> => {
-    const response = await fetchAPI('/vehicles');
-    return getJSON<Vehicle[]>(response);
+  getAll: async (): Promise<{ data: Vehicle[]; version: number }> => {
+    const response = await fetchAPI('/vehicles?format=columnar');
+    return getColumnar<Vehicle>(response);
   },
   getById: async (id: number): Promise<{ data: Vehicle }> => {
     const response = await fetchAPI(`/vehicles/${id}`);
@@ -253,9 +360,9 @@ export const vehiclesApi = {
 
 // Drivers API
 export const driversApi = {
-  getAll: async (): Promise<{ data: Driver[] }> => {
-    const response = await fetchAPI('/drivers');
-    return getJSON<Driver[]>(response);
+  getAll: async (): Promise<{ data: Driver[]; version: number }> => {
+    const response = await fetchAPI('/drivers?format=columnar');
+    return getColumnar<Driver>(response);
   },
   getById: async (id: number): Promise<{ data: Driver }> => {
     const response = await fetchAPI(`/drivers/${id}`);
@@ -321,31 +428,59 @@ export const filesApi = {
   },
 };
 
+// Change feed API
+export const changesApi = {
+  since: async (version: number, types?: string[]): Promise<{ data: { version: number; has_more: boolean; events: ChangeEvent[] } }> => {
+    const queryString = buildQueryString({ since: version, types: types?.join(',') });
+    const response = await fetchAPI(`/changes${queryString}`);
+    return getJSON(response);
+  },
+  // Follows the feed from `since`, the version of the list being patched;
+  // returns a function that closes the stream
+  subscribe: (types: string[], since: number, onChange: (event: ChangeEvent) => void): (() => void) => {
+    // EventSource cannot send headers, so the tenant goes in the query string
+    const queryString = buildQueryString({ types: types.join(','), since: since || undefined, company_ids: tenantIds });
+    const source = new EventSource(`${API_BASE_URL}/changes/stream${queryString}`);
+    source.addEventListener('change', (e) => onChange(JSON.parse((e as MessageEvent).data)));
+    return () => source.close();
+  },
+};
+
 // Search API
+export interface DocumentHit {
+  file: { id: number; filename?: string; file_type?: string; file_url: string; uploaded_at?: string; notes?: string;
+          company_id?: number; vehicle_id?: number; driver_id?: number };
+  rank: number;
+  snippet: string; // matches are wrapped in **
+}
+
+export type SearchFilters = Record<string, string | number | boolean | (string | number | boolean)[] | undefined>;
+
 export const searchApi = {
   companies: async (query: string): Promise<{ data: Company[] }> => {
     const queryString = buildQueryString({ q: query });
     const response = await fetchAPI(`/search/companies${queryString}`);
     return getJSON<Company[]>(response);
   },
-  vehicles: async (query: string, filters?: { company_id?: number; vehicle_type?: string }): Promise<{ data: Vehicle[] }> => {
-    const params: Record<string, any> = { q: query };
-    if (filters) {
-      if (filters.company_id !== undefined) params.company_id = filters.company_id;
-      if (filters.vehicle_type !== undefined) params.vehicle_type = filters.vehicle_type;
-    }
-    const queryString = buildQueryString(params);
+  // filters: facet fields (company_id, car_type, manufacturer, ...) and <date field>_from/_to;
+  // sort: comma-separated fields, '-' for descending
+  vehicles: async (query: string, filters?: SearchFilters, sort?: string): Promise<{ data: Vehicle[]; facets?: Facets }> => {
+    const queryString = buildQueryString({ q: query, ...filters, sort, format: 'columnar' });
     const response = await fetchAPI(`/search/vehicles${queryString}`);
-    return getJSON<Vehicle[]>(response);
+    return getColumnar<Vehicle>(response);
   },
-  drivers: async (query: string, filters?: { company_id?: number; status?: string }): Promise<{ data: Driver[] }> => {
-    const params: Record<string, any> = { q: query };
-    if (filters) {
-      if (filters.company_id !== undefined) params.company_id = filters.company_id;
-      if (filters.status !== undefined) params.status = filters.status;
-    }
-    const queryString = buildQueryString(params);
+  drivers: async (query: string, filters?: SearchFilters, sort?: string): Promise<{ data: Driver[]; facets?: Facets }> => {
+    const queryString = buildQueryString({ q: query, ...filters, sort, format: 'columnar' });
     const response = await fetchAPI(`/search/drivers${queryString}`);
-    return getJSON<Driver[]>(response);
+    return getColumnar<Driver>(response);
+  },
+  // Full-text search inside uploaded documents, optionally within one company, vehicle or driver
+  documents: async (
+    query: string,
+    scope?: { company_id?: number; vehicle_id?: number; driver_id?: number },
+  ): Promise<{ data: DocumentHit[] }> => {
+    const queryString = buildQueryString({ q: query, ...scope });
+    const response = await fetchAPI(`/search/files${queryString}`);
+    return getJSON<DocumentHit[]>(response);
   },
 };
@@ -1,6 +1,6 @@
-import { useEffect, useState } from 'react';
+import { useEffect, useRef, useState } from 'react';
 import { Link, useNavigate } from 'react-router-dom';
-import { companiesApi, searchApi, type Company } from '../api/client';
+import { companiesApi, searchApi, changesApi, applyChange, type Company } from '../api/client';
 import AddCompanyModal from '../components/AddCompanyModal';
 
 const CompaniesPage = () => {
@@ -9,17 +9,35 @@ const CompaniesPage = () => {
   const [loading, setLoading] = useState(true);
   const [searchQuery, setSearchQuery] = useState('');
   const [isModalOpen, setIsModalOpen] = useState(false);
+  const searchQueryRef = useRef('');
 
   useEffect(() => {
-    fetchCompanies();
+    // Patch the list from the change feed instead of reloading it after every edit,
+    // starting at the version the list was read at so no change in between is lost
+    let unsubscribe = () => {};
+    let active = true;
+    fetchCompanies().then((version) => {
+      if (!active) return;
+      unsubscribe = changesApi.subscribe(['company'], version, (event) => {
+        // New rows may not match an active search, so only add them to the full list
+        setCompanies((current) => applyChange(current, event, !searchQueryRef.current.trim()));
+      });
+    });
+    return () => {
+      active = false;
+      unsubscribe();
+    };
   }, []);
 
-  const fetchCompanies = async () => {
+  // Returns the version the list was read at (0 when unknown)
+  const fetchCompanies = async (): Promise<number> => {
     try {
       const response = await companiesApi.getAll();
       setCompanies(response.data);
+      return response.version;
     } catch (error) {
       console.error('Error fetching companies:', error);
+      return 0;
     } finally {
       setLoading(false);
     }
@@ -27,6 +45,7 @@ const CompaniesPage = () => {
 
   const handleSearch = async (query: string) => {
     setSearchQuery(query);
+    searchQueryRef.current = query;
     try {
       if (query.trim()) {
         const response = await searchApi.companies(query);
@@ -124,8 +143,12 @@ const CompaniesPage = () => {
         isOpen={isModalOpen}
         onClose={() => setIsModalOpen(false)}
         onSuccess={() => {
-          fetchCompanies();
+          // The new row arrives through the change feed; only a filtered list needs reloading
+          if (searchQueryRef.current.trim()) {
+            fetchCompanies();
+          }
           setSearchQuery('');
+          searchQueryRef.current = '';
         }}
       />
     </div>
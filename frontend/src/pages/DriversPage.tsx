@@ -1,6 +1,6 @@
-import { useEffect, useState } from 'react';
+import { useEffect, useRef, useState } from 'react';
 import { Link, useNavigate } from 'react-router-dom';
-import { driversApi, searchApi, type Driver } from '../api/client';
+import { driversApi, searchApi, changesApi, applyChange, type Driver } from '../api/client';
 import AddDriverModal from '../components/AddDriverModal';
 
 const DriversPage = () => {
@@ -9,17 +9,35 @@ const DriversPage = () => {
   const [loading, setLoading] = useState(true);
   const [searchQuery, setSearchQuery] = useState('');
   const [isModalOpen, setIsModalOpen] = useState(false);
+  const searchQueryRef = useRef('');
 
   useEffect(() => {
-    fetchDrivers();
+    // Patch the list from the change feed instead of reloading it after every edit,
+    // starting at the version the list was read at so no change in between is lost
+    let unsubscribe = () => {};
+    let active = true;
+    fetchDrivers().then((version) => {
+      if (!active) return;
+      unsubscribe = changesApi.subscribe(['driver'], version, (event) => {
+        // New rows may not match an active search, so only add them to the full list
+        setDrivers((current) => applyChange(current, event, !searchQueryRef.current.trim()));
+      });
+    });
+    return () => {
+      active = false;
+      unsubscribe();
+    };
   }, []);
 
-  const fetchDrivers = async () => {
+  // Returns the version the list was read at (0 when unknown)
+  const fetchDrivers = async (): Promise<number> => {
     try {
       const response = await driversApi.getAll();
       setDrivers(response.data);
+      return response.version;
     } catch (error) {
       console.error('Error fetching drivers:', error);
+      return 0;
     } finally {
       setLoading(false);
     }
@@ -27,6 +45,7 @@ const DriversPage = () => {
 
   const handleSearch = async (query: string) => {
     setSearchQuery(query);
+    searchQueryRef.current = query;
     try {
       if (query.trim()) {
         const response = await searchApi.drivers(query);
@@ -131,8 +150,12 @@ const DriversPage = () => {
         isOpen={isModalOpen}
         onClose={() => setIsModalOpen(false)}
         onSuccess={() => {
-          fetchDrivers();
+          // The new row arrives through the change feed; only a filtered list needs reloading
+          if (searchQueryRef.current.trim()) {
+            fetchDrivers();
+          }
           setSearchQuery('');
+          searchQueryRef.current = '';
         }}
       />
     </div>
@@ -1,6 +1,6 @@
-import { useEffect, useState } from 'react';
+import { useEffect, useRef, useState } from 'react';
 import { Link, useNavigate } from 'react-router-dom';
-import { vehiclesApi, searchApi, type Vehicle } from '../api/client';
+import { vehiclesApi, searchApi, changesApi, applyChange, type Vehicle } from '../api/client';
 import AddVehicleModal from '../components/AddVehicleModal';
 
 const VehiclesPage = () => {
@@ -9,17 +9,35 @@ const VehiclesPage = () => {
   const [loading, setLoading] = useState(true);
   const [searchQuery, setSearchQuery] = useState('');
   const [isModalOpen, setIsModalOpen] = useState(false);
+  const searchQueryRef = useRef('');
 
   useEffect(() => {
-    fetchVehicles();
+    // Patch the list from the change feed instead of reloading it after every edit,
+    // starting at the version the list was read at so no change in between is lost
+    let unsubscribe = () => {};
+    let active = true;
+    fetchVehicles().then((version) => {
+      if (!active) return;
+      unsubscribe = changesApi.subscribe(['vehicle'], version, (event) => {
+        // New rows may not match an active search, so only add them to the full list
+        setVehicles((current) => applyChange(current, event, !searchQueryRef.current.trim()));
+      });
+    });
+    return () => {
+      active = false;
+      unsubscribe();
+    };
   }, []);
 
-  const fetchVehicles = async () => {
+  // Returns the version the list was read at (0 when unknown)
+  const fetchVehicles = async (): Promise<number> => {
     try {
       const response = await vehiclesApi.getAll();
       setVehicles(response.data);
+      return response.version;
     } catch (error) {
       console.error('Error fetching vehicles:', error);
+      return 0;
     } finally {
       setLoading(false);
     }
@@ -27,6 +45,7 @@ const VehiclesPage = () => {
 
   const handleSearch = async (query: string) => {
     setSearchQuery(query);
+    searchQueryRef.current = query;
     try {
       if (query.trim()) {
         const response = await searchApi.vehicles(query);
@@ -131,8 +150,12 @@ const VehiclesPage = () => {
         isOpen={isModalOpen}
         onClose={() => setIsModalOpen(false)}
         onSuccess={() => {
-          fetchVehicles();
+          // The new row arrives through the change feed; only a filtered list needs reloading
+          if (searchQueryRef.current.trim()) {
+            fetchVehicles();
+          }
           setSearchQuery('');
+          searchQueryRef.current = '';
         }}
       />
     </div>
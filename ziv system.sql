@@ -16,7 +16,9 @@ CREATE TABLE "company" (
   "carrier_license_expiry" date,
   "established_date" date,
   "inspection_week" integer,
-  "notes" text
+  "notes" text,
+  "updated_at" timestamp,
+  "version" bigint
 );
 
 CREATE TABLE "vehicle" (
@@ -47,7 +49,9 @@ CREATE TABLE "vehicle" (
   "equipment" text,
   "has_tow_hook" boolean,
   "is_operational" boolean,
-  "notes" text
+  "notes" text,
+  "updated_at" timestamp,
+  "version" bigint
 );
 
 CREATE TABLE "driver" (
@@ -73,7 +77,9 @@ CREATE TABLE "driver" (
   "has_crane_operation_permit" boolean,
   "personal_number_in_company" text,
   "email" text,
-  "notes" text
+  "notes" text,
+  "updated_at" timestamp,
+  "version" bigint
 );
 
 CREATE TABLE "files" (
@@ -85,9 +91,168 @@ CREATE TABLE "files" (
   "notes" text,
   "company_id" integer,
   "vehicle_id" integer,
-  "driver_id" integer
+  "driver_id" integer,
+  "updated_at" timestamp,
+  "version" bigint
+);
+
+CREATE TABLE "job" (
+  "id" serial PRIMARY KEY,
+  "name" text NOT NULL,
+  "payload" json,
+  "status" varchar(20) NOT NULL DEFAULT 'queued',
+  "progress" integer DEFAULT 0,
+  "attempts" integer DEFAULT 0,
+  "max_attempts" integer DEFAULT 3,
+  "result" json,
+  "error" text,
+  "run_after" timestamp DEFAULT (CURRENT_TIMESTAMP),
+  "locked_by" text,
+  "locked_at" timestamp,
+  "created_at" timestamp DEFAULT (CURRENT_TIMESTAMP),
+  "started_at" timestamp,
+  "finished_at" timestamp
+);
+
+CREATE INDEX "ix_job_status_run_after" ON "job" ("status", "run_after");
+
+CREATE TABLE "change_event" (
+  "id" serial PRIMARY KEY,
+  "entity_type" varchar(20) NOT NULL,
+  "entity_id" integer NOT NULL,
+  "action" varchar(20) NOT NULL,
+  "data" json,
+  "created_at" timestamp DEFAULT (CURRENT_TIMESTAMP),
+  "company_id" integer,
+  "version" bigint
+);
+
+CREATE INDEX "ix_change_event_version" ON "change_event" ("version");
+
+CREATE INDEX "ix_change_event_company_version" ON "change_event" ("company_id", "version");
+
+CREATE TABLE "sync_state" (
+  "id" serial PRIMARY KEY,
+  "version" bigint NOT NULL DEFAULT 0,
+  "purged_version" bigint NOT NULL DEFAULT 0
+);
+
+CREATE TABLE "tombstone" (
+  "id" serial PRIMARY KEY,
+  "entity_type" varchar(20) NOT NULL,
+  "entity_id" integer NOT NULL,
+  "version" bigint NOT NULL,
+  "deleted_at" timestamp DEFAULT (CURRENT_TIMESTAMP),
+  "company_id" integer
+);
+
+CREATE INDEX "ix_company_version" ON "company" ("version");
+
+CREATE INDEX "ix_vehicle_version" ON "vehicle" ("version");
+
+CREATE UNIQUE INDEX "ux_vehicle_assigned_driver_id" ON "vehicle" ("assigned_driver_id");
+
+CREATE INDEX "ix_vehicle_car_type" ON "vehicle" ("car_type");
+
+CREATE INDEX "ix_vehicle_manufacturer" ON "vehicle" ("manufacturer");
+
+CREATE INDEX "ix_vehicle_department" ON "vehicle" ("department");
+
+CREATE INDEX "ix_vehicle_is_operational" ON "vehicle" ("is_operational");
+
+CREATE INDEX "ix_vehicle_license_expiry_date" ON "vehicle" ("license_expiry_date");
+
+CREATE INDEX "ix_vehicle_company_car_type" ON "vehicle" ("company_id", "car_type");
+
+CREATE INDEX "ix_vehicle_company_license_expiry" ON "vehicle" ("company_id", "license_expiry_date");
+
+CREATE INDEX "ix_driver_version" ON "driver" ("version");
+
+CREATE INDEX "ix_driver_license_class" ON "driver" ("license_class");
+
+CREATE INDEX "ix_driver_license_expiry_date" ON "driver" ("license_expiry_date");
+
+CREATE INDEX "ix_driver_company_license_expiry" ON "driver" ("company_id", "license_expiry_date");
+
+CREATE INDEX "ix_files_version" ON "files" ("version");
+
+CREATE INDEX "ix_files_company_id" ON "files" ("company_id");
+
+CREATE INDEX "ix_files_vehicle_id" ON "files" ("vehicle_id");
+
+CREATE INDEX "ix_files_driver_id" ON "files" ("driver_id");
+
+CREATE INDEX "ix_files_file_url" ON "files" ("file_url");
+
+CREATE INDEX "ix_tombstone_version" ON "tombstone" ("version");
+
+CREATE TABLE "audit_log" (
+  "id" bigserial,
+  "changed_at" timestamp NOT NULL,
+  "entity_type" varchar(20) NOT NULL,
+  "entity_id" integer NOT NULL,
+  "action" varchar(10) NOT NULL,
+  "actor" text,
+  "diff" json,
+  "company_id" integer,
+  PRIMARY KEY ("id", "changed_at")
+) PARTITION BY RANGE ("changed_at");
+
+CREATE TABLE "audit_log_default" PARTITION OF "audit_log" DEFAULT;
+
+CREATE INDEX "ix_audit_log_entity" ON "audit_log" ("entity_type", "entity_id", "changed_at");
+
+CREATE TABLE "assignment_history" (
+  "id" serial PRIMARY KEY,
+  "vehicle_id" integer NOT NULL,
+  "driver_id" integer NOT NULL,
+  "valid_from" timestamp NOT NULL,
+  "valid_to" timestamp,
+  "company_id" integer
+);
+
+CREATE INDEX "ix_assignment_history_vehicle" ON "assignment_history" ("vehicle_id", "valid_from");
+
+CREATE INDEX "ix_assignment_history_driver" ON "assignment_history" ("driver_id", "valid_from");
+
+CREATE UNIQUE INDEX "ux_assignment_history_open_vehicle" ON "assignment_history" ("vehicle_id") WHERE "valid_to" IS NULL;
+
+CREATE INDEX "ix_assignment_history_period" ON "assignment_history" USING gist (tsrange("valid_from", "valid_to", '[)'));
+
+CREATE TABLE "report_row" (
+  "id" serial PRIMARY KEY,
+  "report" varchar(50) NOT NULL,
+  "position" integer NOT NULL,
+  "group_key" text,
+  "company_id" integer,
+  "data" json NOT NULL
+);
+
+CREATE INDEX "ix_report_row_report_position" ON "report_row" ("report", "position");
+
+CREATE INDEX "ix_report_row_report_group" ON "report_row" ("report", "group_key");
+
+CREATE INDEX "ix_report_row_report_company" ON "report_row" ("report", "company_id", "position");
+
+CREATE TABLE "report_state" (
+  "name" varchar(50) PRIMARY KEY,
+  "refreshed_at" timestamp,
+  "source_version" bigint,
+  "row_count" integer,
+  "groups" json
+);
+
+CREATE TABLE "file_text" (
+  "file_id" integer PRIMARY KEY REFERENCES "files" ("id") ON DELETE CASCADE,
+  "status" varchar(20) NOT NULL,
+  "content" text,
+  "error" text,
+  "extracted_at" timestamp,
+  "document" tsvector GENERATED ALWAYS AS (to_tsvector('simple', coalesce("content", ''))) STORED
 );
 
+CREATE INDEX "ix_file_text_document" ON "file_text" USING gin ("document");
+
 ALTER TABLE "vehicle" ADD FOREIGN KEY ("company_id") REFERENCES "company" ("id");
 
 ALTER TABLE "vehicle" ADD FOREIGN KEY ("assigned_driver_id") REFERENCES "driver" ("id");
@@ -99,3 +264,71 @@ ALTER TABLE "files" ADD FOREIGN KEY ("company_id") REFERENCES "company" ("id");
 ALTER TABLE "files" ADD FOREIGN KEY ("vehicle_id") REFERENCES "vehicle" ("id");
 
 ALTER TABLE "files" ADD FOREIGN KEY ("driver_id") REFERENCES "driver" ("id");
+
+-- Upgrading a database created before row versioning
+ALTER TABLE "company" ADD COLUMN IF NOT EXISTS "updated_at" timestamp;
+
+ALTER TABLE "company" ADD COLUMN IF NOT EXISTS "version" bigint;
+
+ALTER TABLE "vehicle" ADD COLUMN IF NOT EXISTS "updated_at" timestamp;
+
+ALTER TABLE "vehicle" ADD COLUMN IF NOT EXISTS "version" bigint;
+
+ALTER TABLE "driver" ADD COLUMN IF NOT EXISTS "updated_at" timestamp;
+
+ALTER TABLE "driver" ADD COLUMN IF NOT EXISTS "version" bigint;
+
+ALTER TABLE "files" ADD COLUMN IF NOT EXISTS "updated_at" timestamp;
+
+ALTER TABLE "files" ADD COLUMN IF NOT EXISTS "version" bigint;
+
+CREATE INDEX IF NOT EXISTS "ix_company_version" ON "company" ("version");
+
+CREATE INDEX IF NOT EXISTS "ix_vehicle_version" ON "vehicle" ("version");
+
+CREATE INDEX IF NOT EXISTS "ix_driver_version" ON "driver" ("version");
+
+CREATE INDEX IF NOT EXISTS "ix_files_version" ON "files" ("version");
+
+-- Upgrading a database created before the change feed was tenant-scoped
+ALTER TABLE "change_event" ADD COLUMN IF NOT EXISTS "company_id" integer;
+
+-- Upgrading a database whose change feed versions were event ids; startup
+-- gives the existing events versions from the sync_state counter
+ALTER TABLE "change_event" ADD COLUMN IF NOT EXISTS "version" bigint;
+
+DROP INDEX IF EXISTS "ix_change_event_company_id";
+
+CREATE INDEX IF NOT EXISTS "ix_change_event_version" ON "change_event" ("version");
+
+CREATE INDEX IF NOT EXISTS "ix_change_event_company_version" ON "change_event" ("company_id", "version");
+
+-- Upgrading a database created before one driver per vehicle was enforced:
+-- keep each driver on the vehicle updated last, then add the unique index.
+-- Startup does the same and also records assignment history and change events.
+UPDATE "vehicle" v SET "assigned_driver_id" = NULL
+WHERE v."assigned_driver_id" IS NOT NULL AND EXISTS (
+  SELECT 1 FROM "vehicle" o
+  WHERE o."assigned_driver_id" = v."assigned_driver_id"
+    AND (COALESCE(o."updated_at", '-infinity'), o."id") > (COALESCE(v."updated_at", '-infinity'), v."id")
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS "ux_vehicle_assigned_driver_id" ON "vehicle" ("assigned_driver_id");
+
+-- Upgrading a database created before audit entries, assignment periods and
+-- tombstones were tenant-scoped. Old audit entries (append-only) and periods
+-- of deleted vehicles keep no company and are only visible unscoped; old
+-- tombstones are pruned, so sync tokens older than them resync.
+ALTER TABLE "audit_log" ADD COLUMN IF NOT EXISTS "company_id" integer;
+
+ALTER TABLE "assignment_history" ADD COLUMN IF NOT EXISTS "company_id" integer;
+
+UPDATE "assignment_history" h SET "company_id" = v."company_id"
+FROM "vehicle" v WHERE v."id" = h."vehicle_id" AND h."company_id" IS NULL;
+
+ALTER TABLE "tombstone" ADD COLUMN IF NOT EXISTS "company_id" integer;
+
+UPDATE "sync_state" SET "purged_version" = GREATEST("purged_version", (SELECT max("version") FROM "tombstone" WHERE "company_id" IS NULL))
+WHERE EXISTS (SELECT 1 FROM "tombstone" WHERE "company_id" IS NULL);
+
+DELETE FROM "tombstone" WHERE "company_id" IS NULL;